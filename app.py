@@ -1,6 +1,7 @@
 import streamlit as st
 import auth
 import db_manager
+import query_monitor
 import pandas as pd
 import datetime
 import email_sender
@@ -10,24 +11,9 @@ import os
 
 from database import get_protheus_connection, get_dts_connection
 from page_dashboard import page_dashboard
-from gerar_base_pedidos import inicializar_e_migrar_db
-
-# Verificar se o banco de dados existe e inicializá-lo se necessário
-if not os.path.exists('garantia.db'):
-    print("Banco de dados não encontrado. Inicializando...")
-    inicializar_e_migrar_db()
-else:
-    # Verificar se a tabela pedidos_info existe e tem dados
-    try:
-        df_test = db_manager.get_clientes_pedidos_equipamentos()
-        if df_test.empty:
-            print("Tabela pedidos_info vazia. Inicializando com dados de exemplo...")
-            db_manager.inicializar_tabela_pedidos_info()
-    except Exception as e:
-        print(f"Erro ao verificar tabela pedidos_info: {e}")
-        print("Inicializando banco de dados...")
-        inicializar_e_migrar_db()
 
+# Cria ou atualiza a estrutura do banco de dados local. Roda a cada execução do script,
+# mas com o schema já atualizado faz apenas a leitura da versão (PRAGMA user_version)
 db_manager.init_database()
 
 
@@ -187,8 +173,20 @@ def page_solicitacao():
                     selected_equipamento_nome = equipamento_selecionado_str.split(" – ")[1]
                 st.markdown("---")
                 st.subheader(f"Componentes para o Equipamento: {selected_equipamento_nome} (SKU: {selected_equipamento_sku})")
-                # 4. Carregar Componentes do Protheus
-                df_componentes = db_manager.get_componentes_by_sku_protheus(selected_equipamento_sku)
+                # 4. Carregar Componentes e Estoque do Protheus. As consultas são sobrepostas e os
+                # componentes de nível 1 aparecem enquanto os subconjuntos ainda estão carregando.
+                carregamento_placeholder = st.empty()
+                df_componentes, df_estoque = pd.DataFrame(), pd.DataFrame()
+                for df_componentes, df_estoque, completo in db_manager.buscar_componentes_e_estoque(selected_equipamento_sku):
+                    if not completo:
+                        with carregamento_placeholder.container():
+                            st.info("Carregando os subconjuntos do equipamento... Componentes de nível 1:")
+                            df_previa = df_componentes[['Componente', 'Descricao_Componente', 'Quantidade']]
+                            if not df_estoque.empty:
+                                saldos = df_estoque.drop_duplicates('Codigo', keep='last').set_index('Codigo')['Saldo_Disponivel']
+                                df_previa = df_previa.assign(Saldo_Disponivel=df_previa['Componente'].map(saldos))
+                            st.dataframe(df_previa, hide_index=True)
+                carregamento_placeholder.empty()
                 if df_componentes.empty:
                     st.warning(f"Nenhum componente encontrado para o SKU '{selected_equipamento_sku}' no Protheus. Verifique a query em `db_manager.py` ou se o SKU possui BOM.")
                     return
@@ -197,18 +195,15 @@ def page_solicitacao():
                     st.session_state.selected_components = {}
                 if selected_equipamento_sku not in st.session_state.selected_components:
                     st.session_state.selected_components[selected_equipamento_sku] = {}
-                # Buscar informações de estoque para todos os componentes de uma vez
-                todos_componentes = df_componentes['Componente'].tolist()
-                df_estoque = db_manager.get_estoque_componentes(todos_componentes)
                 # Criar dicionário para acesso rápido às informações de estoque
-                estoque_dict = {}
-                if not df_estoque.empty:
-                    for _, row in df_estoque.iterrows():
-                        estoque_dict[row['Codigo']] = {
-                            'saldo': row['Saldo_Disponivel'],
-                            'fornecedor': row['Nome_Fornecedor'] if pd.notna(row['Nome_Fornecedor']) else "Não cadastrado",
-                            'previsao_entrega': row['Previsao_Entrega_Ultimo_Pedido'] if pd.notna(row['Previsao_Entrega_Ultimo_Pedido']) else None
-                        }
+                estoque_dict = {
+                    sku: {
+                        'saldo': dados['Saldo_Disponivel'],
+                        'fornecedor': dados.get('Nome_Fornecedor') or "Não cadastrado",
+                        'previsao_entrega': dados.get('Previsao_Entrega_Ultimo_Pedido')
+                    }
+                    for sku, dados in db_manager.indexar_estoque(df_estoque).items()
+                }
                 # Criar uma organização hierárquica para exibição
                 st.write("Selecione os componentes e suas quantidades:")
                 # Opções para filtrar por nível
@@ -229,7 +224,7 @@ def page_solicitacao():
                             component_desc = row['Descricao_Componente']
                             default_qty = int(row['Quantidade']) if pd.notna(row['Quantidade']) else 1
                             # Obter informações de estoque
-                            estoque_info = estoque_dict.get(component_sku, {'saldo': 0, 'fornecedor': "Não encontrado", 'previsao_entrega': None})
+                            estoque_info = estoque_dict.get(str(component_sku).rstrip(), {'saldo': 0, 'fornecedor': "Não encontrado", 'previsao_entrega': None})
                             tem_estoque = estoque_info['saldo'] >= default_qty
                             # Formata a exibição com base no nível
                             prefix = " " * (nivel - 1)
@@ -293,7 +288,7 @@ def page_solicitacao():
                         summary_data = []
                         produtos_sem_estoque = False
                         for comp_info in st.session_state.selected_components[selected_equipamento_sku].values():
-                            estoque_info = estoque_dict.get(comp_info["sku"], {'saldo': 0})
+                            estoque_info = estoque_dict.get(str(comp_info["sku"]).rstrip(), {'saldo': 0})
                             tem_estoque = estoque_info['saldo'] >= comp_info["quantidade"]
                             status_estoque = "✅ Em estoque" if tem_estoque else "❌ Sem estoque"
                             if not tem_estoque:
@@ -365,7 +360,7 @@ def page_solicitacao():
                         component1_desc = row1['Descricao_Componente']
                         default_qty1 = int(row1['Quantidade']) if pd.notna(row1['Quantidade']) else 1
                         # Verificar estoque do componente nível 1
-                        estoque_info1 = estoque_dict.get(component1_sku, {'saldo': 0, 'fornecedor': "Não encontrado", 'previsao_entrega': None})
+                        estoque_info1 = estoque_dict.get(str(component1_sku).rstrip(), {'saldo': 0, 'fornecedor': "Não encontrado", 'previsao_entrega': None})
                         tem_estoque1 = estoque_info1['saldo'] >= default_qty1
                         # Adiciona indicador de falta de estoque ao título do expander
                         expander_title = f"**{component1_sku}** - {component1_desc}"
@@ -417,7 +412,7 @@ def page_solicitacao():
                                         component2_desc = row2['Descricao_Componente']
                                         default_qty2 = int(row2['Quantidade']) if pd.notna(row2['Quantidade']) else 1
                                         # Verificar estoque do componente nível 2
-                                        estoque_info2 = estoque_dict.get(component2_sku, {'saldo': 0, 'fornecedor': "Não encontrado", 'previsao_entrega': None})
+                                        estoque_info2 = estoque_dict.get(str(component2_sku).rstrip(), {'saldo': 0, 'fornecedor': "Não encontrado", 'previsao_entrega': None})
                                         tem_estoque2 = estoque_info2['saldo'] >= default_qty2
                                         # Adiciona indicador de falta de estoque ao título
                                         component2_title = f"**↳ {component2_sku}** - {component2_desc}"
@@ -467,7 +462,7 @@ def page_solicitacao():
                                                     component3_desc = row3['Descricao_Componente']
                                                     default_qty3 = int(row3['Quantidade']) if pd.notna(row3['Quantidade']) else 1
                                                     # Verificar estoque do componente nível 3
-                                                    estoque_info3 = estoque_dict.get(component3_sku, {'saldo': 0, 'fornecedor': "Não encontrado", 'previsao_entrega': None})
+                                                    estoque_info3 = estoque_dict.get(str(component3_sku).rstrip(), {'saldo': 0, 'fornecedor': "Não encontrado", 'previsao_entrega': None})
                                                     tem_estoque3 = estoque_info3['saldo'] >= default_qty3
                                                     # Adiciona indicador de falta de estoque ao título
                                                     component3_title = f"&nbsp;&nbsp;&nbsp;**↳ {component3_sku}** - {component3_desc}"
@@ -513,7 +508,7 @@ def page_solicitacao():
                         summary_data = []
                         produtos_sem_estoque = False
                         for comp_info in st.session_state.selected_components[selected_equipamento_sku].values():
-                            estoque_info = estoque_dict.get(comp_info["sku"], {'saldo': 0})
+                            estoque_info = estoque_dict.get(str(comp_info["sku"]).rstrip(), {'saldo': 0})
                             tem_estoque = estoque_info['saldo'] >= comp_info["quantidade"]
                             status_estoque = "✅ Em estoque" if tem_estoque else "❌ Sem estoque"
                             if not tem_estoque:
@@ -610,6 +605,16 @@ def page_aprovacao_solicitacao():
         return
     
     st.write(f"**{len(solicitacoes_pendentes)}** solicitações pendentes de aprovação:")
+    
+    # Itens e estoque de toda a fila numa consulta ao SQLite e uma ao Protheus
+    itens_por_solicitacao, df_estoque = db_manager.carregar_fila_aprovacao(solicitacoes_pendentes)
+    
+    # Dicionário para mapear estoque por SKU
+    estoque_por_sku = {
+        sku: {'saldo': dados['Saldo_Disponivel'], 'previsao': dados.get('Previsao_Entrega_Ultimo_Pedido')}
+        for sku, dados in db_manager.indexar_estoque(df_estoque).items()
+    }
+    
     for index, solicitacao in solicitacoes_pendentes.iterrows():
         st.markdown(f"---")
         st.subheader(f"Solicitação #{solicitacao['id']} - Cliente: {solicitacao['cliente_nome']}")
@@ -622,23 +627,10 @@ def page_aprovacao_solicitacao():
             st.write(f"**Pedido Venda:** {solicitacao['pedido_venda']}")
             st.write(f"**Status:** {solicitacao['status_atual']}")
         
-        # Busca itens da solicitação
-        itens = db_manager.get_itens_solicitacao(solicitacao['id'])
+        # Itens da solicitação, já carregados com a fila
+        itens = itens_por_solicitacao[int(solicitacao['id'])]
         
         if not itens.empty:
-            # Busca informações de estoque para os componentes
-            componentes_skus = itens['componente_sku'].tolist()
-            df_estoque = db_manager.get_estoque_componentes(componentes_skus)
-            
-            # Criar um dicionário para mapear estoque por SKU
-            estoque_por_sku = {}
-            if not df_estoque.empty:
-                for _, row in df_estoque.iterrows():
-                    estoque_por_sku[row['Codigo']] = {
-                        'saldo': row['Saldo_Disponivel'],
-                        'previsao': row.get('Previsao_Entrega_Ultimo_Pedido')
-                    }
-            
             # Prepara dados para exibição com informações de estoque
             display_data = []
             algum_estoque_insuficiente = False
@@ -647,7 +639,7 @@ def page_aprovacao_solicitacao():
                 sku = item['componente_sku']
                 qtd_solicitada = item['quantidade_solicitada']
                 
-                estoque_info = estoque_por_sku.get(sku, {'saldo': 0, 'previsao': None})
+                estoque_info = estoque_por_sku.get(str(sku).rstrip(), {'saldo': 0, 'previsao': None})
                 saldo_disponivel = estoque_info['saldo']
                 previsao_chegada = estoque_info['previsao']
                 
@@ -768,6 +760,58 @@ def page_diagnostico():
     else:
         st.write(f"Total de solicitações pendentes: {len(all_pending)}")
         st.dataframe(all_pending[['id', 'solicitante', 'cliente_nome', 'centro_custo', 'setor', 'data_criacao', 'data_ultimo_status']])
+    
+    # Telemetria do ETL de pedidos (gerar_base_pedidos.py)
+    st.header("Execuções do ETL de Pedidos")
+    etl_runs = db_manager.get_etl_runs()
+    if etl_runs.empty:
+        st.info("Nenhuma execução do ETL de pedidos foi registrada ainda.")
+    else:
+        ultima = etl_runs.iloc[0]
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Status", ultima['status'])
+        col2.metric("Tempo total (s)", f"{ultima['tempo_total']:.1f}")
+        col3.metric("Registros/s", f"{ultima['registros_por_segundo'] or 0:.1f}")
+        col4.metric("Latência DTS p95 (ms)", f"{ultima['latencia_p95_ms'] or 0:.0f}")
+        
+        # Compara a vazão da última carga bem-sucedida com a mediana das anteriores
+        sucessos = etl_runs[etl_runs['status'] == 'sucesso']
+        if len(sucessos) > 1:
+            vazao_atual = sucessos.iloc[0]['registros_por_segundo']
+            vazao_mediana = sucessos.iloc[1:]['registros_por_segundo'].median()
+            if vazao_atual and vazao_mediana and vazao_atual < 0.7 * vazao_mediana:
+                st.warning(f"A última carga processou {vazao_atual:.1f} registros/s, abaixo da mediana "
+                           f"das execuções anteriores ({vazao_mediana:.1f} registros/s).")
+        
+        st.subheader("Tempo por Fase (s)")
+        fases = etl_runs.set_index('inicio')[[
+            'tempo_extracao_protheus', 'tempo_procedure_dts', 'tempo_conversao_decimal', 'tempo_escrita_sqlite'
+        ]].sort_index()
+        st.bar_chart(fases)
+        
+        st.subheader("Histórico de Execuções")
+        st.dataframe(etl_runs[[
+            'inicio', 'modo', 'status', 'workers', 'total_pedidos', 'total_registros', 'tempo_total',
+            'registros_por_segundo', 'latencia_p50_ms', 'latencia_p95_ms', 'pedidos_com_erro'
+        ]])
+    
+    # Consultas ao Protheus, DTS e SQLite registradas pelo query_monitor
+    st.header("Consultas aos Bancos de Dados")
+    top_consultas = query_monitor.get_top_consultas()
+    if top_consultas.empty:
+        st.info("Nenhuma consulta registrada desde o início do processo.")
+    else:
+        st.subheader("Consultas com Maior Tempo Total (execuções recentes)")
+        tempo_por_banco = top_consultas.groupby('banco')['tempo_total_ms'].sum()
+        st.bar_chart(tempo_por_banco)
+        st.dataframe(top_consultas)
+    
+    consultas_lentas = query_monitor.get_consultas_lentas()
+    st.subheader(f"Consultas Lentas (≥ {query_monitor.QUERY_LENTA_MS:.0f} ms)")
+    if consultas_lentas.empty:
+        st.info("Nenhuma consulta lenta registrada.")
+    else:
+        st.dataframe(consultas_lentas[['timestamp', 'banco', 'duracao_ms', 'linhas', 'origem', 'pagina', 'fingerprint']])
 
 def page_liberacao_almoxarifado():
     if not auth.has_permission(["Almoxarifado"]):
@@ -805,22 +849,24 @@ def page_liberacao_almoxarifado():
             st.write(f"**Pedido Venda:** {solicitacao['pedido_venda']}")
             st.write(f"**Status:** {solicitacao['status_atual']}")
         
-        # Buscar informações de estoque para os componentes
+        # Buscar informações de estoque para os componentes, com o detalhe por armazém
         componentes_skus = itens['componente_sku'].tolist()
-        df_estoque = db_manager.get_estoque_componentes(componentes_skus)
+        df_estoque = db_manager.get_estoque_componentes(componentes_skus, por_armazem=True)
         
-        # Criar um dicionário para mapear estoque por SKU
-        estoque_por_sku = {}
-        if not df_estoque.empty:
-            for _, row in df_estoque.iterrows():
-                estoque_por_sku[row['Codigo']] = {
-                    'saldo': row['Saldo_Disponivel'],
-                    'quantidade_atual': row['Quantidade_Atual'],
-                    'empenhada': row.get('Quantidade_Empenhada', 0),
-                    'reservada': row.get('Quantidade_Reservada', 0),
-                    'previsao': row.get('Previsao_Entrega_Ultimo_Pedido'),
-                    'armazem': row.get('Armazem', '')
-                }
+        # Dicionário para mapear estoque por SKU (saldos somados de todos os armazéns)
+        estoque_por_sku = {
+            sku: {
+                'saldo': dados['Saldo_Disponivel'],
+                'quantidade_atual': dados['Quantidade_Atual'],
+                'empenhada': dados['Quantidade_Empenhada'],
+                'reservada': dados['Quantidade_Reservada'],
+                'previsao': dados.get('Previsao_Entrega_Ultimo_Pedido'),
+                'armazem': ", ".join(
+                    f"{str(armazem['Armazem']).strip()} ({armazem['Saldo_Disponivel']:.0f})" for armazem in dados['Armazens']
+                )
+            }
+            for sku, dados in db_manager.indexar_estoque(df_estoque).items()
+        }
         
         st.markdown("---")
         st.subheader("Componentes para Liberar")
@@ -833,7 +879,7 @@ def page_liberacao_almoxarifado():
             sku = item['componente_sku']
             qtd_solicitada = int(item['quantidade_solicitada'])  # Garantindo que seja int
             
-            estoque_info = estoque_por_sku.get(sku, {'saldo': 0, 'quantidade_atual': 0, 'empenhada': 0, 'reservada': 0, 'previsao': None, 'armazem': ''})
+            estoque_info = estoque_por_sku.get(str(sku).rstrip(), {'saldo': 0, 'quantidade_atual': 0, 'empenhada': 0, 'reservada': 0, 'previsao': None, 'armazem': ''})
             saldo_disponivel = int(estoque_info['saldo'])  # Garantindo que seja int
             
             # Verifica se há estoque suficiente
@@ -908,16 +954,18 @@ def page_liberacao_almoxarifado():
             # Botão com texto que reflete o tipo de liberação
             button_text = f"{status_liberacao} - Solicitação #{selected_solicitacao_id}"
             if st.button(button_text, type="primary"):
-                db_manager.update_itens_solicitacao_liberacao(selected_solicitacao_id, editable_itens, auth.get_logged_in_username())
-                db_manager.update_status_solicitacao(
-                    selected_solicitacao_id,
-                    status_liberacao,
-                    auth.get_logged_in_username(),
-                    f"Componentes separados e {status_liberacao.lower()}.",
-                    almoxarife_liberacao=auth.get_logged_in_username(),
-                    data_liberacao=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    motivo_nao_disponivel=None
-                )
+                # Itens, status e histórico num único commit
+                with db_manager.transacao():
+                    db_manager.update_itens_solicitacao_liberacao(selected_solicitacao_id, editable_itens, auth.get_logged_in_username())
+                    db_manager.update_status_solicitacao(
+                        selected_solicitacao_id,
+                        status_liberacao,
+                        auth.get_logged_in_username(),
+                        f"Componentes separados e {status_liberacao.lower()}.",
+                        almoxarife_liberacao=auth.get_logged_in_username(),
+                        data_liberacao=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                        motivo_nao_disponivel=None
+                    )
                 st.success(f"Solicitação #{selected_solicitacao_id}: Componentes marcados como '{status_liberacao}'.")
                 st.rerun()
                 
@@ -1013,15 +1061,17 @@ def page_confirmar_retirada_devolucao():
                     st.warning(f"Você não tem permissão para confirmar a retirada desta solicitação. Apenas o solicitante original ({solicitacao['solicitante']}) pode fazer isso.")
                 else:
                     if st.button(f"Confirmar Retirada - Solicitação #{selected_solicitacao_id}", type="primary"):
-                        db_manager.update_itens_solicitacao_retirada(selected_solicitacao_id, logged_in_user)
-                        db_manager.update_status_solicitacao(
-                            selected_solicitacao_id,
-                            'Retirada Confirmada',
-                            logged_in_user,
-                            "Solicitante confirmou a retirada dos componentes.",
-                            retirado_por=logged_in_user,
-                            data_retirada=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        )
+                        # Itens, status e histórico num único commit
+                        with db_manager.transacao():
+                            db_manager.update_itens_solicitacao_retirada(selected_solicitacao_id, logged_in_user)
+                            db_manager.update_status_solicitacao(
+                                selected_solicitacao_id,
+                                'Retirada Confirmada',
+                                logged_in_user,
+                                "Solicitante confirmou a retirada dos componentes.",
+                                retirado_por=logged_in_user,
+                                data_retirada=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                            )
                         st.success(f"Retirada da Solicitação #{selected_solicitacao_id} confirmada!")
                         st.rerun()
             else:
@@ -1073,14 +1123,16 @@ def page_confirmar_retirada_devolucao():
                     if st.button(f"Registrar Devolução - Solicitação #{selected_solicitacao_id}", type="secondary"):
                         itens_para_devolver = [item for item in editable_devolucao_itens if item['quantidade_devolvida'] > itens.loc[itens['id'] == item['id'], 'quantidade_devolvida'].iloc[0]]
                         if itens_para_devolver:
-                            db_manager.update_itens_solicitacao_devolucao(selected_solicitacao_id, itens_para_devolver, logged_in_user)
-                            db_manager.update_status_solicitacao(
-                                selected_solicitacao_id,
-                                'Devolução Pendente Almoxarifado',
-                                logged_in_user,
-                                "Solicitante registrou componentes para devolução.",
-                                data_devolucao_solicitada=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                            )
+                            # Itens, status e histórico num único commit
+                            with db_manager.transacao():
+                                db_manager.update_itens_solicitacao_devolucao(selected_solicitacao_id, itens_para_devolver, logged_in_user)
+                                db_manager.update_status_solicitacao(
+                                    selected_solicitacao_id,
+                                    'Devolução Pendente Almoxarifado',
+                                    logged_in_user,
+                                    "Solicitante registrou componentes para devolução.",
+                                    data_devolucao_solicitada=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                                )
                             st.success(f"Devolução da Solicitação #{selected_solicitacao_id} registrada. Aguardando confirmação do almoxarifado.")
                             st.rerun()
                         else:
@@ -1094,16 +1146,18 @@ def page_confirmar_retirada_devolucao():
                 st.markdown("---")
                 st.subheader("Ação do Almoxarifado")
                 if st.button(f"Confirmar Recebimento Devolução - Solicitação #{selected_solicitacao_id}", type="primary"):
-                    db_manager.confirm_itens_solicitacao_devolucao_almoxarifado(selected_solicitacao_id, logged_in_user)
-                    db_manager.update_status_solicitacao(
-                        selected_solicitacao_id,
-                        'Devolução Concluída',
-                        logged_in_user,
-                        "Almoxarifado confirmou o recebimento dos componentes devolvidos.",
-                        almoxarife_devolucao_confirmacao=logged_in_user,
-                        data_devolucao_confirmada=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                        data_finalizacao=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') # Finaliza após devolução
-                    )
+                    # Itens, status e histórico num único commit
+                    with db_manager.transacao():
+                        db_manager.confirm_itens_solicitacao_devolucao_almoxarifado(selected_solicitacao_id, logged_in_user)
+                        db_manager.update_status_solicitacao(
+                            selected_solicitacao_id,
+                            'Devolução Concluída',
+                            logged_in_user,
+                            "Almoxarifado confirmou o recebimento dos componentes devolvidos.",
+                            almoxarife_devolucao_confirmacao=logged_in_user,
+                            data_devolucao_confirmada=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                            data_finalizacao=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') # Finaliza após devolução
+                        )
                     st.success(f"Devolução da Solicitação #{selected_solicitacao_id} confirmada pelo Almoxarifado e processo finalizado!")
                     st.rerun()
             else:
@@ -1156,16 +1210,18 @@ def page_devolucoes_almoxarifado():
             st.info("Nenhum componente registrado para devolução nesta solicitação.")
 
         if st.button(f"Confirmar Devolução - Solicitação #{solicitacao['id']}", key=f"confirm_dev_{solicitacao['id']}", type="primary"):
-            db_manager.confirm_itens_solicitacao_devolucao_almoxarifado(solicitacao['id'], auth.get_logged_in_username())
-            db_manager.update_status_solicitacao(
-                solicitacao['id'],
-                'Devolução Concluída',
-                auth.get_logged_in_username(),
-                "Almoxarifado confirmou o recebimento dos componentes devolvidos.",
-                almoxarife_devolucao_confirmacao=auth.get_logged_in_username(),
-                data_devolucao_confirmada=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                data_finalizacao=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') # Finaliza após devolução
-            )
+            # Itens, status e histórico num único commit
+            with db_manager.transacao():
+                db_manager.confirm_itens_solicitacao_devolucao_almoxarifado(solicitacao['id'], auth.get_logged_in_username())
+                db_manager.update_status_solicitacao(
+                    solicitacao['id'],
+                    'Devolução Concluída',
+                    auth.get_logged_in_username(),
+                    "Almoxarifado confirmou o recebimento dos componentes devolvidos.",
+                    almoxarife_devolucao_confirmacao=auth.get_logged_in_username(),
+                    data_devolucao_confirmada=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    data_finalizacao=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S') # Finaliza após devolução
+                )
             st.success(f"Devolução da Solicitação #{solicitacao['id']} confirmada e processo finalizado!")
             st.rerun()
 
@@ -1446,6 +1502,7 @@ def main():
 
         # Renderiza a página selecionada
         if selected_page:
+            query_monitor.definir_pagina(selected_page)
             pages[selected_page]()
 
         st.sidebar.markdown("---")
@@ -1453,9 +1510,5 @@ def main():
             auth.logout()
 
 if __name__ == "__main__":
-    # Garante que o DB local e as tabelas estejam criadas/atualizadas antes de iniciar o app
-    from gerar_base_pedidos import inicializar_e_migrar_db
-    inicializar_e_migrar_db()
-    
     main()
 
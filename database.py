@@ -1,10 +1,28 @@
 import streamlit as st
+import pandas as pd
 import os
+import sqlite3
+import queue
+import threading
+import time
+import weakref
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from query_monitor import instrumentar, definir_pagina, pagina_atual, InstrumentedSQLiteConnection
+from query_replay import preparar_conexao, modo_reproducao
 
 # Verifica se estamos executando no Streamlit Cloud
 is_streamlit_cloud = os.environ.get('STREAMLIT_SHARING', False) or 'streamlit.app' in os.environ.get('HOSTNAME', '')
 
+# Permite que threads auxiliares usem st.error/st.warning na sessão que as criou
+try:
+    from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+except ImportError:
+    add_script_run_ctx = get_script_run_ctx = None
+
 # Tenta importar pyodbc apenas se não estiver no Streamlit Cloud
+pyodbc = None
 if not is_streamlit_cloud:
     try:
         import pyodbc
@@ -60,85 +78,464 @@ class MockCursor:
     def close(self):
         print(f"Fechando cursor simulado para {self.db_name}")
 
-# Função para criar e retornar uma conexão com o banco de dados Protheus
-@st.cache_resource
-def get_protheus_connection():
+PROTHEUS_CONNECTION_STRING = (
+    "DRIVER={ODBC Driver 18 for SQL Server};"
+    "SERVER=192.168.3.205;"  # <-- CORRIGIDO: IP do script funcional
+    "DATABASE=PROTHEUS_PRODUCAO;" # <-- CORRIGIDO: Nome do banco do script funcional
+    "UID=almoxarifado;"           # <-- CORRIGIDO: Usuário do script funcional
+    "PWD=almoxarifado;"           # <-- CORRIGIDO: Senha do script funcional
+    "TrustServerCertificate=yes;" # <-- ADICIONADO: Parâmetro essencial que faltava
+    "Encrypt=yes;"                # Adicionado para consistência com o script funcional
+)
+
+# Quantidade máxima de conexões simultâneas com o Protheus (compartilhadas por todas as sessões)
+PROTHEUS_POOL_TAMANHO = int(os.environ.get('PROTHEUS_POOL_TAMANHO', 4))
+# Tempo máximo (s) esperando uma conexão livre do pool antes de desistir
+POOL_TIMEOUT_CHECKOUT = float(os.environ.get('POOL_TIMEOUT_CHECKOUT', 30))
+# Conexões ociosas há mais que este tempo (s) são testadas com um ping antes de serem entregues
+POOL_PING_APOS_SEGUNDOS = float(os.environ.get('POOL_PING_APOS_SEGUNDOS', 60))
+
+def _erro_de_comunicacao(erro):
     """
-    Cria e retorna uma conexão com o banco de dados Protheus (interno).
-    As credenciais são baseadas nos scripts funcionais fornecidos.
+    Indica se o erro (ou a exceção que o originou, como nos erros embrulhados pelo pandas)
+    é uma falha de comunicação do pyodbc, caso em que a conexão não deve ser reaproveitada.
+    """
+    if pyodbc is None:
+        return False
+    while erro is not None:
+        if isinstance(erro, (pyodbc.OperationalError, pyodbc.InterfaceError)):
+            return True
+        erro = erro.__cause__ or erro.__context__
+    return False
+
+class FalhaConexao(Exception):
+    """O pool não conseguiu abrir uma conexão nova com o banco."""
+
+class ConnectionPool:
     """
+    Pool limitado e thread-safe de conexões.
+    
+    No máximo 'tamanho' conexões ficam emprestadas ao mesmo tempo; quem pede uma conexão
+    com o pool esgotado espera até 'timeout_checkout' segundos. Conexões ociosas há mais de
+    'ping_apos_segundos' são testadas antes de serem entregues e, se estiverem quebradas,
+    são substituídas por uma nova. Uma conexão devolvida após falha de comunicação é fechada.
+    As conexões emprestadas por connection() registram suas consultas no query_monitor.
+    """
+    def __init__(self, nome, fabrica, tamanho, timeout_checkout=POOL_TIMEOUT_CHECKOUT,
+                 ping_apos_segundos=POOL_PING_APOS_SEGUNDOS):
+        self.nome = nome
+        self.tamanho = tamanho
+        self._fabrica = fabrica
+        self._timeout_checkout = timeout_checkout
+        self._ping_apos_segundos = ping_apos_segundos
+        self._livres = queue.LifoQueue()  # (conexão, instante da devolução)
+        self._vagas = threading.BoundedSemaphore(tamanho)
+    
+    def _conexao_viva(self, conn):
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            return True
+        except Exception as e:
+            print(f"Conexão ociosa com {self.nome} não respondeu ao ping e será substituída: {e}")
+            return False
+    
+    def _fechar(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+    
+    def acquire(self):
+        """Retira uma conexão do pool, abrindo uma nova se não houver nenhuma livre."""
+        if not self._vagas.acquire(timeout=self._timeout_checkout):
+            raise TimeoutError(
+                f"Nenhuma conexão com {self.nome} ficou livre em {self._timeout_checkout:.0f}s "
+                f"(pool com {self.tamanho} conexões)."
+            )
+        try:
+            while True:
+                try:
+                    conn, devolvida_em = self._livres.get_nowait()
+                except queue.Empty:
+                    try:
+                        conn = self._fabrica()
+                    except Exception as e:
+                        raise FalhaConexao(f"Falha ao conectar ao {self.nome}: {e}") from e
+                    print(f"Nova conexão com {self.nome} aberta para o pool.")
+                    return conn
+                if time.monotonic() - devolvida_em < self._ping_apos_segundos or self._conexao_viva(conn):
+                    return conn
+                self._fechar(conn)
+        except BaseException:
+            self._vagas.release()
+            raise
+    
+    def release(self, conn, descartar=False):
+        """Devolve a conexão ao pool; com descartar=True ela é fechada."""
+        try:
+            if descartar:
+                self._fechar(conn)
+            else:
+                self._livres.put((conn, time.monotonic()))
+        finally:
+            self._vagas.release()
+    
+    @contextmanager
+    def connection(self):
+        """Empresta uma conexão durante o bloco 'with' e a devolve ao final."""
+        conn = self.acquire()
+        descartar = False
+        try:
+            yield instrumentar(conn, self.nome)
+        except BaseException as e:
+            descartar = _erro_de_comunicacao(e)
+            raise
+        finally:
+            self.release(conn, descartar)
+    
+    def close_all(self):
+        """Fecha as conexões livres (as emprestadas são fechadas quando forem devolvidas)."""
+        while True:
+            try:
+                conn, _ = self._livres.get_nowait()
+            except queue.Empty:
+                return
+            self._fechar(conn)
+
+# Pools e demais recursos compartilhados por todas as sessões do processo. Ficam no módulo
+# (e não em st.cache_resource) para valer também nos scripts executados fora do Streamlit.
+_recursos_compartilhados = {}
+_recursos_lock = threading.Lock()
+
+def _recurso_compartilhado(nome, criar):
+    with _recursos_lock:
+        if nome not in _recursos_compartilhados:
+            _recursos_compartilhados[nome] = criar()
+        return _recursos_compartilhados[nome]
+
+def _conectar_protheus():
+    if (is_streamlit_cloud or pyodbc is None) and not modo_reproducao():
+        return MockConnection("PROTHEUS_PRODUCAO")
+    # Com DB_MODO_GRAVACAO, a conexão grava ou reproduz as consultas (query_replay)
+    return preparar_conexao("PROTHEUS", lambda: pyodbc.connect(PROTHEUS_CONNECTION_STRING, timeout=30))
+
+def _criar_pool_protheus():
     if is_streamlit_cloud:
         st.warning("Executando em ambiente Streamlit Cloud: usando conexão simulada para Protheus")
-        return MockConnection("PROTHEUS_PRODUCAO")
+    return ConnectionPool("PROTHEUS", _conectar_protheus, PROTHEUS_POOL_TAMANHO)
+
+def get_protheus_pool():
+    """Retorna o pool de conexões com o Protheus (interno), único para todo o processo."""
+    return _recurso_compartilhado('pool_protheus', _criar_pool_protheus)
+
+def get_protheus_connection():
+    """
+    Empresta uma conexão do pool do Protheus (interno). Use como context manager:
     
-    try:
-        connection_string = (
-            "DRIVER={ODBC Driver 18 for SQL Server};"
-            "SERVER=192.168.3.205;"  # <-- CORRIGIDO: IP do script funcional
-            "DATABASE=PROTHEUS_PRODUCAO;" # <-- CORRIGIDO: Nome do banco do script funcional
-            "UID=almoxarifado;"           # <-- CORRIGIDO: Usuário do script funcional
-            "PWD=almoxarifado;"           # <-- CORRIGIDO: Senha do script funcional
-            "TrustServerCertificate=yes;" # <-- ADICIONADO: Parâmetro essencial que faltava
-            "Encrypt=yes;"                # Adicionado para consistência com o script funcional
-        )
-        conn = pyodbc.connect(connection_string, timeout=30)
-        print("Conexão com PROTHEUS (interno) bem-sucedida!")
-        return conn
-    except Exception as e:
-        print(f"Erro ao conectar ao PROTHEUS (interno): {e}")
-        # Exibe o erro no Streamlit e para a execução
-        st.error(f"Falha na conexão com o banco de dados Protheus (interno). Verifique o console para detalhes. Erro: {e}")
-        if not is_streamlit_cloud:
-            st.stop()
-        else:
-            st.warning("Usando conexão simulada como fallback")
-            return MockConnection("PROTHEUS_PRODUCAO")
+        with get_protheus_connection() as conn:
+            ...
+    
+    A conexão volta ao pool ao final do bloco (ou é descartada, se a comunicação falhou).
+    """
+    return get_protheus_pool().connection()
 
-# Função para criar e retornar uma conexão com o banco de dados DTS
-@st.cache_resource
-def get_dts_connection():
+def interromper_sem_protheus(erro):
     """
-    Cria e retorna uma conexão com o banco de dados DTS (externo).
+    Mostra na página a falha ao conectar ao Protheus e interrompe a execução do script.
+    Fora da thread do script (threads do pool, scripts de linha de comando) o st.stop não
+    interrompe nada, então o erro é relançado para quem chamou.
     """
-    if is_streamlit_cloud:
-        st.warning("Executando em ambiente Streamlit Cloud: usando conexão simulada para DTS")
+    print(f"Erro ao conectar ao PROTHEUS (interno): {erro}")
+    st.error(f"Falha na conexão com o banco de dados Protheus (interno). Verifique o console para detalhes. Erro: {erro}")
+    st.stop()
+    raise erro
+
+def get_executor_protheus():
+    """Threads para consultas simultâneas ao Protheus, uma por conexão do pool."""
+    return _recurso_compartilhado(
+        'executor_protheus',
+        lambda: ThreadPoolExecutor(max_workers=PROTHEUS_POOL_TAMANHO, thread_name_prefix='protheus')
+    )
+
+# Listas IN são enviadas como parâmetros em blocos de tamanho fixo: o texto do SQL é sempre
+# o mesmo (o SQL Server reaproveita o plano) e o limite de 2100 parâmetros nunca é atingido
+IN_LOTE_TAMANHO = int(os.environ.get('IN_LOTE_TAMANHO', 200))
+
+def _get_executor_lotes_protheus():
+    # Separado de get_executor_protheus: quem espera pelos blocos pode estar numa daquelas threads
+    return _recurso_compartilhado(
+        'executor_lotes_protheus',
+        lambda: ThreadPoolExecutor(max_workers=PROTHEUS_POOL_TAMANHO, thread_name_prefix='protheus-lotes')
+    )
+
+def consultar_protheus_em_lotes(query, valores, tamanho_lote=None, paralelo=True):
+    """
+    Executa no Protheus uma consulta com lista IN parametrizada, em blocos de tamanho fixo.
+    
+    query: SQL com o marcador '{marcadores}' no lugar da lista, ex.: "... WHERE B1_COD IN ({marcadores})".
+    valores: valores da lista (duplicados são ignorados). O último bloco é completado repetindo
+        o último valor, para que todos os blocos usem o mesmo texto de SQL.
+    paralelo: com mais de um bloco, consulta os blocos simultaneamente nas conexões do pool.
+    Retorna um DataFrame com os resultados de todos os blocos.
+    """
+    tamanho_lote = tamanho_lote or IN_LOTE_TAMANHO
+    valores = list(dict.fromkeys(valores))
+    if not valores:
+        return pd.DataFrame()
+    sql = query.format(marcadores=', '.join('?' for _ in range(tamanho_lote)))
+    blocos = []
+    for i in range(0, len(valores), tamanho_lote):
+        bloco = valores[i:i + tamanho_lote]
+        blocos.append(bloco + [bloco[-1]] * (tamanho_lote - len(bloco)))
+    
+    def consultar_bloco(bloco):
+        with get_protheus_connection() as conn:
+            return pd.read_sql(sql, conn, params=bloco)
+    
+    if paralelo and len(blocos) > 1:
+        futuros = [submeter(_get_executor_lotes_protheus(), consultar_bloco, bloco) for bloco in blocos]
+        resultados = [futuro.result() for futuro in futuros]
+    else:
+        resultados = [consultar_bloco(bloco) for bloco in blocos]
+    return pd.concat(resultados, ignore_index=True)
+
+def submeter(executor, funcao, *args, **kwargs):
+    """
+    Executa 'funcao' no executor levando junto o contexto da sessão do Streamlit e a
+    página do query_monitor da thread que submeteu. Retorna o Future.
+    """
+    contexto = get_script_run_ctx() if get_script_run_ctx else None
+    pagina = pagina_atual()
+    
+    def executar():
+        if contexto is not None:
+            add_script_run_ctx(threading.current_thread(), contexto)
+        definir_pagina(pagina)
+        return funcao(*args, **kwargs)
+    return executor.submit(executar)
+
+DTS_CONNECTION_STRING = (
+    "DRIVER={ODBC Driver 18 for SQL Server};"
+    "SERVER=177.136.226.250;"
+    "DATABASE=TOPEMA_PRD;"
+    "UID=TOPEMA_DR;"
+    "PWD=T0p_X9iF*^@C~$;"
+    "TrustServerCertificate=yes;" # Adicionado para consistência
+)
+
+# Quantidade máxima de conexões simultâneas com o DTS no app
+DTS_POOL_TAMANHO = int(os.environ.get('DTS_POOL_TAMANHO', 4))
+# Tempo máximo (s) de cada consulta no DTS; 0 desativa o limite
+DTS_TIMEOUT_CONSULTA = int(os.environ.get('DTS_TIMEOUT_CONSULTA', 120))
+
+def _conectar_dts(timeout_consulta=DTS_TIMEOUT_CONSULTA):
+    if (is_streamlit_cloud or pyodbc is None) and not modo_reproducao():
         return MockConnection("TOPEMA_PRD")
     
-    try:
-        connection_string = (
-            "DRIVER={ODBC Driver 18 for SQL Server};"
-            "SERVER=177.136.226.250;"
-            "DATABASE=TOPEMA_PRD;"
-            "UID=TOPEMA_DR;"
-            "PWD=T0p_X9iF*^@C~$;"
-            "TrustServerCertificate=yes;" # Adicionado para consistência
-        )
-        conn = pyodbc.connect(connection_string, timeout=30)
-        print("Conexão com DTS (externo) bem-sucedida!")
+    def conectar():
+        conn = pyodbc.connect(DTS_CONNECTION_STRING, timeout=30)
+        # Timeout por consulta: o driver cancela a execução que passar deste tempo
+        conn.timeout = timeout_consulta
         return conn
-    except Exception as e:
-        print(f"Erro ao conectar ao DTS (externo): {e}")
-        # Exibe o erro no Streamlit e para a execução
-        st.error(f"Falha na conexão com o banco de dados DTS (externo). Verifique o console para detalhes. Erro: {e}")
-        if not is_streamlit_cloud:
-            st.stop()
-        else:
-            st.warning("Usando conexão simulada como fallback")
-            return MockConnection("TOPEMA_PRD")
+    return preparar_conexao("DTS", conectar)
+
+def criar_pool_dts(tamanho=DTS_POOL_TAMANHO, timeout_consulta=DTS_TIMEOUT_CONSULTA):
+    """Cria um pool de conexões com o DTS (externo); usado diretamente pelo ETL de pedidos."""
+    return ConnectionPool("DTS", lambda: _conectar_dts(timeout_consulta), tamanho)
+
+def _criar_pool_dts_app():
+    if is_streamlit_cloud:
+        st.warning("Executando em ambiente Streamlit Cloud: usando conexão simulada para DTS")
+    return criar_pool_dts()
+
+def get_dts_pool():
+    """Retorna o pool de conexões com o DTS (externo) usado pelo app, único para todo o processo."""
+    return _recurso_compartilhado('pool_dts', _criar_pool_dts_app)
+
+def get_dts_connection():
+    """
+    Empresta uma conexão do pool do DTS (externo). Use como context manager:
+    
+        with get_dts_connection() as conn:
+            ...
+    """
+    return get_dts_pool().connection()
+
+def consultar_pedido_dts(numero, pool=None):
+    """
+    Executa a procedure XSP_0044_DTS_PedidosVendasInfo para um pedido de venda.
+    
+    Retorna (colunas, linhas), em que 'colunas' é a lista de (nome, tipo Python)
+    obtida de cursor.description. Erros de banco são propagados para o chamador.
+    """
+    if pool is None:
+        pool = get_dts_pool()
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            # Adaptação para garantir que o numero seja string, se necessário pela procedure
+            cursor.execute("EXEC XSP_0044_DTS_PedidosVendasInfo @CD_PEDIDOVENDA = ?", str(numero))
+            colunas = [(coluna[0], coluna[1]) for coluna in cursor.description]
+            linhas = cursor.fetchall()
+        finally:
+            cursor.close()
+    return colunas, linhas
+
+def _get_executor_dts():
+    """Threads que executam as consultas ao DTS fora da thread do Streamlit."""
+    return _recurso_compartilhado(
+        'executor_dts', lambda: ThreadPoolExecutor(max_workers=DTS_POOL_TAMANHO, thread_name_prefix='dts-app')
+    )
+
+async def consultar_pedido_dts_async(numero, timeout=None):
+    """
+    Versão para asyncio de consultar_pedido_dts: a consulta roda nas threads do DTS
+    e o event loop fica livre. Com 'timeout', levanta asyncio.TimeoutError se passar do tempo.
+    """
+    loop = asyncio.get_running_loop()
+    futuro = loop.run_in_executor(_get_executor_dts(), consultar_pedido_dts, numero, get_dts_pool())
+    return await asyncio.wait_for(futuro, timeout)
+
+# Banco SQLite local: as conexões ficam abertas e são reaproveitadas por todo o processo (em vez
+# de uma conexão nova por consulta), em modo WAL e com os pragmas abaixo. Cada thread usa a sua
+# com exclusividade; quando a thread termina (o Streamlit usa uma thread por execução da página),
+# a conexão volta para as livres e é entregue à próxima thread, já configurada.
+DB_LOCAL = 'garantia.db'
+# Quantidade de comandos preparados mantidos em cache por conexão
+SQLITE_CACHE_COMANDOS = int(os.environ.get('SQLITE_CACHE_COMANDOS', 512))
+# Cache de páginas (KiB) e área mapeada em memória (bytes) de cada conexão
+SQLITE_CACHE_KB = int(os.environ.get('SQLITE_CACHE_KB', 64 * 1024))
+SQLITE_MMAP_BYTES = int(os.environ.get('SQLITE_MMAP_BYTES', 256 * 1024 * 1024))
+# Tempo máximo (s) esperando outra conexão liberar o banco para escrita
+SQLITE_TIMEOUT = float(os.environ.get('SQLITE_TIMEOUT', 30))
+# Conexões livres mantidas abertas por banco; as que passarem disso são fechadas ao serem devolvidas
+SQLITE_CONEXOES_LIVRES = int(os.environ.get('SQLITE_CONEXOES_LIVRES', 8))
+
+_conexoes_sqlite = threading.local()
+_conexoes_sqlite_livres = {}  # (caminho absoluto, row_factory) -> [conexões sem thread]
+_conexoes_sqlite_lock = threading.Lock()
+
+class PersistentSQLiteConnection(InstrumentedSQLiteConnection):
+    """
+    Conexão SQLite (instrumentada) reaproveitada pelo processo. close() não faz nada: a conexão
+    é compartilhada entre chamadas e um close() no meio de uma unidade de trabalho
+    (db_manager.transacao) não pode desfazê-la. Dentro de uma unidade de trabalho, o bloco
+    'with conn' também não faz commit nem rollback; quem decide é a transação externa.
+    """
+    # Nível de aninhamento de db_manager.transacao() na conexão
+    profundidade_transacao = 0
+
+    def close(self):
+        pass
+
+    def __exit__(self, *args):
+        if self.profundidade_transacao:
+            return False
+        return super().__exit__(*args)
+
+    def fechar(self):
+        super().close()
+
+class _ConexoesDaThread:
+    """Conexões SQLite em uso por uma thread; ao fim da thread são devolvidas às livres."""
+    def __init__(self):
+        self.conexoes = {}
+        weakref.finalize(self, _devolver_conexoes_sqlite, self.conexoes)
+
+def _devolver_conexoes_sqlite(conexoes):
+    for chave, conn in conexoes.items():
+        try:
+            # Transação deixada aberta por uma thread que terminou com erro
+            conn.profundidade_transacao = 0
+            if conn.in_transaction:
+                conn.rollback()
+        except Exception:
+            conn.fechar()
+            continue
+        with _conexoes_sqlite_lock:
+            livres = _conexoes_sqlite_livres.setdefault(chave, [])
+            if len(livres) < SQLITE_CONEXOES_LIVRES:
+                livres.append(conn)
+                continue
+        conn.fechar()
+    conexoes.clear()
+
+def _abrir_conexao_sqlite(caminho, row_factory):
+    # check_same_thread=False: a conexão passa de uma thread para outra, mas nunca é usada
+    # por duas ao mesmo tempo
+    conn = sqlite3.connect(
+        caminho, factory=PersistentSQLiteConnection, timeout=SQLITE_TIMEOUT,
+        cached_statements=SQLITE_CACHE_COMANDOS, check_same_thread=False
+    )
+    conn.row_factory = row_factory
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB}")
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_BYTES}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+def get_sqlite_connection(caminho=DB_LOCAL, row_factory=None):
+    """
+    Retorna a conexão persistente da thread atual com o banco SQLite 'caminho' (uma por
+    row_factory), reaproveitando uma conexão livre do processo quando houver. Uma conexão nova
+    é aberta e configurada: WAL (leitores não bloqueiam a escrita), synchronous=NORMAL, cache
+    de páginas, mmap e tabelas temporárias em memória. Use com 'with' para commit/rollback automático.
+    """
+    da_thread = getattr(_conexoes_sqlite, 'da_thread', None)
+    if da_thread is None:
+        da_thread = _conexoes_sqlite.da_thread = _ConexoesDaThread()
+    chave = (os.path.abspath(caminho), row_factory)
+    conn = da_thread.conexoes.get(chave)
+    if conn is None:
+        with _conexoes_sqlite_lock:
+            livres = _conexoes_sqlite_livres.get(chave)
+            conn = livres.pop() if livres else None
+        if conn is None:
+            conn = _abrir_conexao_sqlite(caminho, row_factory)
+        da_thread.conexoes[chave] = conn
+    return conn
+
+def fechar_conexoes_sqlite():
+    """
+    Fecha as conexões SQLite persistentes da thread atual e as livres do processo
+    (ex.: ao fim de um script, fazendo o checkpoint do WAL).
+    """
+    da_thread = getattr(_conexoes_sqlite, 'da_thread', None)
+    conexoes = list(da_thread.conexoes.values()) if da_thread is not None else []
+    if da_thread is not None:
+        da_thread.conexoes.clear()
+    with _conexoes_sqlite_lock:
+        for livres in _conexoes_sqlite_livres.values():
+            conexoes.extend(livres)
+        _conexoes_sqlite_livres.clear()
+    for conn in conexoes:
+        conn.fechar()
 
 # Função para testar as conexões ao iniciar o app
 def test_connections():
     print("Testando conexão com PROTHEUS (interno)...")
-    protheus_conn = get_protheus_connection()
-    if protheus_conn:
-        # Não precisa fechar aqui, o cache_resource gerencia
-        pass
+    try:
+        with get_protheus_connection() as protheus_conn:
+            cursor = protheus_conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+        print("Conexão com PROTHEUS (interno) bem-sucedida!")
+    except Exception as e:
+        print(f"Erro ao conectar ao PROTHEUS (interno): {e}")
     
     print("\nTestando conexão com DTS (externo)...")
-    dts_conn = get_dts_connection()
-    if dts_conn:
-        # Não precisa fechar aqui, o cache_resource gerencia
-        pass
+    try:
+        with get_dts_connection() as dts_conn:
+            cursor = dts_conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+        print("Conexão com DTS (externo) bem-sucedida!")
+    except Exception as e:
+        print(f"Erro ao conectar ao DTS (externo): {e}")
 
 
 
@@ -5,6 +5,10 @@ import streamlit as st
 
 # Detecta ambiente do Streamlit Cloud (você pode adicionar essa verificação)
 import os
+import time
+import json
+import threading
+from contextlib import contextmanager
 is_streamlit_cloud = os.environ.get('IS_STREAMLIT_CLOUD', False)
 
 if not is_streamlit_cloud:
@@ -16,73 +20,94 @@ if not is_streamlit_cloud:
         # Classe simulada ou alternativa
         class PyodbcMock:
             # Implementar métodos necessários que simulam pyodbc
-            pass
+            # 'except pyodbc.Error' continua válido sem o pyodbc (ex.: reprodução de consultas gravadas)
+            Error = Exception
         pyodbc = PyodbcMock()
 
-from database import get_protheus_connection # Importa a função de conexão com Protheus
+from database import get_protheus_connection, get_executor_protheus, submeter, consultar_protheus_em_lotes, FalhaConexao, interromper_sem_protheus # Pool e threads do Protheus
+from database import get_sqlite_connection # Conexão persistente com o SQLite local
+from migracoes import migrar_banco # Estrutura do banco local
 
 DB_LOCAL = 'garantia.db'
 
+# Profundidade máxima da explosão da estrutura (BOM) dos equipamentos
+BOM_NIVEL_MAXIMO = int(os.environ.get('BOM_NIVEL_MAXIMO', 3))
+# Validade (em horas) da BOM guardada no cache local 'componentes_produtos'
+BOM_CACHE_TTL_HORAS = float(os.environ.get('BOM_CACHE_TTL_HORAS', 24))
+# Validade (em segundos) do estoque de cada SKU no cache em memória de get_estoque_componentes
+ESTOQUE_CACHE_TTL_SEGUNDOS = float(os.environ.get('ESTOQUE_CACHE_TTL_SEGUNDOS', 120))
+
+# Cache de estoque compartilhado por todas as sessões: SKU -> (instante da consulta, linhas por armazém)
+_cache_estoque = {}
+_cache_estoque_lock = threading.Lock()
+_colunas_estoque = None
+
+# Validade (em horas) das tabelas locais de fornecedor principal e último pedido de compra
+LOOKUP_ESTOQUE_TTL_HORAS = float(os.environ.get('LOOKUP_ESTOQUE_TTL_HORAS', 12))
+_lookups_proxima_verificacao = 0.0
+_lookups_em_atualizacao = False
+_lookups_carregados = False
+
 # --- Funções para interagir com o banco de dados local (SQLite) ---
 def get_db_connection():
-    """Retorna uma conexão com o banco de dados SQLite local."""
-    conn = sqlite3.connect(DB_LOCAL)
-    conn.row_factory = sqlite3.Row # Permite acessar colunas por nome
-    return conn
+    """
+    Retorna a conexão persistente da thread com o banco de dados SQLite local (WAL, pragmas
+    ajustados e consultas instrumentadas pelo query_monitor). Use sempre com 'with'.
+    """
+    return get_sqlite_connection(DB_LOCAL, row_factory=sqlite3.Row) # Permite acessar colunas por nome
+
+@contextmanager
+def transacao():
+    """
+    Unidade de trabalho no SQLite local: as alterações feitas dentro do bloco (inclusive o
+    registro no histórico) são gravadas num único commit ao final, ou todas desfeitas se
+    ocorrer uma exceção. Chamadas aninhadas participam da transação externa (com um SAVEPOINT,
+    para que uma exceção tratada por quem chamou desfaça só a parte interna).
+    
+        with transacao() as conn:
+            conn.execute(...)
+            log_historico(...)
+    """
+    conn = get_db_connection()
+    profundidade = conn.profundidade_transacao
+    if profundidade:
+        savepoint = f"transacao_{profundidade}"
+        conn.execute(f"SAVEPOINT {savepoint}")
+        conn.profundidade_transacao = profundidade + 1
+        try:
+            yield conn
+        except BaseException:
+            conn.execute(f"ROLLBACK TO {savepoint}")
+            conn.execute(f"RELEASE {savepoint}")
+            raise
+        else:
+            conn.execute(f"RELEASE {savepoint}")
+        finally:
+            conn.profundidade_transacao = profundidade
+        return
+    
+    # Reserva a escrita já no início, evitando que a transação falhe ao passar de leitura para escrita
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    conn.profundidade_transacao = 1
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+    finally:
+        conn.profundidade_transacao = 0
 
 def log_historico(solicitacao_id, usuario, acao, detalhes=""):
-    """Registra uma ação no histórico da solicitação."""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
+    """Registra uma ação no histórico da solicitação (na transação em andamento, se houver)."""
+    with transacao() as conn:
         timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        cursor.execute(
+        conn.execute(
             "INSERT INTO historico (solicitacao_id, timestamp, usuario, acao, detalhes) VALUES (?, ?, ?, ?, ?)",
             (solicitacao_id, timestamp, usuario, acao, detalhes)
         )
-        conn.commit()
-
-def setup_centros_custo_gestores():
-    """
-    Cria a tabela de centros de custo e seus gestores responsáveis.
-    """
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Verificar se a tabela já existe
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='centros_custo'")
-        if not cursor.fetchone():
-            cursor.execute("""
-            CREATE TABLE centros_custo (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                codigo TEXT NOT NULL,
-                setor TEXT NOT NULL,
-                gestor TEXT NOT NULL,
-                gestor_email TEXT
-            )
-            """)
-            
-            # Inserir os centros de custo iniciais
-            cursor.executemany(
-                "INSERT INTO centros_custo (codigo, setor, gestor, gestor_email) VALUES (?, ?, ?, ?)",
-                [
-                    ('040023', 'Garantia', 'gestor.garantia', 'gestor.garantia@empresa.com'),
-                    ('040031', 'Assistência', 'gestor.assistencia', 'gestor.assistencia@empresa.com'),
-                    ('040024', 'Instalações', 'gestor.instalacoes', 'gestor.instalacoes@empresa.com'),
-                ]
-            )
-            
-            conn.commit()
-            print("Tabela de centros de custo criada e populada com sucesso.")
-        
-        # Adicionar coluna centro_custo à tabela solicitacoes, se não existir
-        cursor.execute("PRAGMA table_info(solicitacoes)")
-        colunas = [info[1] for info in cursor.fetchall()]
-        
-        if 'centro_custo' not in colunas:
-            cursor.execute("ALTER TABLE solicitacoes ADD COLUMN centro_custo TEXT")
-            cursor.execute("ALTER TABLE solicitacoes ADD COLUMN setor TEXT")
-            conn.commit()
-            print("Colunas 'centro_custo' e 'setor' adicionadas à tabela 'solicitacoes'")
 
 def get_centros_custo():
     """Retorna todos os centros de custo disponíveis."""
@@ -313,7 +338,7 @@ def confirmar_retirada_itens_solicitacao(solicitacao_id, user_confirming):
     Confirma a retirada dos itens pelo solicitante e atualiza o status
     da solicitação com base na quantidade retirada vs. solicitada.
     """
-    with get_db_connection() as conn:
+    with transacao() as conn:
         cursor = conn.cursor()
         
         # 1. Obter o status atual
@@ -352,125 +377,160 @@ def confirmar_retirada_itens_solicitacao(solicitacao_id, user_confirming):
         else:
             log_historico(solicitacao_id, user_confirming, f"Retirada de itens confirmada. Status permaneceu: {novo_status}")
         
-        conn.commit()
         return True  # Retorna True para indicar sucesso
     
-def adicionar_campo_observacoes():
+def init_database():
     """
-    Adiciona o campo 'observacoes' à tabela itens_solicitacao, se ainda não existir.
+    Inicializa o banco de dados, aplicando as migrações pendentes (migracoes.py).
+    Esta função deve ser chamada ao iniciar o aplicativo; com o schema já atualizado,
+    faz apenas a leitura da versão do banco.
     """
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Verificar se a coluna já existe
-        cursor.execute("PRAGMA table_info(itens_solicitacao)")
-        colunas = [info[1] for info in cursor.fetchall()]
-        
-        if 'observacoes' not in colunas:
-            try:
-                cursor.execute("ALTER TABLE itens_solicitacao ADD COLUMN observacoes TEXT")
-                conn.commit()
-                print("Coluna 'observacoes' adicionada com sucesso à tabela 'itens_solicitacao'")
-            except Exception as e:
-                print(f"Erro ao adicionar coluna 'observacoes': {str(e)}")
-        else:
-            print("Coluna 'observacoes' já existe na tabela 'itens_solicitacao'")
-    
-def init_database():
+    migrar_banco(DB_LOCAL)
+
+# Funções que leem uma tabela inteira por definição: função -> (detalhes do EXPLAIN QUERY PLAN
+# aceitos em verificar_planos_consultas, motivo). Qualquer outra varredura é apontada como falha.
+PLANOS_ACEITOS = {
+    'get_centros_custo': (
+        {'SCAN centros_custo USING INDEX idx_centros_custo_setor'},
+        "lista todos os centros de custo, já na ordem do índice por setor",
+    ),
+    'get_clientes_pedidos_equipamentos': (
+        {'SCAN pedidos_info USING COVERING INDEX idx_pedidos_info_dropdown'},
+        "opções dos filtros da solicitação com todos os pedidos, lidas só do índice e na ordem dele",
+    ),
+    '_ler_lookups_estoque': (
+        {
+            'SCAN p',
+            'SCAN fornecedor_principal USING COVERING INDEX sqlite_autoindex_fornecedor_principal_1',
+            'SCAN ultimo_pedido_compra USING COVERING INDEX sqlite_autoindex_ultimo_pedido_compra_1',
+        },
+        "sem lista de produtos, devolve os lookups de todos os produtos (carga do estoque completo)",
+    ),
+    'get_all_solicitacoes': (
+        {'SCAN solicitacoes USING INDEX idx_solicitacoes_data_criacao'},
+        "histórico geral com todas as solicitações, na ordem do índice por data de criação",
+    ),
+    'get_all_historico': (
+        {'SCAN historico'},
+        "exportação do histórico completo; um índice por timestamp pesaria em toda gravação de histórico",
+    ),
+    'get_all_itens_solicitacao': (
+        {'SCAN i'},
+        "relatório consolidado de todas as peças, ordenado por colunas das duas tabelas",
+    ),
+    'get_etl_runs': (
+        {'SCAN etl_runs'},
+        "lê as últimas execuções pelo rowid, em ordem decrescente, e para no LIMIT",
+    ),
+}
+
+# Funções com SQL no banco local que verificar_planos_consultas não executa: função -> motivo
+PLANOS_NAO_VERIFICADOS = {
+    'aquecer_cache_bom': "consulta o Protheus para cada equipamento sem cache; lê todos os SKUs de pedidos_info por definição",
+    'atualizar_lookups_estoque': "recarrega as tabelas de lookup inteiras a partir do Protheus",
+    'verificar_e_reconfigurar_centros_custo': "diagnóstico de linha de comando que lista a tabela inteira",
+    'diagnostico_centros_custo': "diagnóstico que lista a tabela inteira",
+    'verificar_usuarios_gestores': "diagnóstico que lista a tabela inteira",
+}
+
+class _VerificacaoConcluida(Exception):
+    """Desfaz a transação de verificar_planos_consultas."""
+
+def verificar_planos_consultas():
     """
-    Inicializa o banco de dados, criando as tabelas necessárias se não existirem.
-    Esta função deve ser chamada ao iniciar o aplicativo.
+    Executa as funções de db_manager que acessam o SQLite local (inclusive as que gravam,
+    numa transação desfeita ao final) e analisa o EXPLAIN QUERY PLAN de cada comando.
+    Retorna a lista de (função, sql, detalhe do plano) dos que percorrem uma tabela ou um
+    índice inteiro (SCAN, inclusive SCAN ... USING INDEX), exceto os planos de PLANOS_ACEITOS;
+    lista vazia significa que todas usam índices.
+    As funções de PLANOS_NAO_VERIFICADOS ficam de fora.
     """
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Criar tabela solicitacoes
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS solicitacoes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            data_criacao TIMESTAMP NOT NULL,
-            solicitante TEXT NOT NULL,
-            cliente_id TEXT,
-            cliente_nome TEXT,
-            pedido_venda TEXT,
-            equipamento_sku TEXT,
-            equipamento_nome TEXT,
-            justificativa TEXT,
-            status_atual TEXT DEFAULT 'Pendente Aprovação',
-            data_ultimo_status TIMESTAMP,
-            aprovador TEXT,
-            data_aprovacao TIMESTAMP,
-            motivo_rejeicao TEXT,
-            liberador TEXT,
-            data_liberacao TIMESTAMP,
-            data_retirada TIMESTAMP,
-            data_devolucao TIMESTAMP,
-            data_devolucao_confirmada TIMESTAMP,
-            data_finalizacao TIMESTAMP,
-            centro_custo TEXT,
-            setor TEXT
-        )
-        """)
-        
-        # Criar tabela itens_solicitacao
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS itens_solicitacao (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            solicitacao_id INTEGER NOT NULL,
-            componente_sku TEXT NOT NULL,
-            componente_desc TEXT NOT NULL,
-            quantidade_solicitada INTEGER NOT NULL,
-            quantidade_liberada INTEGER DEFAULT 0,
-            quantidade_retirada INTEGER DEFAULT 0,
-            quantidade_devolvida INTEGER DEFAULT 0,
-            FOREIGN KEY (solicitacao_id) REFERENCES solicitacoes (id)
-        )
-        """)
-        
-        # Criar tabela histórico
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS historico (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            solicitacao_id INTEGER NOT NULL,
-            timestamp TIMESTAMP NOT NULL,
-            usuario TEXT NOT NULL,
-            acao TEXT NOT NULL,
-            detalhes TEXT,
-            FOREIGN KEY (solicitacao_id) REFERENCES solicitacoes (id)
-        )
-        """)
-        
-        # Criar tabela clientes_pedidos_equipamentos (se usado para histórico)
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS clientes_pedidos_equipamentos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            cliente_id TEXT NOT NULL,
-            cliente_nome TEXT NOT NULL,
-            pedido_venda TEXT NOT NULL,
-            equipamento_sku TEXT NOT NULL,
-            equipamento_nome TEXT NOT NULL
-        )
-        """)
-        
-        # Criar tabela componentes_produtos (para cache local do Protheus)
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS componentes_produtos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            produto_sku TEXT NOT NULL,
-            componente_sku TEXT NOT NULL,
-            componente_desc TEXT NOT NULL,
-            quantidade INTEGER NOT NULL
+    sku = 'VERIFICACAO-PLANOS'
+    df_bom = pd.DataFrame(
+        [(f'{sku}-C1', 'Componente', 1.0, 'PC', 1, sku)],
+        columns=['Componente', 'Descricao_Componente', 'Quantidade', 'Unidade_Medida', 'Nivel', 'Pai_Componente']
+    )
+    estado = {}
+    
+    def criar():
+        estado['id'] = criar_solicitacao(
+            'verificacao', None, '', '', '', sku, '', [{'sku': f'{sku}-C1', 'descricao': '', 'quantidade': 1}],
+            centro_custo='040023'
         )
-        """)
-        
-        # Configurar centros de custo e gestores
-        setup_centros_custo_gestores()
-
-        # Adicionar o campo observacoes se necessário
-        adicionar_campo_observacoes()
-        
-        conn.commit()
-        print("Banco de dados inicializado com sucesso.")
+        estado['item'] = int(get_itens_solicitacao(estado['id'])['id'].iloc[0])
+    
+    chamadas = [
+        ('criar_solicitacao', criar),
+        ('log_historico', lambda: log_historico(estado['id'], 'verificacao', 'Verificação')),
+        ('get_centros_custo', get_centros_custo),
+        ('get_gestor_by_centro_custo', lambda: get_gestor_by_centro_custo('040023')),
+        ('get_solicitacoes_pendentes_aprovacao_by_gestor', lambda: get_solicitacoes_pendentes_aprovacao_by_gestor('rafael.barboza')),
+        ('get_solicitacoes_pendentes_aprovacao_by_gestor', lambda: get_solicitacoes_pendentes_aprovacao_by_gestor('')),
+        ('get_solicitacoes_pendentes_aprovacao', get_solicitacoes_pendentes_aprovacao),
+        ('get_solicitacoes_aprovadas_pendentes_liberacao', get_solicitacoes_aprovadas_pendentes_liberacao),
+        ('get_solicitacoes_pendentes_retirada', get_solicitacoes_pendentes_retirada),
+        ('get_solicitacoes_pendentes_devolucao_almoxarifado', get_solicitacoes_pendentes_devolucao_almoxarifado),
+        ('get_solicitacoes_para_confirmar_retirada', get_solicitacoes_para_confirmar_retirada),
+        ('get_solicitacoes_para_confirmar_retirada', lambda: get_solicitacoes_para_confirmar_retirada('verificacao')),
+        ('get_solicitacao_by_id', lambda: get_solicitacao_by_id(estado['id'])),
+        ('get_itens_solicitacao', lambda: get_itens_solicitacao(estado['id'])),
+        ('get_itens_solicitacoes', lambda: get_itens_solicitacoes([estado['id'], 0])),
+        ('get_historico_solicitacao', lambda: get_historico_solicitacao(estado['id'])),
+        ('update_status_solicitacao', lambda: update_status_solicitacao(
+            estado['id'], 'Aprovada', 'verificacao', aprovador='verificacao')),
+        ('update_itens_solicitacao_liberacao', lambda: update_itens_solicitacao_liberacao(
+            estado['id'], [{'id': estado['item'], 'quantidade_liberada': 1}], 'verificacao')),
+        ('update_itens_solicitacao_retirada', lambda: update_itens_solicitacao_retirada(estado['id'], 'verificacao')),
+        ('confirmar_retirada', lambda: confirmar_retirada(
+            estado['id'], 'verificacao', [{'item_protheus': f'{sku}-C1', 'quantidade_retirada': 0}])),
+        ('confirmar_retirada_itens_solicitacao', lambda: confirmar_retirada_itens_solicitacao(estado['id'], 'verificacao')),
+        ('update_itens_solicitacao_devolucao', lambda: update_itens_solicitacao_devolucao(
+            estado['id'], [{'id': estado['item'], 'quantidade_devolvida': 0}], 'verificacao')),
+        ('confirm_itens_solicitacao_devolucao_almoxarifado', lambda: confirm_itens_solicitacao_devolucao_almoxarifado(
+            estado['id'], 'verificacao')),
+        ('_gravar_cache_bom', lambda: _gravar_cache_bom(sku, 1, df_bom)),
+        ('_ler_cache_bom', lambda: _ler_cache_bom(sku, 1)),
+        ('_lookups_estoque_vencidos', _lookups_estoque_vencidos),
+        ('_lookups_estoque_carregados', _lookups_estoque_carregados),
+        ('_ler_lookups_estoque', lambda: _ler_lookups_estoque([f'{sku}-C1'])),
+        ('_ler_lookups_estoque', _ler_lookups_estoque),
+        ('get_clientes_pedidos_equipamentos', get_clientes_pedidos_equipamentos),
+        ('get_all_solicitacoes', get_all_solicitacoes),
+        ('get_all_historico', get_all_historico),
+        ('get_all_itens_solicitacao', get_all_itens_solicitacao),
+        ('get_etl_runs', get_etl_runs),
+    ]
+    conn = get_db_connection()
+    executadas = []
+    funcao_atual = [None]
+    # O callback recebe cada comando com os parâmetros já substituídos
+    conn.set_trace_callback(lambda sql: executadas.append((funcao_atual[0], sql)))
+    try:
+        with transacao():
+            for nome, chamada in chamadas:
+                funcao_atual[0] = nome
+                chamada()
+            raise _VerificacaoConcluida()
+    except _VerificacaoConcluida:
+        pass
+    finally:
+        conn.set_trace_callback(None)
+    
+    varreduras = []
+    cursor = conn.cursor()
+    for nome, sql in dict.fromkeys(executadas):
+        if sql.lstrip().split(None, 1)[0].upper() not in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE'):
+            continue
+        aceitos = PLANOS_ACEITOS.get(nome, (set(), ''))[0]
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}")
+        for linha in cursor.fetchall():
+            detalhe = linha[3]
+            # O catálogo (sqlite_master) e listas de parâmetros (json_each) não têm índice
+            if 'sqlite_master' in detalhe or 'VIRTUAL TABLE' in detalhe or 'CONSTANT ROW' in detalhe:
+                continue
+            if detalhe.startswith('SCAN ') and detalhe not in aceitos:
+                varreduras.append((nome, ' '.join(sql.split()), detalhe))
+    return varreduras
 
 def get_clientes_pedidos_equipamentos():
     """
@@ -502,110 +562,219 @@ def get_clientes_pedidos_equipamentos():
         ])
 
 
-def get_componentes_by_sku_protheus(equipamento_sku):
+def _ler_cache_bom(equipamento_sku, nivel_maximo):
     """
-    Busca os componentes (BOM) de um equipamento específico no Protheus (tabela SG1010),
-    incluindo subcomponentes para itens que começam com E ou S.
-    
-    equipamento_sku: O SKU (código) do equipamento pai.
-    Retorna um DataFrame com os componentes, suas descrições, quantidades, níveis e relações.
+    Retorna a BOM do cache local se ela estiver dentro do prazo de validade
+    (BOM_CACHE_TTL_HORAS) e tiver sido gerada com a mesma profundidade.
+    Retorna None quando não há cache válido.
     """
-    conn_protheus = None
     try:
-        conn_protheus = get_protheus_connection()
-        if not conn_protheus:
-            st.error("Falha ao conectar ao Protheus para buscar componentes.")
-            return pd.DataFrame()
-        
-        # 1. Query para componentes de nível 1 (diretos do equipamento)
-        query_nivel1 = f"""
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT nivel_maximo, data_atualizacao FROM componentes_produtos_cache WHERE produto_sku = ?",
+                (equipamento_sku,)
+            )
+            controle = cursor.fetchone()
+            if not controle or controle[0] != int(nivel_maximo):
+                return None
+            
+            data_atualizacao = datetime.datetime.strptime(controle[1], '%Y-%m-%d %H:%M:%S')
+            if datetime.datetime.now() - data_atualizacao > datetime.timedelta(hours=BOM_CACHE_TTL_HORAS):
+                return None
+            
+            query = """
+            SELECT
+                componente_sku AS Componente,
+                componente_desc AS Descricao_Componente,
+                quantidade AS Quantidade,
+                unidade_medida AS Unidade_Medida,
+                nivel AS Nivel,
+                pai_componente AS Pai_Componente
+            FROM componentes_produtos
+            WHERE produto_sku = ?
+            ORDER BY ordem
+            """
+            return pd.read_sql_query(query, conn, params=(equipamento_sku,))
+    except Exception as e:
+        print(f"Aviso: Não foi possível ler o cache de BOM para {equipamento_sku}: {e}")
+        return None
+
+def _gravar_cache_bom(equipamento_sku, nivel_maximo, df_componentes):
+    """Substitui a BOM em cache de um equipamento e renova sua data de atualização."""
+    data_atualizacao = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    linhas = [
+        (
+            equipamento_sku, row.Componente, row.Descricao_Componente, float(row.Quantidade),
+            row.Unidade_Medida, int(row.Nivel), row.Pai_Componente, ordem
+        )
+        for ordem, row in enumerate(df_componentes.itertuples(index=False))
+    ]
+    with transacao() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM componentes_produtos WHERE produto_sku = ?", (equipamento_sku,))
+        cursor.executemany(
+            """
+            INSERT INTO componentes_produtos (
+                produto_sku, componente_sku, componente_desc, quantidade,
+                unidade_medida, nivel, pai_componente, ordem
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            linhas
+        )
+        cursor.execute(
+            """
+            INSERT OR REPLACE INTO componentes_produtos_cache (produto_sku, nivel_maximo, data_atualizacao)
+            VALUES (?, ?, ?)
+            """,
+            (equipamento_sku, int(nivel_maximo), data_atualizacao)
+        )
+
+def _gravar_cache_bom_seguro(equipamento_sku, nivel_maximo, df_componentes):
+    """_gravar_cache_bom que apenas avisa em caso de erro: a BOM lida continua sendo usada."""
+    try:
+        _gravar_cache_bom(equipamento_sku, nivel_maximo, df_componentes)
+    except Exception as e:
+        print(f"Aviso: Não foi possível gravar o cache de BOM para {equipamento_sku}: {e}")
+
+def _explodir_bom_protheus(conn_protheus, ancora, params_ancora, nivel_maximo):
+    """
+    Executa no Protheus a CTE recursiva da BOM a partir das linhas de 'ancora' (SELECT com as
+    colunas da CTE BOM) e retorna o DataFrame resultante. Erros de banco são propagados.
+    """
+    # Caminho_Pais acumula os subconjuntos ancestrais e Ordem reproduz a ordem de exibição
+    # anterior: todo o nível 1, depois os filhos de cada subconjunto seguidos dos seus netos.
+    # MAXRECURSION só aceita literal; acompanha nivel_maximo (limite do SQL Server: 32767)
+    # para que uma profundidade maior não estoure o padrão de 100 recursões.
+    max_recursao = min(max(int(nivel_maximo), 1), 32767)
+    query = f"""
+    WITH BOM (Componente, Descricao_Componente, Quantidade, Unidade_Medida, Nivel, Pai_Componente, Caminho_Pais, Ordem) AS (
+        {ancora}
+        UNION ALL
         SELECT
-            SG1.G1_COMP AS Componente,
-            SB1.B1_DESC AS Descricao_Componente,
-            SG1.G1_QUANT AS Quantidade,
-            SB1.B1_UM AS Unidade_Medida,
-            1 AS Nivel,
-            '{equipamento_sku}' AS Pai_Componente
+            SG1.G1_COMP,
+            SB1.B1_DESC,
+            SG1.G1_QUANT,
+            SB1.B1_UM,
+            BOM.Nivel + 1,
+            CAST(BOM.Componente AS VARCHAR(100)),
+            CAST(BOM.Caminho_Pais + '1|' + BOM.Componente + '|' AS VARCHAR(4000)),
+            CAST(BOM.Caminho_Pais + '1|' + BOM.Componente + '|0|' + SG1.G1_COMP AS VARCHAR(4000))
+        FROM
+            BOM
+        INNER JOIN
+            SG1010 SG1 ON SG1.G1_COD = BOM.Componente AND SG1.D_E_L_E_T_ = ''
+        INNER JOIN
+            SB1010 SB1 ON SG1.G1_COMP = SB1.B1_COD AND SB1.D_E_L_E_T_ = ''
+        WHERE
+            BOM.Nivel < ?
+            AND LEFT(BOM.Componente, 1) IN ('E', 'S')
+    )
+    SELECT
+        Componente,
+        Descricao_Componente,
+        Quantidade,
+        Unidade_Medida,
+        Nivel,
+        Pai_Componente
+    FROM
+        BOM
+    ORDER BY
+        Ordem
+    OPTION (MAXRECURSION {max_recursao})
+    """
+    return pd.read_sql_query(query, conn_protheus, params=list(params_ancora) + [int(nivel_maximo)])
+
+def _buscar_bom_protheus(conn_protheus, equipamento_sku, nivel_maximo):
+    """
+    Executa a explosão da BOM no Protheus e retorna o DataFrame resultante.
+    Erros de banco são propagados para o chamador.
+    """
+    ancora = """
+        SELECT
+            SG1.G1_COMP,
+            SB1.B1_DESC,
+            SG1.G1_QUANT,
+            SB1.B1_UM,
+            1,
+            CAST(? AS VARCHAR(100)),
+            CAST('' AS VARCHAR(4000)),
+            CAST('0|' + SG1.G1_COMP AS VARCHAR(4000))
         FROM
             SG1010 SG1
         INNER JOIN
             SB1010 SB1 ON SG1.G1_COMP = SB1.B1_COD AND SB1.D_E_L_E_T_ = ''
         WHERE
-            SG1.G1_COD = '{equipamento_sku}'
+            SG1.G1_COD = ?
             AND SG1.D_E_L_E_T_ = ''
-        ORDER BY
-            SG1.G1_COMP
-        """
+    """
+    return _explodir_bom_protheus(conn_protheus, ancora, [equipamento_sku, equipamento_sku], nivel_maximo)
+
+def _buscar_subniveis_bom_protheus(conn_protheus, subconjuntos, nivel_maximo):
+    """
+    Explode no Protheus os níveis 2 em diante a partir dos subconjuntos de nível 1 já lidos
+    (componentes E/S), sem consultar o nível 1 de novo. Caminho e ordem são os mesmos de
+    _buscar_bom_protheus, de modo que o nível 1 seguido deste resultado é a BOM completa.
+    """
+    marcadores = ', '.join('?' for _ in subconjuntos)
+    ancora = f"""
+        SELECT
+            SG1.G1_COMP,
+            SB1.B1_DESC,
+            SG1.G1_QUANT,
+            SB1.B1_UM,
+            2,
+            CAST(SG1.G1_COD AS VARCHAR(100)),
+            CAST('1|' + SG1.G1_COD + '|' AS VARCHAR(4000)),
+            CAST('1|' + SG1.G1_COD + '|0|' + SG1.G1_COMP AS VARCHAR(4000))
+        FROM
+            SG1010 SG1
+        INNER JOIN
+            SB1010 SB1 ON SG1.G1_COMP = SB1.B1_COD AND SB1.D_E_L_E_T_ = ''
+        WHERE
+            SG1.G1_COD IN ({marcadores})
+            AND SG1.D_E_L_E_T_ = ''
+    """
+    return _explodir_bom_protheus(conn_protheus, ancora, subconjuntos, nivel_maximo)
+
+def get_componentes_by_sku_protheus(equipamento_sku, nivel_maximo=None, usar_cache=True):
+    """
+    Busca os componentes (BOM) de um equipamento específico no Protheus (tabela SG1010),
+    incluindo subcomponentes para itens que começam com E ou S.
+    
+    A explosão de todos os níveis é feita no servidor com uma única CTE recursiva,
+    em vez de uma consulta por subconjunto. O resultado passa pelo cache local
+    'componentes_produtos': uma BOM ainda válida é servida do SQLite e uma BOM lida
+    do Protheus é gravada no cache antes de ser retornada.
+    
+    equipamento_sku: O SKU (código) do equipamento pai.
+    nivel_maximo: Profundidade máxima da explosão (padrão: BOM_NIVEL_MAXIMO).
+    usar_cache: Se False, ignora o cache e consulta sempre o Protheus (o cache é atualizado mesmo assim).
+    Retorna um DataFrame com os componentes, suas descrições, quantidades, níveis e relações.
+    """
+    if nivel_maximo is None:
+        nivel_maximo = BOM_NIVEL_MAXIMO
+    
+    if usar_cache:
+        df_cache = _ler_cache_bom(equipamento_sku, nivel_maximo)
+        if df_cache is not None:
+            return df_cache
+    
+    try:
+        with get_protheus_connection() as conn_protheus:
+            df_componentes = _buscar_bom_protheus(conn_protheus, equipamento_sku, nivel_maximo)
         
-        df_nivel1 = pd.read_sql_query(query_nivel1, conn_protheus)
+        # Grava no cache também as BOMs vazias, para não repetir a consulta até o fim do TTL
+        _gravar_cache_bom_seguro(equipamento_sku, nivel_maximo, df_componentes)
         
-        # Se não encontrou componentes de nível 1, retorna DataFrame vazio
-        if df_nivel1.empty:
+        # Se não encontrou componentes, retorna DataFrame vazio
+        if df_componentes.empty:
             return pd.DataFrame()
         
-        # Inicializa o DataFrame final com os componentes de nível 1
-        df_componentes = df_nivel1.copy()
-        
-        # 2. Para cada componente de nível 1 que começa com 'E' ou 'S', busca subcomponentes de nível 2
-        for idx, row in df_nivel1.iterrows():
-            componente = row['Componente']
-            if componente.startswith('E') or componente.startswith('S'):
-                query_nivel2 = f"""
-                SELECT
-                    SG1.G1_COMP AS Componente,
-                    SB1.B1_DESC AS Descricao_Componente,
-                    SG1.G1_QUANT AS Quantidade,
-                    SB1.B1_UM AS Unidade_Medida,
-                    2 AS Nivel,
-                    '{componente}' AS Pai_Componente
-                FROM
-                    SG1010 SG1
-                INNER JOIN
-                    SB1010 SB1 ON SG1.G1_COMP = SB1.B1_COD AND SB1.D_E_L_E_T_ = ''
-                WHERE
-                    SG1.G1_COD = '{componente}'
-                    AND SG1.D_E_L_E_T_ = ''
-                ORDER BY
-                    SG1.G1_COMP
-                """
-                
-                df_nivel2 = pd.read_sql_query(query_nivel2, conn_protheus)
-                
-                # Adiciona os componentes de nível 2 ao DataFrame final
-                if not df_nivel2.empty:
-                    df_componentes = pd.concat([df_componentes, df_nivel2], ignore_index=True)
-                    
-                    # 3. Para cada componente de nível 2 que começa com 'E' ou 'S', busca subcomponentes de nível 3
-                    for idx2, row2 in df_nivel2.iterrows():
-                        componente2 = row2['Componente']
-                        if componente2.startswith('E') or componente2.startswith('S'):
-                            query_nivel3 = f"""
-                            SELECT
-                                SG1.G1_COMP AS Componente,
-                                SB1.B1_DESC AS Descricao_Componente,
-                                SG1.G1_QUANT AS Quantidade,
-                                SB1.B1_UM AS Unidade_Medida,
-                                3 AS Nivel,
-                                '{componente2}' AS Pai_Componente
-                            FROM
-                                SG1010 SG1
-                            INNER JOIN
-                                SB1010 SB1 ON SG1.G1_COMP = SB1.B1_COD AND SB1.D_E_L_E_T_ = ''
-                            WHERE
-                                SG1.G1_COD = '{componente2}'
-                                AND SG1.D_E_L_E_T_ = ''
-                            ORDER BY
-                                SG1.G1_COMP
-                            """
-                            
-                            df_nivel3 = pd.read_sql_query(query_nivel3, conn_protheus)
-                            
-                            # Adiciona os componentes de nível 3 ao DataFrame final
-                            if not df_nivel3.empty:
-                                df_componentes = pd.concat([df_componentes, df_nivel3], ignore_index=True)
-        
         return df_componentes
     
+    except FalhaConexao as e:
+        interromper_sem_protheus(e)
     except pyodbc.Error as ex:
         sqlstate = ex.args[0]
         if sqlstate == '42S02':
@@ -618,97 +787,511 @@ def get_componentes_by_sku_protheus(equipamento_sku):
     except Exception as e:
         st.error(f"Erro inesperado ao buscar componentes no Protheus: {e}")
         return pd.DataFrame()
-    finally:
-        # A conexão do Protheus é gerenciada por st.cache_resource (em database.py), não precisa fechar aqui
-        pass
 
-def get_estoque_componentes(components_list=None):
+def aquecer_cache_bom(forcar=False, nivel_maximo=None):
+    """
+    Pré-carrega no cache local a BOM de todos os equipamentos ('SKU Protheus')
+    presentes em 'pedidos_info'. Por padrão só consulta o Protheus para SKUs sem
+    cache válido; com forcar=True recarrega todos.
+    
+    Returns:
+    --------
+    dict:
+        Contagem de SKUs atualizados, já válidos e com erro.
+    """
+    if nivel_maximo is None:
+        nivel_maximo = BOM_NIVEL_MAXIMO
+    init_database()
+    
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT DISTINCT "SKU Protheus" FROM pedidos_info
+            WHERE "SKU Protheus" IS NOT NULL AND "SKU Protheus" <> ''
+        """)
+        skus = [row[0] for row in cursor.fetchall()]
+    print(f"Aquecendo cache de BOM para {len(skus)} equipamentos...")
+    
+    resumo = {'atualizados': 0, 'validos': 0, 'erros': 0}
+    for i, sku in enumerate(skus, start=1):
+        if not forcar and _ler_cache_bom(sku, nivel_maximo) is not None:
+            resumo['validos'] += 1
+            continue
+        try:
+            # Uma conexão por equipamento: se ela cair, o pool abre outra para o próximo
+            with get_protheus_connection() as conn_protheus:
+                df_componentes = _buscar_bom_protheus(conn_protheus, sku, nivel_maximo)
+            _gravar_cache_bom(sku, nivel_maximo, df_componentes)
+            resumo['atualizados'] += 1
+        except Exception as e:
+            print(f"Erro ao carregar BOM do equipamento {sku}: {e}")
+            resumo['erros'] += 1
+        if i % 100 == 0:
+            print(f" -> {i}/{len(skus)} equipamentos verificados")
+    
+    print(f"Cache de BOM aquecido: {resumo['atualizados']} atualizados, "
+          f"{resumo['validos']} já válidos, {resumo['erros']} com erro.")
+    return resumo
+
+# Fornecedor principal e previsão do último pedido de compra por produto, lidos do Protheus.
+# '{filtro}' recebe a restrição opcional de produtos (vazio para todos).
+_QUERY_FORNECEDOR_PRINCIPAL = """
+SELECT
+    PROD_FORN.A5_PRODUTO AS produto,
+    FORN_PRINC.A2_NOME AS nome_fornecedor,
+    PROD_FORN.A5_NOMPROD AS descricao_produto_fornecedor
+FROM (
+    SELECT
+        A5_PRODUTO,
+        A5_FORNECE,
+        A5_LOJA,
+        A5_NOMPROD,
+        ROW_NUMBER() OVER (PARTITION BY A5_PRODUTO ORDER BY A5_FORNECE) AS rn
+    FROM
+        SA5010
+    WHERE
+        D_E_L_E_T_ = ' '{filtro}
+) PROD_FORN
+LEFT JOIN SA2010 FORN_PRINC ON PROD_FORN.A5_FORNECE = FORN_PRINC.A2_COD
+                           AND PROD_FORN.A5_LOJA = FORN_PRINC.A2_LOJA
+                           AND FORN_PRINC.D_E_L_E_T_ = ' '
+WHERE
+    PROD_FORN.rn = 1
+"""
+_QUERY_ULTIMO_PEDIDO_COMPRA = """
+SELECT
+    C7_PRODUTO AS produto,
+    C7_DATPRF AS previsao_entrega
+FROM (
+    SELECT
+        C7_PRODUTO,
+        C7_DATPRF,
+        ROW_NUMBER() OVER (PARTITION BY C7_PRODUTO ORDER BY C7_EMISSAO DESC, C7_NUM DESC) AS rn
+    FROM
+        SC7010
+    WHERE
+        D_E_L_E_T_ = ' '
+        AND C7_RESIDUO <> 'S'{filtro}
+) ULT_PED
+WHERE
+    ULT_PED.rn = 1
+"""
+
+def atualizar_lookups_estoque():
+    """
+    Recarrega do Protheus as tabelas locais 'fornecedor_principal' e 'ultimo_pedido_compra'
+    e registra a atualização em 'sync_estado'. Erros de banco são propagados.
+    """
+    inicio = time.time()
+    with get_protheus_connection() as conn_protheus:
+        df_fornecedores = pd.read_sql(_QUERY_FORNECEDOR_PRINCIPAL.format(filtro=""), conn_protheus)
+        df_ultimos_pedidos = pd.read_sql(_QUERY_ULTIMO_PEDIDO_COMPRA.format(filtro=""), conn_protheus)
+    
+    init_database()
+    agora = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM fornecedor_principal")
+        cursor.executemany(
+            "INSERT OR REPLACE INTO fornecedor_principal (produto, nome_fornecedor, descricao_produto_fornecedor) VALUES (?, ?, ?)",
+            [
+                (str(row.produto).rstrip(), row.nome_fornecedor, row.descricao_produto_fornecedor)
+                for row in df_fornecedores.itertuples(index=False)
+            ]
+        )
+        cursor.execute("DELETE FROM ultimo_pedido_compra")
+        cursor.executemany(
+            "INSERT OR REPLACE INTO ultimo_pedido_compra (produto, previsao_entrega) VALUES (?, ?)",
+            [(str(row.produto).rstrip(), row.previsao_entrega) for row in df_ultimos_pedidos.itertuples(index=False)]
+        )
+        for tabela in ('fornecedor_principal', 'ultimo_pedido_compra'):
+            cursor.execute(
+                """
+                INSERT OR REPLACE INTO sync_estado (tabela, modo, data_ultima_execucao)
+                VALUES (?, 'completo', ?)
+                """,
+                (tabela, agora)
+            )
+        conn.commit()
+    print(f"Lookups de estoque atualizados: {len(df_fornecedores)} fornecedores principais e "
+          f"{len(df_ultimos_pedidos)} últimos pedidos de compra em {time.time() - inicio:.1f}s.")
+
+def _lookups_estoque_vencidos():
+    """Indica se os lookups de estoque nunca foram carregados ou passaram de LOOKUP_ESTOQUE_TTL_HORAS."""
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT MIN(data_ultima_execucao), COUNT(*) FROM sync_estado WHERE tabela IN ('fornecedor_principal', 'ultimo_pedido_compra')"
+            )
+            data_atualizacao, quantidade = cursor.fetchone()
+    except sqlite3.Error:
+        return True
+    if quantidade < 2 or not data_atualizacao:
+        return True
+    atualizado_em = datetime.datetime.strptime(data_atualizacao, '%Y-%m-%d %H:%M:%S')
+    return datetime.datetime.now() - atualizado_em > datetime.timedelta(hours=LOOKUP_ESTOQUE_TTL_HORAS)
+
+def _lookups_estoque_carregados():
+    """Indica se os lookups de estoque já foram carregados ao menos uma vez neste banco."""
+    global _lookups_carregados
+    if _lookups_carregados:
+        return True
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT COUNT(*) FROM sync_estado WHERE tabela IN ('fornecedor_principal', 'ultimo_pedido_compra')"
+            )
+            _lookups_carregados = cursor.fetchone()[0] == 2
+    except sqlite3.Error:
+        return False
+    return _lookups_carregados
+
+def _consultar_lookups_protheus(produtos=None):
+    """
+    Lê do Protheus, na hora, o fornecedor principal e a previsão do último pedido de compra
+    dos produtos informados (ou de todos), no mesmo formato de _ler_lookups_estoque.
+    Usado enquanto as tabelas locais ainda não foram carregadas. Erros de banco são propagados.
+    """
+    if produtos is None:
+        with get_protheus_connection() as conn_protheus:
+            df_fornecedores = pd.read_sql(_QUERY_FORNECEDOR_PRINCIPAL.format(filtro=""), conn_protheus)
+            df_ultimos_pedidos = pd.read_sql(_QUERY_ULTIMO_PEDIDO_COMPRA.format(filtro=""), conn_protheus)
+    else:
+        produtos = list(produtos)
+        df_fornecedores = consultar_protheus_em_lotes(
+            _QUERY_FORNECEDOR_PRINCIPAL.format(filtro="\n        AND A5_PRODUTO IN ({marcadores})"), produtos
+        )
+        df_ultimos_pedidos = consultar_protheus_em_lotes(
+            _QUERY_ULTIMO_PEDIDO_COMPRA.format(filtro="\n        AND C7_PRODUTO IN ({marcadores})"), produtos
+        )
+    df_fornecedores = df_fornecedores.reindex(columns=['produto', 'nome_fornecedor', 'descricao_produto_fornecedor'])
+    df_ultimos_pedidos = df_ultimos_pedidos.reindex(columns=['produto', 'previsao_entrega'])
+    df_fornecedores['produto'] = df_fornecedores['produto'].astype(str).str.rstrip()
+    df_ultimos_pedidos['produto'] = df_ultimos_pedidos['produto'].astype(str).str.rstrip()
+    df_lookups = df_fornecedores.merge(df_ultimos_pedidos, on='produto', how='outer')
+    return df_lookups.rename(columns={
+        'nome_fornecedor': 'Nome_Fornecedor',
+        'descricao_produto_fornecedor': 'Descricao_Produto_Fornecedor',
+        'previsao_entrega': 'Previsao_Entrega_Ultimo_Pedido',
+    })
+
+def _agendar_atualizacao_lookups_estoque():
+    """
+    Dispara em segundo plano a atualização dos lookups de estoque quando vencidos, sem
+    bloquear a página. A verificação é feita no máximo uma vez por minuto.
+    """
+    global _lookups_proxima_verificacao, _lookups_em_atualizacao
+    agora = time.monotonic()
+    with _cache_estoque_lock:
+        if _lookups_em_atualizacao or agora < _lookups_proxima_verificacao:
+            return
+        _lookups_proxima_verificacao = agora + 60
+    if not _lookups_estoque_vencidos():
+        return
+    with _cache_estoque_lock:
+        if _lookups_em_atualizacao:
+            return
+        _lookups_em_atualizacao = True
+    
+    def atualizar():
+        global _lookups_em_atualizacao
+        try:
+            atualizar_lookups_estoque()
+        except Exception as e:
+            print(f"Aviso: Não foi possível atualizar os lookups de estoque: {e}")
+        finally:
+            _lookups_em_atualizacao = False
+    get_executor_protheus().submit(atualizar)
+
+def _ler_lookups_estoque(produtos=None):
+    """
+    Retorna um DataFrame com fornecedor principal e previsão do último pedido de compra
+    por produto (chave sem espaços), para os produtos informados ou para todos.
+    """
+    query = """
+        SELECT
+            p.produto,
+            f.nome_fornecedor AS Nome_Fornecedor,
+            f.descricao_produto_fornecedor AS Descricao_Produto_Fornecedor,
+            u.previsao_entrega AS Previsao_Entrega_Ultimo_Pedido
+        FROM ({produtos}) p
+        LEFT JOIN fornecedor_principal f ON f.produto = p.produto
+        LEFT JOIN ultimo_pedido_compra u ON u.produto = p.produto
     """
-    Busca informações de estoque dos componentes.
+    colunas = ['produto', 'Nome_Fornecedor', 'Descricao_Produto_Fornecedor', 'Previsao_Entrega_Ultimo_Pedido']
+    try:
+        with get_db_connection() as conn:
+            if produtos is None:
+                uniao = "SELECT produto FROM fornecedor_principal UNION SELECT produto FROM ultimo_pedido_compra"
+                return pd.read_sql_query(query.format(produtos=uniao), conn)
+            # A lista inteira vai num único parâmetro JSON, sem esbarrar nos limites de
+            # parâmetros e de SELECTs compostos do SQLite
+            valores = "SELECT value AS produto FROM json_each(?)"
+            produtos = json.dumps([str(produto) for produto in produtos])
+            return pd.read_sql_query(query.format(produtos=valores), conn, params=(produtos,))
+    except sqlite3.Error as e:
+        print(f"Aviso: Não foi possível ler os lookups de estoque: {e}")
+        return pd.DataFrame(columns=colunas)
+
+def _consultar_estoque_protheus(components_list=None):
+    """
+    Consulta o estoque (SB1010/SB2010) no Protheus e completa cada produto com o fornecedor
+    principal e a previsão do último pedido de compra das tabelas locais de lookup, que são
+    atualizadas à parte (atualizar_lookups_estoque). Erros de banco são propagados.
+    
+    Retorna uma linha por produto e armazém (coluna Armazem, vazia para produto sem saldo
+    em SB2010); os saldos por produto são somados a partir delas por _somar_armazens.
+    """
+    query = """
+    SELECT
+        B1.B1_COD AS Codigo,
+        B1.B1_DESC AS Descricao,
+        COALESCE(B2.B2_QATU, 0) AS Quantidade_Atual,
+        COALESCE(B2.B2_QEMP, 0) AS Quantidade_Empenhada,
+        COALESCE(B2.B2_RESERVA, 0) AS Quantidade_Reservada,
+        COALESCE(B2.B2_QATU, 0) - COALESCE(B2.B2_QEMP, 0) - COALESCE(B2.B2_RESERVA, 0) AS Saldo_Disponivel,
+        B2.B2_LOCAL AS Armazem
+    FROM
+        SB1010 B1
+        LEFT JOIN SB2010 B2 ON B1.B1_COD = B2.B2_COD
+                           AND B2.D_E_L_E_T_ = ' '
+    WHERE
+        B1.D_E_L_E_T_ = ' '"""
+    
+    if components_list and len(components_list) > 0:
+        # Lista de componentes como parâmetros, em blocos de tamanho fixo consultados em paralelo
+        df_estoque = consultar_protheus_em_lotes(query + " AND B1.B1_COD IN ({marcadores})", components_list)
+    else:
+        # A conexão é emprestada do pool só durante a consulta
+        with get_protheus_connection() as conn_protheus:
+            df_estoque = pd.read_sql(query, conn_protheus)
+    
+    _agendar_atualizacao_lookups_estoque()
+    produtos = df_estoque['Codigo'].astype(str).str.rstrip()
+    if _lookups_estoque_carregados():
+        df_lookups = _ler_lookups_estoque(produtos.unique() if components_list else None)
+    else:
+        # Banco novo: até a primeira carga dos lookups (já agendada) terminar, fornecedor e
+        # último pedido vêm direto do Protheus, só para os produtos consultados
+        df_lookups = _consultar_lookups_protheus(produtos.unique() if components_list else None)
+    df_estoque = df_estoque.assign(_produto=produtos).merge(
+        df_lookups.drop_duplicates('produto'), how='left', left_on='_produto', right_on='produto'
+    )
+    return df_estoque.drop(columns=['_produto', 'produto'])
+
+def invalidar_cache_estoque(skus=None):
+    """
+    Remove SKUs do cache de estoque (todos, se skus for None), forçando a próxima
+    consulta a ir ao Protheus. Chamado após a liberação de componentes.
+    """
+    with _cache_estoque_lock:
+        if skus is None:
+            _cache_estoque.clear()
+        else:
+            for sku in skus:
+                _cache_estoque.pop(str(sku).rstrip(), None)
+
+def _somar_armazens(df_armazens):
+    """
+    Soma por SKU as linhas por armazém de _consultar_estoque_protheus: uma linha por Codigo,
+    com a quantidade de armazéns em Quantidade_Armazens.
+    """
+    if 'Codigo' not in df_armazens.columns:
+        return df_armazens
+    quantidades = ['Quantidade_Atual', 'Quantidade_Empenhada', 'Quantidade_Reservada', 'Saldo_Disponivel']
+    demais = [coluna for coluna in df_armazens.columns if coluna not in quantidades + ['Codigo', 'Armazem']]
+    agregacoes = {coluna: (coluna, 'first') for coluna in demais[:1]}
+    agregacoes.update({coluna: (coluna, 'sum') for coluna in quantidades})
+    agregacoes['Quantidade_Armazens'] = ('Armazem', 'count')
+    agregacoes.update({coluna: (coluna, 'first') for coluna in demais[1:]})
+    return df_armazens.groupby('Codigo', sort=False, as_index=False).agg(**agregacoes)
+
+def get_estoque_componentes(components_list=None, usar_cache=True, por_armazem=False):
+    """
+    Busca informações de estoque dos componentes, com os saldos somados por SKU.
+    
+    Com uma lista de componentes, as linhas por armazém de cada SKU ficam num cache do processo
+    (compartilhado por todas as sessões) por ESTOQUE_CACHE_TTL_SEGUNDOS: só os SKUs ausentes
+    ou expirados são consultados no Protheus, numa única consulta, e os demais vêm da memória.
+    Os saldos somados e o detalhe por armazém saem das mesmas linhas em cache.
     Parameters:
     -----------
     components_list : list, optional
         Lista de códigos de componentes a serem consultados.
-        Se None, retorna informações de todos os componentes.
+        Se None, retorna informações de todos os componentes (sem cache).
+    usar_cache : bool
+        Se False, consulta todos os SKUs no Protheus (o cache é atualizado mesmo assim).
+    por_armazem : bool
+        Se True, retorna uma linha por SKU e armazém (coluna Armazem) em vez dos saldos somados.
     Returns:
     --------
     pandas.DataFrame
         DataFrame com informações de estoque dos componentes
     """
+    global _colunas_estoque
     try:
-        # Obtenha a conexão Protheus
-        conn_protheus = get_protheus_connection()
-        if not conn_protheus:
-            st.error("Falha ao conectar ao Protheus para buscar informações de estoque.")
-            return pd.DataFrame()
-            
-        query = """
-        SELECT
-            B1.B1_COD AS Codigo,
-            B1.B1_DESC AS Descricao,
-            COALESCE(B2.B2_QATU, 0) AS Quantidade_Atual,
-            COALESCE(B2.B2_QEMP, 0) AS Quantidade_Empenhada,
-            COALESCE(B2.B2_RESERVA, 0) AS Quantidade_Reservada,
-            COALESCE(B2.B2_QATU, 0) - COALESCE(B2.B2_QEMP, 0) - COALESCE(B2.B2_RESERVA, 0) AS Saldo_Disponivel,
-            B2.B2_LOCAL AS Armazem,
-            FORN_PRINC.A2_NOME AS Nome_Fornecedor,
-            PROD_FORN.A5_NOMPROD AS Descricao_Produto_Fornecedor,
-            ULT_PED.C7_DATPRF AS Previsao_Entrega_Ultimo_Pedido
-        FROM
-            SB1010 B1
-            LEFT JOIN SB2010 B2 ON B1.B1_COD = B2.B2_COD
-                               AND B2.D_E_L_E_T_ = ' '
-            LEFT JOIN (
-                SELECT
-                    A5_PRODUTO,
-                    A5_FORNECE,
-                    A5_LOJA,
-                    A5_CODPRF,
-                    A5_NOMPROD,
-                    ROW_NUMBER() OVER (PARTITION BY A5_PRODUTO ORDER BY A5_FORNECE) AS rn
-                FROM
-                    SA5010
-                WHERE
-                    D_E_L_E_T_ = ' '
-                GROUP BY
-                    A5_PRODUTO, A5_FORNECE, A5_LOJA, A5_CODPRF, A5_NOMPROD
-            ) PROD_FORN ON B1.B1_COD = PROD_FORN.A5_PRODUTO AND PROD_FORN.rn = 1
-            LEFT JOIN SA2010 FORN_PRINC ON PROD_FORN.A5_FORNECE = FORN_PRINC.A2_COD
-                                       AND PROD_FORN.A5_LOJA = FORN_PRINC.A2_LOJA
-                                       AND FORN_PRINC.D_E_L_E_T_ = ' '
-            LEFT JOIN (
-                SELECT
-                    C7_PRODUTO,
-                    C7_NUM,
-                    C7_EMISSAO,
-                    C7_DATPRF,
-                    ROW_NUMBER() OVER (PARTITION BY C7_PRODUTO ORDER BY C7_EMISSAO DESC, C7_NUM DESC) AS rn
-                FROM
-                    SC7010
-                WHERE
-                    D_E_L_E_T_ = ' '
-                    AND C7_RESIDUO <> 'S'
-            ) ULT_PED ON B1.B1_COD = ULT_PED.C7_PRODUTO AND ULT_PED.rn = 1
-        WHERE
-            B1.D_E_L_E_T_ = ' '
-        """
+        if not components_list:
+            df_armazens = _consultar_estoque_protheus()
+            return df_armazens if por_armazem else _somar_armazens(df_armazens)
         
-        # Se houver uma lista específica de componentes, filtra por eles
-        if components_list and len(components_list) > 0:
-            # Sanitiza os valores da lista para evitar SQL injection
-            components_str = "', '".join([comp.replace("'", "''") for comp in components_list])
-            query += f" AND B1.B1_COD IN ('{components_str}')"
-            
-        df_estoque = pd.read_sql(query, conn_protheus)
+        # O Protheus completa os códigos com espaços; a chave do cache ignora esse preenchimento
+        skus = list(dict.fromkeys(str(sku).rstrip() for sku in components_list))
+        agora = time.monotonic()
+        with _cache_estoque_lock:
+            faltantes = [
+                sku for sku in skus
+                if not usar_cache or sku not in _cache_estoque
+                or agora - _cache_estoque[sku][0] > ESTOQUE_CACHE_TTL_SEGUNDOS
+            ]
         
-        # O problema está aqui: a conexão não está sendo fechada corretamente
-        # Não fechar conexão que é gerenciada pelo st.cache_resource
+        if faltantes:
+            df_novo = _consultar_estoque_protheus(faltantes)
+            registros_por_sku = {sku: [] for sku in faltantes}
+            for registro in df_novo.to_dict('records'):
+                registros_por_sku.setdefault(str(registro['Codigo']).rstrip(), []).append(registro)
+            # SKUs sem linha no Protheus também entram no cache, para não serem consultados de novo
+            with _cache_estoque_lock:
+                _colunas_estoque = list(df_novo.columns)
+                for sku, registros in registros_por_sku.items():
+                    _cache_estoque[sku] = (agora, registros)
         
-        return df_estoque
+        with _cache_estoque_lock:
+            registros = [
+                registro for sku in skus if sku in _cache_estoque for registro in _cache_estoque[sku][1]
+            ]
+            colunas = _colunas_estoque
+        df_armazens = pd.DataFrame.from_records(registros, columns=colunas)
+        return df_armazens if por_armazem else _somar_armazens(df_armazens)
+    except FalhaConexao as e:
+        interromper_sem_protheus(e)
     except Exception as e:
         st.error(f"Erro ao obter estoque de componentes: {str(e)}")
         return pd.DataFrame()  # Retorna DataFrame vazio em caso de erro
 
+def indexar_estoque(df_estoque):
+    """
+    Converte o resultado de get_estoque_componentes num dicionário SKU -> dados de estoque,
+    com a chave sem os espaços de preenchimento do Protheus (use str(sku).rstrip() na busca).
+    
+    Com o resultado por armazém, os saldos de cada SKU são somados e a lista de armazéns
+    (Armazem, Quantidade_Atual, Quantidade_Empenhada, Quantidade_Reservada, Saldo_Disponivel)
+    fica em 'Armazens'.
+    """
+    if df_estoque is None or df_estoque.empty:
+        return {}
+    df = df_estoque.assign(Codigo=df_estoque['Codigo'].astype(str).str.rstrip())
+    # Valores ausentes (fornecedor, previsão) viram None em vez de NaN
+    df = df.astype(object).where(df.notna(), None)
+    if 'Armazem' not in df.columns:
+        return df.drop_duplicates('Codigo', keep='last').set_index('Codigo').to_dict('index')
+    
+    quantidades = ['Quantidade_Atual', 'Quantidade_Empenhada', 'Quantidade_Reservada', 'Saldo_Disponivel']
+    estoque = df.drop(columns=quantidades + ['Armazem']).drop_duplicates('Codigo').set_index('Codigo').to_dict('index')
+    df_armazens = df[df['Armazem'].notna()]
+    totais = df_armazens.groupby('Codigo')[quantidades].sum()
+    armazens = df_armazens.groupby('Codigo')[['Armazem'] + quantidades].apply(lambda grupo: grupo.to_dict('records'))
+    for sku, dados in estoque.items():
+        dados.update(totais.loc[sku].to_dict() if sku in totais.index else dict.fromkeys(quantidades, 0))
+        dados['Quantidade_Armazens'] = len(armazens.get(sku, []))
+        dados['Armazens'] = armazens.get(sku, [])
+    return estoque
+
+def _bom_nivel_1_protheus(equipamento_sku):
+    """Componentes diretos do equipamento (nível 1), lidos do Protheus sem passar pelo cache."""
+    with get_protheus_connection() as conn_protheus:
+        return _buscar_bom_protheus(conn_protheus, equipamento_sku, 1)
+
+def _buscar_subniveis_bom(equipamento_sku, df_nivel_1, nivel_maximo):
+    """Níveis 2 em diante da BOM (vazio se não houver subconjuntos no nível 1 ou profundidade)."""
+    subconjuntos = [
+        componente for componente in df_nivel_1['Componente'].unique()
+        if str(componente)[:1] in ('E', 'S')
+    ]
+    if int(nivel_maximo) < 2 or not subconjuntos:
+        return pd.DataFrame(columns=df_nivel_1.columns)
+    with get_protheus_connection() as conn_protheus:
+        return _buscar_subniveis_bom_protheus(conn_protheus, subconjuntos, nivel_maximo)
+
+def buscar_componentes_e_estoque(equipamento_sku, nivel_maximo=None):
+    """
+    Carrega a BOM do equipamento e o estoque dos componentes com as consultas ao Protheus
+    sobrepostas, nas threads do pool. Gerador que produz (df_componentes, df_estoque, completo):
+    
+    - com a BOM em cache, produz uma única vez o resultado completo;
+    - senão, o nível 1 é lido primeiro e produzido de imediato (completo=False, sem estoque).
+      Em seguida o estoque desses componentes e os subníveis (a partir dos subconjuntos do
+      nível 1 já lido, sem consultá-lo de novo) são buscados em paralelo; se o estoque chegar
+      antes dos subníveis, o nível 1 é produzido novamente com ele. Ao fim, só o estoque dos
+      componentes que faltavam é consultado, a BOM completa é gravada no cache e o resultado
+      completo é produzido.
+    """
+    if nivel_maximo is None:
+        nivel_maximo = BOM_NIVEL_MAXIMO
+    executor = get_executor_protheus()
+    
+    df_cache = _ler_cache_bom(equipamento_sku, nivel_maximo)
+    if df_cache is not None:
+        componentes = df_cache['Componente'].tolist() if not df_cache.empty else []
+        df_estoque = get_estoque_componentes(componentes) if componentes else pd.DataFrame()
+        yield df_cache, df_estoque, True
+        return
+    
+    try:
+        df_nivel_1 = _bom_nivel_1_protheus(equipamento_sku)
+    except Exception as e:
+        # Sem o nível 1 não há o que antecipar: segue pela leitura completa, que trata os erros
+        print(f"Aviso: Não foi possível antecipar o nível 1 da BOM de {equipamento_sku}: {e}")
+        df_componentes = get_componentes_by_sku_protheus(equipamento_sku, nivel_maximo, False)
+        componentes = df_componentes['Componente'].tolist() if not df_componentes.empty else []
+        yield df_componentes, get_estoque_componentes(componentes) if componentes else pd.DataFrame(), True
+        return
+    if df_nivel_1.empty:
+        _gravar_cache_bom_seguro(equipamento_sku, nivel_maximo, df_nivel_1)
+        yield pd.DataFrame(), pd.DataFrame(), True
+        return
+    
+    componentes_nivel_1 = df_nivel_1['Componente'].tolist()
+    futuro_estoque_1 = submeter(executor, get_estoque_componentes, componentes_nivel_1)
+    futuro_subniveis = submeter(executor, _buscar_subniveis_bom, equipamento_sku, df_nivel_1, nivel_maximo)
+    if not futuro_subniveis.done():
+        yield df_nivel_1, pd.DataFrame(), False
+    
+    try:
+        df_estoque_1 = futuro_estoque_1.result()
+    except FalhaConexao:
+        # A falha já foi mostrada na página pela thread que consultou o estoque
+        st.stop()
+        raise
+    if not futuro_subniveis.done():
+        yield df_nivel_1, df_estoque_1, False
+    
+    try:
+        df_subniveis = futuro_subniveis.result()
+    except Exception as e:
+        print(f"Aviso: Não foi possível carregar os subníveis da BOM de {equipamento_sku}: {e}")
+        df_componentes = get_componentes_by_sku_protheus(equipamento_sku, nivel_maximo, False)
+    else:
+        df_componentes = df_nivel_1
+        if not df_subniveis.empty:
+            df_componentes = pd.concat([df_nivel_1, df_subniveis], ignore_index=True)
+        _gravar_cache_bom_seguro(equipamento_sku, nivel_maximo, df_componentes)
+    if df_componentes.empty:
+        yield df_componentes, pd.DataFrame(), True
+        return
+    
+    estoques = [df_estoque_1]
+    consultados = set(componentes_nivel_1)
+    componentes_restantes = [
+        componente for componente in df_componentes['Componente'].unique() if componente not in consultados
+    ]
+    if componentes_restantes:
+        estoques.append(get_estoque_componentes(componentes_restantes))
+    estoques = [df for df in estoques if not df.empty]
+    df_estoque = pd.concat(estoques, ignore_index=True) if estoques else pd.DataFrame()
+    yield df_componentes, df_estoque, True
+
 def criar_solicitacao(solicitante, solicitante_email, cliente_cnpj, cliente_nome, pedido_venda,
                       equipamento_sku, equipamento_nome, itens_solicitados, centro_custo=None, setor=None,
                       email_sender_module=None, app_base_url=None):
@@ -748,7 +1331,8 @@ def criar_solicitacao(solicitante, solicitante_email, cliente_cnpj, cliente_nome
     int
         ID da solicitação criada.
     """
-    with get_db_connection() as conn:
+    # Solicitação, itens e registro de criação no histórico num único commit
+    with transacao() as conn:
         cursor = conn.cursor()
         data_criacao = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         status_inicial = 'Pendente Aprovação'
@@ -782,6 +1366,7 @@ def criar_solicitacao(solicitante, solicitante_email, cliente_cnpj, cliente_nome
         )
         solicitacao_id = cursor.lastrowid
         
+        linhas_itens = []
         for item in itens_solicitados:
             # Verifica informações de estoque do item
             tem_estoque = item.get('tem_estoque', True) # Default para True se não estiver presente
@@ -792,16 +1377,17 @@ def criar_solicitacao(solicitante, solicitante_email, cliente_cnpj, cliente_nome
             if not tem_estoque:
                 observacoes = f"Produto sem estoque suficiente. Saldo disponível: {saldo_disponivel}"
             
-            cursor.execute(
-                """
-                INSERT INTO itens_solicitacao (
-                    solicitacao_id, componente_sku, componente_desc, quantidade_solicitada, observacoes
-                ) VALUES (?, ?, ?, ?, ?)
-                """,
-                (solicitacao_id, item['sku'], item['descricao'], item['quantidade'], observacoes)
-            )
+            linhas_itens.append((solicitacao_id, item['sku'], item['descricao'], item['quantidade'], observacoes))
         
-        conn.commit()
+        # Todos os itens num único lote, com o comando preparado uma só vez
+        cursor.executemany(
+            """
+            INSERT INTO itens_solicitacao (
+                solicitacao_id, componente_sku, componente_desc, quantidade_solicitada, observacoes
+            ) VALUES (?, ?, ?, ?, ?)
+            """,
+            linhas_itens
+        )
         
         # Adiciona log com informação sobre itens sem estoque
         log_msg = f"Status inicial: {status_inicial}"
@@ -809,67 +1395,68 @@ def criar_solicitacao(solicitante, solicitante_email, cliente_cnpj, cliente_nome
             log_msg += ". ATENÇÃO: Solicitação contém itens sem estoque suficiente."
         
         log_historico(solicitacao_id, solicitante, 'Solicitação Criada', log_msg)
-        
-        # Preparar dados para o e-mail, se os módulos necessários foram fornecidos
-        if email_sender_module is not None and app_base_url is not None:
-            try:
-                # Preparar informações para o e-mail
-                solicitacao_info = {
-                    'id': solicitacao_id,
-                    'data_criacao': data_criacao,
-                    'solicitante': solicitante,
-                    'solicitante_email': solicitante_email,
-                    'cliente_cnpj': cliente_cnpj,
-                    'cliente_nome': cliente_nome,
-                    'pedido_venda': pedido_venda,
-                    'equipamento_sku': equipamento_sku,
-                    'equipamento_nome': equipamento_nome,
-                    'centro_custo': centro_custo,
-                    'setor': setor
-                }
-                
-                # Enviar e-mail para o gestor correspondente
-                email_sent = email_sender_module.send_email_to_gestor(
+    
+    # O e-mail é enviado fora da transação, para não manter o banco bloqueado durante o envio
+    # Preparar dados para o e-mail, se os módulos necessários foram fornecidos
+    if email_sender_module is not None and app_base_url is not None:
+        try:
+            # Preparar informações para o e-mail
+            solicitacao_info = {
+                'id': solicitacao_id,
+                'data_criacao': data_criacao,
+                'solicitante': solicitante,
+                'solicitante_email': solicitante_email,
+                'cliente_cnpj': cliente_cnpj,
+                'cliente_nome': cliente_nome,
+                'pedido_venda': pedido_venda,
+                'equipamento_sku': equipamento_sku,
+                'equipamento_nome': equipamento_nome,
+                'centro_custo': centro_custo,
+                'setor': setor
+            }
+            
+            # Enviar e-mail para o gestor correspondente
+            email_sent = email_sender_module.send_email_to_gestor(
+                solicitacao_id,
+                solicitacao_info,
+                itens_solicitados,
+                app_base_url
+            )
+            
+            if not email_sent:
+                # Registra o problema no log, mas não interrompe o processo
+                log_historico(
                     solicitacao_id,
-                    solicitacao_info,
-                    itens_solicitados,
-                    app_base_url
+                    solicitante,
+                    'Aviso',
+                    "Não foi possível enviar e-mail de notificação ao gestor responsável."
                 )
-                
-                if not email_sent:
-                    # Registra o problema no log, mas não interrompe o processo
-                    log_historico(
-                        solicitacao_id,
-                        solicitante,
-                        'Aviso',
-                        "Não foi possível enviar e-mail de notificação ao gestor responsável."
-                    )
-                else:
-                    log_historico(
-                        solicitacao_id,
-                        solicitante,
-                        'Notificação',
-                        f"E-mail enviado ao gestor responsável pelo centro de custo {centro_custo}."
-                    )
-            except Exception as e:
-                # Registra a exceção no log
+            else:
                 log_historico(
                     solicitacao_id,
                     solicitante,
-                    'Erro',
-                    f"Erro ao tentar enviar e-mail para o gestor: {str(e)}"
+                    'Notificação',
+                    f"E-mail enviado ao gestor responsável pelo centro de custo {centro_custo}."
                 )
-        elif centro_custo:
-            # Se temos centro de custo mas não podemos enviar e-mail, registramos isso
+        except Exception as e:
+            # Registra a exceção no log
             log_historico(
                 solicitacao_id,
                 solicitante,
-                'Aviso',
-                "Módulo de e-mail não fornecido. Não foi possível notificar o gestor responsável."
+                'Erro',
+                f"Erro ao tentar enviar e-mail para o gestor: {str(e)}"
             )
-        
-        # Retorna o ID da solicitação criada
-        return solicitacao_id
+    elif centro_custo:
+        # Se temos centro de custo mas não podemos enviar e-mail, registramos isso
+        log_historico(
+            solicitacao_id,
+            solicitante,
+            'Aviso',
+            "Módulo de e-mail não fornecido. Não foi possível notificar o gestor responsável."
+        )
+    
+    # Retorna o ID da solicitação criada
+    return solicitacao_id
 
 
 def get_solicitacoes_pendentes_aprovacao():
@@ -917,6 +1504,42 @@ def get_itens_solicitacao(solicitacao_id):
         query = "SELECT * FROM itens_solicitacao WHERE solicitacao_id = ?"
         return pd.read_sql_query(query, conn, params=(solicitacao_id,))
 
+def get_itens_solicitacoes(solicitacao_ids):
+    """Retorna, numa única consulta, os itens de várias solicitações (coluna solicitacao_id identifica cada uma)."""
+    solicitacao_ids = [int(solicitacao_id) for solicitacao_id in solicitacao_ids]
+    partes = []
+    with get_db_connection() as conn:
+        # Em blocos, respeitando o limite de parâmetros do SQLite
+        for i in range(0, len(solicitacao_ids), 500):
+            bloco = solicitacao_ids[i:i + 500]
+            marcadores = ", ".join("?" for _ in bloco)
+            query = f"SELECT * FROM itens_solicitacao WHERE solicitacao_id IN ({marcadores}) ORDER BY solicitacao_id, id"
+            partes.append(pd.read_sql_query(query, conn, params=bloco))
+        if not partes:
+            return pd.read_sql_query("SELECT * FROM itens_solicitacao WHERE 0", conn)
+    return pd.concat(partes, ignore_index=True)
+
+def carregar_fila_aprovacao(solicitacoes):
+    """
+    Carrega os dados da fila de aprovação de uma só vez: os itens de todas as solicitações
+    numa consulta ao SQLite e o estoque de todos os SKUs distintos numa consulta ao Protheus.
+    
+    Retorna (itens_por_solicitacao, df_estoque): um dicionário id -> DataFrame de itens
+    (vazio para solicitações sem itens) e o estoque de todos os componentes da fila.
+    """
+    ids = [int(solicitacao_id) for solicitacao_id in solicitacoes['id']] if not solicitacoes.empty else []
+    if not ids:
+        return {}, pd.DataFrame()
+    itens = get_itens_solicitacoes(ids)
+    itens_por_solicitacao = {solicitacao_id: grupo.reset_index(drop=True) for solicitacao_id, grupo in itens.groupby('solicitacao_id')}
+    vazio = itens.iloc[0:0]
+    for solicitacao_id in ids:
+        itens_por_solicitacao.setdefault(solicitacao_id, vazio)
+    
+    skus = [sku for sku in itens['componente_sku'].dropna().unique().tolist() if sku]
+    df_estoque = get_estoque_componentes(skus) if skus else pd.DataFrame()
+    return itens_por_solicitacao, df_estoque
+
 def get_historico_solicitacao(solicitacao_id):
     """Retorna o histórico de uma solicitação específica."""
     with get_db_connection() as conn:
@@ -956,8 +1579,10 @@ def confirmar_retirada(solicitacao_id, user_confirming, itens_retirados_info):
     Confirma a retirada de itens de uma solicitação, atualiza o status
     e registra no histórico.
     Verifica se o user_confirming é o solicitante da solicitação.
+    As quantidades, o status e o histórico são gravados num único commit; se alguma
+    validação falhar, nada é alterado.
     """
-    with get_db_connection() as conn:
+    with transacao() as conn:
         cursor = conn.cursor()
 
         # 1. Obter informações da solicitação e verificar autoria
@@ -989,6 +1614,8 @@ def confirmar_retirada(solicitacao_id, user_confirming, itens_retirados_info):
         for item_db in itens_db:
             total_itens_solicitados += item_db[2] # quantidade_solicitada
 
+        # As quantidades só são gravadas depois que todos os itens forem validados
+        atualizacoes = []
         for item_info in itens_retirados_info:
             item_protheus = item_info['item_protheus'] # Usamos 'item_protheus' do input, que mapeia para 'componente_sku'
             quantidade_retirada_agora = item_info['quantidade_retirada']
@@ -1002,17 +1629,15 @@ def confirmar_retirada(solicitacao_id, user_confirming, itens_retirados_info):
                     st.error(f"Erro: Quantidade retirada para o item '{item_protheus}' excede a quantidade solicitada ({item_db['solicitada']}).")
                     return False
 
-                # Atualiza a quantidade retirada no banco de dados
-                cursor.execute(
-                    "UPDATE itens_solicitacao SET quantidade_retirada = ? WHERE id = ?",
-                    (nova_quantidade_retirada, item_db['id'])
-                )
+                atualizacoes.append((nova_quantidade_retirada, item_db['id']))
                 # Atualiza o total de itens retirados para verificar o status da solicitação
                 # Subtraímos a quantidade que já estava retirada e adicionamos a nova total
                 total_itens_retirados_apos_confirmacao += nova_quantidade_retirada
             else:
                 st.warning(f"Item '{item_protheus}' não encontrado na solicitação {solicitacao_id}. Ignorando.")
 
+        # Atualiza as quantidades retiradas no banco de dados, num único lote
+        cursor.executemany("UPDATE itens_solicitacao SET quantidade_retirada = ? WHERE id = ?", atualizacoes)
 
         # 3. Atualizar status da solicitação
         novo_status = ""
@@ -1039,20 +1664,19 @@ def confirmar_retirada(solicitacao_id, user_confirming, itens_retirados_info):
         else:
              log_historico(solicitacao_id, user_confirming, f"Retirada de itens confirmada. Status permaneceu: {novo_status}")
 
-
-        conn.commit()
         return True # Retorna True para indicar sucesso
 
 def update_status_solicitacao(solicitacao_id, novo_status, usuario, detalhes_historico="", **kwargs):
     """
     Atualiza o status de uma solicitação e registra no histórico.
     kwargs pode incluir aprovador, data_aprovacao, motivo_rejeicao, etc.
+    A alteração e o registro no histórico são gravados no mesmo commit.
     """
-    with get_db_connection() as conn:
+    with transacao() as conn:
         cursor = conn.cursor()
         data_atual = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        set_clauses = [f"status_atual = '{novo_status}'", f"data_ultimo_status = '{data_atual}'"]
-        params = []
+        set_clauses = ["status_atual = ?", "data_ultimo_status = ?"]
+        params = [novo_status, data_atual]
         for key, value in kwargs.items():
             if value is not None: # Apenas adiciona se o valor não for None
                 set_clauses.append(f"{key} = ?")
@@ -1062,31 +1686,29 @@ def update_status_solicitacao(solicitacao_id, novo_status, usuario, detalhes_his
         query = f"UPDATE solicitacoes SET {', '.join(set_clauses)} WHERE id = ?"
         params.append(solicitacao_id)
         cursor.execute(query, tuple(params))
-        conn.commit()
         log_historico(solicitacao_id, usuario, f"Status alterado para: {novo_status}", detalhes_historico)
 
 def update_itens_solicitacao_liberacao(solicitacao_id, itens_liberados, usuario):
     """Atualiza as quantidades liberadas para os itens de uma solicitação."""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        for item in itens_liberados:
-            cursor.execute(
-                """
-                UPDATE itens_solicitacao
-                SET quantidade_liberada = ?
-                WHERE id = ? AND solicitacao_id = ?
-                """,
-                (item['quantidade_liberada'], item['id'], solicitacao_id)
-            )
-        conn.commit()
+    with transacao() as conn:
+        conn.executemany(
+            """
+            UPDATE itens_solicitacao
+            SET quantidade_liberada = ?
+            WHERE id = ? AND solicitacao_id = ?
+            """,
+            [(item['quantidade_liberada'], item['id'], solicitacao_id) for item in itens_liberados]
+        )
         log_historico(solicitacao_id, usuario, "Itens Liberados", "Quantidades liberadas pelo almoxarifado atualizadas.")
+    # O estoque desses componentes muda com a separação; a próxima consulta vai ao Protheus
+    invalidar_cache_estoque([item['componente_sku'] for item in itens_liberados if 'componente_sku' in item])
 
 def update_itens_solicitacao_retirada(solicitacao_id, usuario):
     """
     Atualiza as quantidades retiradas para os itens de uma solicitação,
     assumindo que a quantidade retirada é igual à quantidade liberada.
     """
-    with get_db_connection() as conn:
+    with transacao() as conn:
         cursor = conn.cursor()
         cursor.execute(
             """
@@ -1096,7 +1718,6 @@ def update_itens_solicitacao_retirada(solicitacao_id, usuario):
             """,
             (solicitacao_id,)
         )
-        conn.commit()
         log_historico(solicitacao_id, usuario, "Itens Retirados", "Quantidades retiradas confirmadas pelo solicitante.")
 
 def update_itens_solicitacao_devolucao(solicitacao_id, itens_devolvidos, usuario):
@@ -1104,18 +1725,15 @@ def update_itens_solicitacao_devolucao(solicitacao_id, itens_devolvidos, usuario
     Atualiza as quantidades devolvidas para os itens de uma solicitação.
     Este é o registro inicial da devolução pelo solicitante.
     """
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        for item in itens_devolvidos:
-            cursor.execute(
-                """
-                UPDATE itens_solicitacao
-                SET quantidade_devolvida = ?
-                WHERE id = ? AND solicitacao_id = ?
-                """,
-                (item['quantidade_devolvida'], item['id'], solicitacao_id)
-            )
-        conn.commit()
+    with transacao() as conn:
+        conn.executemany(
+            """
+            UPDATE itens_solicitacao
+            SET quantidade_devolvida = ?
+            WHERE id = ? AND solicitacao_id = ?
+            """,
+            [(item['quantidade_devolvida'], item['id'], solicitacao_id) for item in itens_devolvidos]
+        )
         log_historico(solicitacao_id, usuario, "Devolução Solicitada", "Solicitante registrou componentes para devolução.")
 
 def confirm_itens_solicitacao_devolucao_almoxarifado(solicitacao_id, usuario):
@@ -1124,11 +1742,9 @@ def confirm_itens_solicitacao_devolucao_almoxarifado(solicitacao_id, usuario):
     Neste ponto, a quantidade devolvida já foi registrada pelo solicitante,
     o almoxarifado apenas confirma o processo.
     """
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        # Não há atualização de quantidade aqui, apenas a confirmação do processo
-        # A quantidade_devolvida já foi setada pelo solicitante
-        conn.commit() # Apenas commit para garantir que o log seja salvo
+    # Não há atualização de quantidade aqui, apenas a confirmação do processo
+    # A quantidade_devolvida já foi setada pelo solicitante
+    with transacao():
         log_historico(solicitacao_id, usuario, "Devolução Confirmada (Almoxarifado)", "Almoxarifado confirmou o recebimento dos componentes devolvidos.")
 
 def get_all_solicitacoes():
@@ -1180,11 +1796,32 @@ def get_all_itens_solicitacao():
         """
         return pd.read_sql_query(query, conn)
 
+def get_etl_runs(limite=30):
+    """
+    Retorna as últimas execuções do ETL de pedidos (tabela 'etl_runs'), da mais recente
+    para a mais antiga. Retorna um DataFrame vazio se o ETL ainda não foi executado.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='etl_runs'")
+        if not cursor.fetchone():
+            return pd.DataFrame()
+        query = "SELECT * FROM etl_runs ORDER BY id DESC LIMIT ?"
+        return pd.read_sql_query(query, conn, params=(limite,))
+
 # Teste de conexão com o DB local (opcional, para depuração)
 if __name__ == '__main__':
     # Garante que o DB local e as tabelas estejam criadas/atualizadas
-    from gerar_base_pedidos import inicializar_e_migrar_db
-    inicializar_e_migrar_db()
+    init_database()
+    
+    # python db_manager.py --verificar-indices: falha se alguma consulta fizer varredura completa
+    import sys
+    if '--verificar-indices' in sys.argv:
+        varreduras = verificar_planos_consultas()
+        for funcao, sql, detalhe in varreduras:
+            print(f"VARREDURA COMPLETA em {funcao} ({detalhe}): {sql}")
+        print("Todas as consultas usam índices." if not varreduras else f"{len(varreduras)} consulta(s) sem índice.")
+        sys.exit(1 if varreduras else 0)
     print("Testando get_clientes_pedidos_equipamentos...")
     df_info = get_clientes_pedidos_equipamentos()
     if not df_info.empty:
@@ -1,9 +1,12 @@
 import os
+import math
 import pandas as pd
 import time
-import sqlite3
 from decimal import Decimal
 import datetime # Importado para usar datas
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # Detecta ambiente do Streamlit Cloud ou outros ambientes
 is_streamlit_cloud = os.environ.get('IS_STREAMLIT_CLOUD', False)
@@ -33,154 +36,313 @@ if not is_streamlit_cloud:
     except ImportError:
         print("pyodbc não está disponível. Algumas funcionalidades de conexão ao banco de dados externo estarão limitadas.")
 
+# O acesso ao DTS (pool, timeout por consulta e a procedure de pedidos) é o mesmo do app
+from database import PROTHEUS_CONNECTION_STRING, criar_pool_dts, consultar_pedido_dts, get_sqlite_connection, fechar_conexoes_sqlite
+from query_monitor import instrumentar
+from query_replay import preparar_conexao, modo_reproducao
+from migracoes import migrar_banco, INDICES_PEDIDOS_INFO, criar_indices_pedidos_info, nome_sql
+
 DB_LOCAL = 'garantia.db'
 
+# Quantidade de conexões DTS executando a procedure de pedidos em paralelo
+DTS_WORKERS = int(os.environ.get('DTS_WORKERS', 1))
+
+# No modo incremental, pedidos emitidos nestes últimos dias (a partir da última
+# sincronização) são reprocessados para capturar alterações em pedidos recentes.
+# O SC5010 não tem uma coluna de data de alteração confiável (S_T_A_M_P_ depende da
+# configuração do DBAccess): alterações em pedidos emitidos antes da janela só entram
+# na base na próxima carga completa.
+INCREMENTAL_JANELA_DIAS = int(os.environ.get('INCREMENTAL_JANELA_DIAS', 7))
+
+# Tabela intermediária onde o ETL grava as linhas retornadas pelo DTS, em lotes
+TABELA_STAGING = 'pedidos_info_staging'
+# Na carga completa, a nova geração é montada em TABELA_NOVA e trocada por 'pedidos_info'
+# numa única transação; a geração substituída fica guardada em TABELA_ANTERIOR
+TABELA_NOVA = 'pedidos_info_nova'
+TABELA_ANTERIOR = 'pedidos_info_anterior'
+ETL_LOTE_REGISTROS = int(os.environ.get('ETL_LOTE_REGISTROS', 5000))
+# Fração máxima de pedidos com erro para que a carga completa ainda substitua 'pedidos_info'
+ETL_LIMITE_FALHAS = float(os.environ.get('ETL_LIMITE_FALHAS', 0.05))
+
 def inicializar_e_migrar_db():
     """
-    Garante que o banco de dados SQLite e todas as tabelas necessárias existam.
-    Também aplica migrações, como adicionar novas colunas a tabelas existentes,
-    para manter o schema compatível com a aplicação.
+    Garante que o banco de dados SQLite e todas as tabelas necessárias existam, aplicando
+    as migrações pendentes (migracoes.py). Com o schema já atualizado, só lê a versão.
+    """
+    migrar_banco(DB_LOCAL)
+
+def _executar_procedure_pedido(pool_dts, numero):
+    """
+    Executa a procedure de informações do pedido usando uma conexão do pool DTS.
+    Uma conexão com falha de comunicação é descartada pelo pool, que abre uma nova
+    para o próximo pedido; erros nunca se propagam para os demais workers.
+    Retorna (numero, colunas, linhas, erro, duracao_em_segundos), em que 'colunas' é a
+    lista de (nome, tipo Python) obtida de cursor.description.
+    """
+    inicio = time.perf_counter()
+    try:
+        columns, rows = consultar_pedido_dts(numero, pool_dts)
+        return numero, columns, rows, None, time.perf_counter() - inicio
+    except Exception as e:
+        return numero, None, None, e, time.perf_counter() - inicio
+
+def processar_pedidos_dts(numeros, workers, pool_dts=None):
     """
-    print("Verificando e inicializando a estrutura do banco de dados local...")
+    Executa a procedure XSP_0044_DTS_PedidosVendasInfo para cada pedido usando até
+    'workers' conexões DTS simultâneas.
     
-    # Primeiro, vamos verificar se o banco já existe e fazer backup se necessário
-    if os.path.exists(DB_LOCAL):
-        # Verificar se há dados nas tabelas principais antes de prosseguir
-        try:
-            with sqlite3.connect(DB_LOCAL) as conn_check:
-                cursor = conn_check.cursor()
-                # Verificar tabela de solicitações
-                cursor.execute("SELECT COUNT(*) FROM solicitacoes")
-                count_solicitacoes = cursor.fetchone()[0]
-                # Verificar tabela de histórico
-                cursor.execute("SELECT COUNT(*) FROM historico")
-                count_historico = cursor.fetchone()[0]
-                
-                print(f"Banco de dados existente contém {count_solicitacoes} solicitações e {count_historico} registros de histórico.")
-                
-                # Se houver dados, fazer backup
-                if count_solicitacoes > 0 or count_historico > 0:
-                    import shutil
-                    backup_file = f"{DB_LOCAL}.backup_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
-                    shutil.copy2(DB_LOCAL, backup_file)
-                    print(f"Backup do banco de dados criado: {backup_file}")
-        except Exception as e:
-            print(f"Aviso: Não foi possível verificar dados existentes: {e}")
+    Os resultados são produzidos na mesma ordem de 'numeros', como tuplas
+    (numero, colunas, linhas, erro, duracao), e no máximo 'workers * 4' pedidos ficam em
+    andamento ao mesmo tempo. Sem 'pool_dts', um pool próprio é criado e fechado ao final.
+    """
+    pool_proprio = pool_dts is None
+    if pool_proprio:
+        pool_dts = criar_pool_dts(workers)
     
-    with sqlite3.connect(DB_LOCAL) as conn:
-        cursor = conn.cursor()
-        # 1. Garante que todas as tabelas do sistema existam
-        print(" -> Criando tabelas, se não existirem...")
-        # Tabela principal de solicitações
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS solicitacoes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                data_criacao TEXT,
-                solicitante TEXT,
-                solicitante_email TEXT,
-                cliente_cnpj TEXT,
-                cliente_nome TEXT,
-                pedido_venda TEXT,
-                equipamento_sku TEXT,
-                equipamento_nome TEXT,
-                status_atual TEXT, -- Novo: 'Pendente Aprovação', 'Aprovada', 'Rejeitada', 'Disponível para Retirada', 'Não Disponível', 'Retirada Confirmada', 'Devolução Pendente Almoxarifado', 'Devolução Concluída', 'Finalizada'
-                data_ultimo_status TEXT,
-                aprovador TEXT, -- Novo: Usuário que aprovou/rejeitou
-                data_aprovacao TEXT, -- Novo: Data da aprovação/rejeição
-                motivo_rejeicao TEXT, -- Novo: Motivo se a solicitação foi rejeitada
-                almoxarife_liberacao TEXT, -- Novo: Usuário do almoxarifado que liberou
-                data_liberacao TEXT, -- Novo: Data da liberação pelo almoxarifado
-                motivo_nao_disponivel TEXT, -- Novo: Motivo se o almoxarifado não pôde separar
-                retirado_por TEXT,
-                data_retirada TEXT, -- Novo: Data da confirmação de retirada pelo solicitante
-                data_devolucao_solicitada TEXT, -- Novo: Data em que o solicitante registrou a devolução
-                data_devolucao_confirmada TEXT, -- Novo: Data em que o almoxarifado confirmou a devolução
-                almoxarife_devolucao_confirmacao TEXT, -- Novo: Usuário do almoxarifado que confirmou a devolução
-                data_finalizacao TEXT -- Novo: Data de finalização do processo
-            )
-        ''')
-        # Tabela com os itens de cada solicitação
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS itens_solicitacao (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                solicitacao_id INTEGER,
-                componente_sku TEXT,
-                componente_desc TEXT,
-                quantidade_solicitada INTEGER,
-                quantidade_liberada INTEGER DEFAULT 0, -- Novo: Quantidade separada pelo almoxarifado
-                quantidade_retirada INTEGER DEFAULT 0, -- Novo: Quantidade efetivamente retirada
-                quantidade_devolvida INTEGER DEFAULT 0, -- Quantidade devolvida pelo solicitante
-                observacoes TEXT,
-                FOREIGN KEY (solicitacao_id) REFERENCES solicitacoes (id)
-            )
-        ''')
-        # Tabela de histórico para auditoria completa
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS historico (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                solicitacao_id INTEGER,
-                timestamp TEXT,
-                usuario TEXT,
-                acao TEXT,
-                detalhes TEXT,
-                FOREIGN KEY (solicitacao_id) REFERENCES solicitacoes (id)
-            )
-        ''')
-        # 2. Lógica de Migração: Adiciona colunas se elas não existirem
-        print(" -> Verificando a necessidade de migrações na tabela 'solicitacoes'...")
-        cursor.execute("PRAGMA table_info(solicitacoes)")
-        colunas_existentes_solicitacoes = [info[1] for info in cursor.fetchall()]
-        novas_colunas_solicitacoes = [
-            ('solicitante_email', 'TEXT'), ('retirado_por', 'TEXT'),
-            ('status_aprovacao', 'TEXT'), ('aprovador', 'TEXT'), ('data_aprovacao', 'TEXT'),
-            ('motivo_rejeicao', 'TEXT'), ('almoxarife_liberacao', 'TEXT'), ('data_liberacao', 'TEXT'),
-            ('motivo_nao_disponivel', 'TEXT'), ('data_retirada', 'TEXT'),
-            ('data_devolucao_solicitada', 'TEXT'), ('data_devolucao_confirmada', 'TEXT'),
-            ('almoxarife_devolucao_confirmacao', 'TEXT'), ('data_finalizacao', 'TEXT')
-        ]
-        for col_name, col_type in novas_colunas_solicitacoes:
-            if col_name not in colunas_existentes_solicitacoes:
-                print(f" -> Adicionando coluna '{col_name}' na tabela 'solicitacoes'...")
-                cursor.execute(f"ALTER TABLE solicitacoes ADD COLUMN {col_name} {col_type};")
-        print(" -> Verificando a necessidade de migrações na tabela 'itens_solicitacao'...")
-        cursor.execute("PRAGMA table_info(itens_solicitacao)")
-        colunas_existentes_itens = [info[1] for info in cursor.fetchall()]
-        novas_colunas_itens = [
-            ('quantidade_liberada', 'INTEGER DEFAULT 0'),
-            ('quantidade_retirada', 'INTEGER DEFAULT 0'),
-            ('observacoes', 'TEXT')
-        ]
-        for col_name, col_type in novas_colunas_itens:
-            if col_name not in colunas_existentes_itens:
-                print(f" -> Adicionando coluna '{col_name}' na tabela 'itens_solicitacao'...")
-                cursor.execute(f"ALTER TABLE itens_solicitacao ADD COLUMN {col_name} {col_type};")
-        conn.commit()
-    # 3. Configuração da tabela de centros de custo e gestores
-    print(" -> Configurando tabela de centros de custo e gestores...")
+    limite_em_andamento = workers * 4
+    em_andamento = deque()
     try:
-        import db_manager  # Importamos aqui para usar a função
-        db_manager.setup_centros_custo_gestores()  # Chamada para configurar a tabela de centros de custo
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dts') as executor:
+            try:
+                for numero in numeros:
+                    em_andamento.append(executor.submit(_executar_procedure_pedido, pool_dts, numero))
+                    if len(em_andamento) >= limite_em_andamento:
+                        yield em_andamento.popleft().result()
+                while em_andamento:
+                    yield em_andamento.popleft().result()
+            finally:
+                # Interrupção antecipada: descarta os pedidos que ainda não começaram
+                for future in em_andamento:
+                    future.cancel()
+    finally:
+        if pool_proprio:
+            pool_dts.close_all()
+
+def _ler_estado_sincronizacao(conn_local):
+    """Retorna (ultimo_recno, ultima_emissao) da última sincronização de 'pedidos_info', ou None."""
+    cursor = conn_local.cursor()
+    cursor.execute("SELECT ultimo_recno, ultima_emissao FROM sync_estado WHERE tabela = 'pedidos_info'")
+    estado = cursor.fetchone()
+    if not estado or estado[0] is None:
+        return None
+    # O upsert depende da coluna C5_NUM, que tabelas geradas por versões anteriores não têm
+    cursor.execute("PRAGMA table_info(pedidos_info)")
+    if 'C5_NUM' not in [info[1] for info in cursor.fetchall()]:
+        return None
+    return estado[0], estado[1]
+
+def _calcular_marca_d_agua(df_pedidos, pedidos_com_erro, estado_anterior=None):
+    """
+    Calcula o novo (ultimo_recno, ultima_emissao) a partir dos pedidos extraídos e da
+    marca anterior (None na carga completa). A marca nunca recua por causa dos pedidos
+    trazidos apenas pela janela de emissão, cujo R_E_C_N_O_ já estava abaixo dela.
+    Um pedido com erro acima da marca anterior a segura logo antes dele, para que seja
+    reprocessado na próxima execução; um pedido com erro da janela de emissão continua
+    dentro dela, pois a emissão da marca não passa da sua.
+    """
+    if df_pedidos.empty:
+        return None
+    recno_anterior, emissao_anterior = estado_anterior or (None, None)
+    com_erro = df_pedidos['NumeroPedido'].isin(pedidos_com_erro)
+    df_sucesso, df_erros = df_pedidos[~com_erro], df_pedidos[com_erro]
+
+    recnos = [int(recno) for recno in df_sucesso['Recno']]
+    emissoes = [str(emissao) for emissao in df_sucesso['Emissao'].dropna()]
+    if recno_anterior is not None:
+        recnos.append(int(recno_anterior))
+        df_erros_novos = df_erros[df_erros['Recno'] > recno_anterior]
+    else:
+        df_erros_novos = df_erros
+    if emissao_anterior is not None:
+        emissoes.append(str(emissao_anterior))
+
+    ultimo_recno = max(recnos) if recnos else None
+    if not df_erros_novos.empty:
+        ultimo_recno = int(df_erros_novos['Recno'].min()) - 1
+    ultima_emissao = max(emissoes) if emissoes else None
+    emissoes_erros = [str(emissao) for emissao in df_erros['Emissao'].dropna()]
+    if emissoes_erros:
+        ultima_emissao = min(emissoes_erros + ([ultima_emissao] if ultima_emissao else []))
+    if ultimo_recno is None:
+        return None
+    return ultimo_recno, ultima_emissao
+
+def _gravar_estado_sincronizacao(conn_local, marca_d_agua, modo, pedidos_processados):
+    """Registra a marca d'água da sincronização bem-sucedida de 'pedidos_info'."""
+    data_execucao = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cursor = conn_local.cursor()
+    if marca_d_agua is None:
+        # Nada novo no Protheus: mantém a marca anterior e registra apenas a execução
+        cursor.execute(
+            "UPDATE sync_estado SET modo = ?, data_ultima_execucao = ?, pedidos_processados = 0 WHERE tabela = 'pedidos_info'",
+            (modo, data_execucao)
+        )
+    else:
+        cursor.execute(
+            """
+            INSERT OR REPLACE INTO sync_estado (tabela, ultimo_recno, ultima_emissao, modo, data_ultima_execucao, pedidos_processados)
+            VALUES ('pedidos_info', ?, ?, ?, ?, ?)
+            """,
+            (marca_d_agua[0], marca_d_agua[1], modo, data_execucao, pedidos_processados)
+        )
+    conn_local.commit()
+
+def _selecao_deduplicada(colunas_staging):
+    """
+    SELECT das linhas da staging sem duplicatas, para gravação em 'pedidos_info'.
+    A duplicidade considera só as colunas retornadas pela procedure, como o
+    drop_duplicates() da versão anterior: uma linha repetida em pedidos diferentes é
+    gravada uma única vez, atribuída ao menor C5_NUM que a gerou. C5_NUM (última coluna
+    da staging) permanece em 'pedidos_info' porque o upsert incremental remove as linhas
+    de cada pedido reprocessado por ele.
+    """
+    lista_dts = ', '.join(nome_sql(coluna) for coluna in colunas_staging[:-1])
+    return (
+        f"SELECT {lista_dts}, CAST(MIN(C5_NUM) AS TEXT) AS C5_NUM "
+        f"FROM {TABELA_STAGING} GROUP BY {lista_dts}"
+    )
+
+def _afinidade_sqlite(tipo):
+    """Tipo SQLite equivalente ao tipo Python informado pelo pyodbc em cursor.description."""
+    if tipo in (int, bool):
+        return 'INTEGER'
+    if tipo in (float, Decimal):
+        return 'REAL'
+    if tipo in (bytes, bytearray):
+        return 'BLOB'
+    return 'TEXT'
+
+def _normalizar_linhas(rows, indices_decimais, numero):
+    """
+    Converte as linhas da procedure para gravação no SQLite, acrescentando o número do pedido.
+    Só as colunas Decimal (resolvidas uma única vez a partir de cursor.description) são
+    convertidas para float; as demais passam sem inspeção valor a valor.
+    """
+    if not indices_decimais:
+        return [tuple(row) + (numero,) for row in rows]
+    linhas = []
+    for row in rows:
+        valores = list(row)
+        for indice in indices_decimais:
+            if valores[indice] is not None:
+                valores[indice] = float(valores[indice])
+        valores.append(numero)
+        linhas.append(valores)
+    return linhas
+
+def _criar_tabela_staging(conn_local, colunas):
+    """Cria a tabela de staging tipada a partir das colunas (nome, tipo) da procedure."""
+    definicao = ', '.join(f"{nome_sql(nome)} {_afinidade_sqlite(tipo)}" for nome, tipo in colunas)
+    conn_local.execute(f"CREATE TABLE {TABELA_STAGING} ({definicao})")
+    conn_local.commit()
+
+def _gravar_lote_staging(conn_local, colunas, lote, pedidos_concluidos, modo):
+    """
+    Grava um lote de linhas na tabela de staging e, na mesma transação, marca os
+    pedidos do lote como concluídos em 'etl_progresso' (checkpoint).
+    """
+    marcadores = ', '.join('?' for _ in colunas)
+    data_processamento = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    conn_local.executemany(f"INSERT INTO {TABELA_STAGING} VALUES ({marcadores})", lote)
+    conn_local.executemany(
+        "INSERT OR REPLACE INTO etl_progresso (C5_NUM, modo, data_processamento) VALUES (?, ?, ?)",
+        [(numero, modo, data_processamento) for numero in pedidos_concluidos]
+    )
+    conn_local.commit()
+
+def _ler_progresso(conn_local, modo):
+    """
+    Retorna (colunas_staging, pedidos_concluidos) de uma execução interrompida no mesmo
+    modo, ou (None, set()) se não houver o que retomar.
+    """
+    cursor = conn_local.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (TABELA_STAGING,))
+    if not cursor.fetchone():
+        return None, set()
+    cursor.execute("SELECT C5_NUM, modo FROM etl_progresso")
+    progresso = cursor.fetchall()
+    if not progresso or any(modo_anterior != modo for _, modo_anterior in progresso):
+        print("Nenhuma execução interrompida compatível encontrada. Iniciando do zero.")
+        return None, set()
+    cursor.execute(f"PRAGMA table_info({TABELA_STAGING})")
+    colunas = [info[1] for info in cursor.fetchall()]
+    return colunas, {numero for numero, _ in progresso}
+
+def _percentil(valores, percentual):
+    """Percentil pelo método do posto mais próximo; None se não houver valores."""
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    posicao = max(0, min(len(ordenados) - 1, math.ceil(percentual / 100 * len(ordenados)) - 1))
+    return ordenados[posicao]
+
+def _registrar_execucao_etl(telemetria):
+    """Grava em 'etl_runs' os tempos por fase, a vazão e os pedidos com erro de uma execução do ETL."""
+    fim = datetime.datetime.now()
+    tempo_total = (fim - telemetria['inicio']).total_seconds()
+    latencia_p50 = _percentil(telemetria['latencias'], 50)
+    latencia_p95 = _percentil(telemetria['latencias'], 95)
+    registros_por_segundo = telemetria['total_registros'] / tempo_total if tempo_total > 0 else None
+    try:
+        with get_sqlite_connection(DB_LOCAL) as conn_local:
+            conn_local.execute(
+                """
+                INSERT INTO etl_runs (
+                    inicio, fim, modo, status, workers, total_pedidos, total_registros,
+                    tempo_extracao_protheus, tempo_procedure_dts, latencia_p50_ms, latencia_p95_ms,
+                    tempo_conversao_decimal, tempo_escrita_sqlite, tempo_total, registros_por_segundo,
+                    pedidos_com_erro
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    telemetria['inicio'].strftime('%Y-%m-%d %H:%M:%S'), fim.strftime('%Y-%m-%d %H:%M:%S'),
+                    telemetria['modo'], telemetria['status'], telemetria['workers'],
+                    telemetria['total_pedidos'], telemetria['total_registros'],
+                    telemetria['tempo_extracao_protheus'], telemetria['tempo_procedure_dts'],
+                    latencia_p50 * 1000 if latencia_p50 is not None else None,
+                    latencia_p95 * 1000 if latencia_p95 is not None else None,
+                    telemetria['tempo_conversao_decimal'], telemetria['tempo_escrita_sqlite'],
+                    tempo_total, registros_por_segundo,
+                    json.dumps([str(numero) for numero in telemetria['pedidos_com_erro']])
+                )
+            )
+            conn_local.commit()
+        print(f"Execução registrada em 'etl_runs' (status: {telemetria['status']}, "
+              f"extração Protheus {telemetria['tempo_extracao_protheus']:.1f}s, "
+              f"DTS {telemetria['tempo_procedure_dts']:.1f}s, "
+              f"escrita SQLite {telemetria['tempo_escrita_sqlite']:.1f}s).")
     except Exception as e:
-        print(f"Aviso: Não foi possível configurar centros de custo: {e}")
-    print("Estrutura do banco de dados verificada e atualizada com sucesso.")
+        print(f"Aviso: Não foi possível registrar a execução do ETL: {e}")
 
-def gerar_base_completa():
+def gerar_base_completa(workers=None, incremental=False, retomar=False):
     """
     Executa a lógica de busca nos bancos de dados Protheus e DTS,
     processa os dados e salva o resultado em uma tabela no banco de dados local SQLite.
+    
+    workers: quantidade de conexões DTS executando a procedure em paralelo
+    (padrão: DTS_WORKERS).
+    incremental: se True, processa apenas os pedidos do SC5010 novos (R_E_C_N_O_ acima
+    da última sincronização) ou emitidos dentro da janela INCREMENTAL_JANELA_DIAS, e
+    substitui em 'pedidos_info' somente as linhas desses pedidos. Sem uma sincronização
+    anterior registrada em 'sync_estado', executa a carga completa. Pedidos excluídos
+    no Protheus, e alterações em pedidos emitidos antes da janela, só chegam à base
+    numa carga completa.
+    retomar: se True, reaproveita a staging e o checkpoint ('etl_progresso') de uma
+    execução interrompida no mesmo modo, processando apenas os pedidos pendentes.
     """
     # Passo 0: Garante que a estrutura do DB local está correta ANTES de tudo.
     inicializar_e_migrar_db()
     
     # Se estamos no Streamlit Cloud ou pyodbc não está disponível, 
     # não tentamos acessar os bancos externos
-    if is_streamlit_cloud or not pyodbc_available:
+    # No modo de reprodução (DB_MODO_GRAVACAO=reproduzir) as consultas vêm das gravações locais
+    if (is_streamlit_cloud or not pyodbc_available) and not modo_reproducao():
         print("\nFunção de geração de base completa não disponível no ambiente atual.")
         print("Esta funcionalidade requer acesso direto ao banco de dados Protheus/DTS.")
         print("Use esta aplicação em um ambiente local com pyodbc instalado para acessar esta funcionalidade.")
         
         # Verifica se já existe uma tabela pedidos_info localmente
-        with sqlite3.connect(DB_LOCAL) as conn_check:
+        with get_sqlite_connection(DB_LOCAL) as conn_check:
             cursor = conn_check.cursor()
             cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='pedidos_info'")
             if cursor.fetchone():
@@ -212,31 +374,20 @@ def gerar_base_completa():
     print("\nIniciando a geração da base de dados de pedidos...")
     # Conexão 1 - PROTHEUS_PRODUCAO
     conn1 = None
-    conn2 = None
     try:
-        conn1 = pyodbc.connect(
-            'DRIVER={ODBC Driver 18 for SQL Server};'
-            'SERVER=192.168.3.205;'
-            'DATABASE=PROTHEUS_PRODUCAO;'
-            'UID=almoxarifado;'
-            'PWD=almoxarifado;'
-            'TrustServerCertificate=yes;'
-        )
+        conn1 = instrumentar(preparar_conexao('PROTHEUS', lambda: pyodbc.connect(PROTHEUS_CONNECTION_STRING)), 'PROTHEUS')
         print("Conexão com PROTHEUS bem-sucedida.")
     except Exception as e:
         print(f"Falha ao conectar no PROTHEUS: {e}")
         return
     
-    # Conexão 2 - TOPEMA_PRD (DTS)
+    # Conexão 2 - TOPEMA_PRD (DTS). O pool tem uma conexão por worker; a primeira é aberta
+    # já aqui para validar o acesso e fica disponível para os workers.
+    workers = max(1, int(workers or DTS_WORKERS))
+    pool_dts = criar_pool_dts(workers)
     try:
-        conn2 = pyodbc.connect(
-            'DRIVER={ODBC Driver 18 for SQL Server};'
-            'SERVER=177.136.226.250;'
-            'DATABASE=TOPEMA_PRD;'
-            'UID=TOPEMA_DR;'
-            'PWD=T0p_X9iF*^@C~$;'
-            'TrustServerCertificate=yes;'
-        )
+        with pool_dts.connection():
+            pass
         print("Conexão com DTS bem-sucedida.")
     except Exception as e:
         print(f"Falha ao conectar no DTS: {e}")
@@ -244,77 +395,264 @@ def gerar_base_completa():
             conn1.close()
         return
     
+    estado_anterior = None
+    if incremental:
+        with get_sqlite_connection(DB_LOCAL) as conn_local:
+            estado_anterior = _ler_estado_sincronizacao(conn_local)
+        if estado_anterior is None:
+            print("Nenhuma sincronização anterior encontrada. Executando carga completa.")
+    modo = 'incremental' if estado_anterior else 'completo'
+    
+    telemetria = {
+        'inicio': datetime.datetime.now(),
+        'modo': modo,
+        'status': 'erro',
+        'workers': workers,
+        'total_pedidos': 0,
+        'total_registros': 0,
+        'tempo_extracao_protheus': 0.0,
+        'tempo_procedure_dts': 0.0,
+        'latencias': [],
+        'tempo_conversao_decimal': 0.0,
+        'tempo_escrita_sqlite': 0.0,
+        'pedidos_com_erro': [],
+    }
+    try:
+        _executar_carga(conn1, pool_dts, modo, estado_anterior, workers, retomar, telemetria)
+    finally:
+        pool_dts.close_all()
+        _registrar_execucao_etl(telemetria)
+
+def _executar_carga(conn1, pool_dts, modo, estado_anterior, workers, retomar, telemetria):
+    """
+    Extrai os pedidos do Protheus, executa a procedure no DTS e grava 'pedidos_info'.
+    Preenche 'telemetria' com os tempos de cada fase e o status final da execução.
+    """
     inicio = time.time()
     print("Iniciando extração de pedidos do Protheus...")
-    # 1. Pegando os pedidos únicos do Protheus
-    df_pedidos = pd.read_sql_query("SELECT DISTINCT C5_NUM AS NumeroPedido FROM SC5010 WHERE D_E_L_E_T_ = ''", conn1)
-    print(f"Encontrados {len(df_pedidos)} pedidos únicos.")
-    
-    resultados = []
-    # 2. Para cada pedido, executa a procedure no DTS
-    for numero in tqdm(df_pedidos['NumeroPedido'], desc='Processando pedidos no DTS', unit='pedido'):
+    # 1. Pegando os pedidos únicos do Protheus, com R_E_C_N_O_ e emissão para a marca d'água
+    query_pedidos = """
+        SELECT C5_NUM AS NumeroPedido, MAX(R_E_C_N_O_) AS Recno, MAX(C5_EMISSAO) AS Emissao
+        FROM SC5010
+        WHERE D_E_L_E_T_ = ''
+    """
+    params_pedidos = []
+    if estado_anterior:
+        ultimo_recno, ultima_emissao = estado_anterior
         try:
-            with conn2.cursor() as cursor2:
-                # Adaptação para garantir que o numero seja string, se necessário pela procedure
-                cursor2.execute("EXEC XSP_0044_DTS_PedidosVendasInfo @CD_PEDIDOVENDA = ?", str(numero))
-                columns = [column[0] for column in cursor2.description]
-                rows = cursor2.fetchall()
-                for row in rows:
-                    resultados.append(dict(zip(columns, row)))
-        except Exception as e:
-            print(f"\nErro ao processar pedido {numero}: {e}")
-            continue
+            emissao_minima = (
+                datetime.datetime.strptime(ultima_emissao, '%Y%m%d') - datetime.timedelta(days=INCREMENTAL_JANELA_DIAS)
+            ).strftime('%Y%m%d')
+        except (TypeError, ValueError):
+            emissao_minima = ultima_emissao or ''
+        query_pedidos += " AND (R_E_C_N_O_ > ? OR C5_EMISSAO >= ?)"
+        params_pedidos = [ultimo_recno, emissao_minima]
+        print(f"Modo incremental: R_E_C_N_O_ > {ultimo_recno} ou emissão a partir de {emissao_minima}.")
+    query_pedidos += " GROUP BY C5_NUM"
+    inicio_fase = time.perf_counter()
+    df_pedidos = pd.read_sql_query(query_pedidos, conn1, params=params_pedidos)
+    telemetria['tempo_extracao_protheus'] = time.perf_counter() - inicio_fase
+    telemetria['total_pedidos'] = len(df_pedidos)
+    print(f"Encontrados {len(df_pedidos)} pedidos únicos.")
     
-    if conn1:
+    if estado_anterior and df_pedidos.empty:
         conn1.close()
-    if conn2:
-        conn2.close()
+        with get_sqlite_connection(DB_LOCAL) as conn_local:
+            _gravar_estado_sincronizacao(conn_local, None, modo, 0)
+        print("Nenhum pedido novo ou alterado desde a última sincronização.")
+        telemetria['status'] = 'sem_alteracoes'
+        return
+    
+    # 2. Para cada pedido, executa a procedure no DTS (em paralelo quando workers > 1).
+    # As linhas são gravadas em lotes numa tabela de staging no SQLite à medida que chegam,
+    # de modo que a memória usada não cresce com o histórico de pedidos. Cada lote registra
+    # também os pedidos concluídos em 'etl_progresso', permitindo retomar uma execução interrompida.
+    print(f"Executando a procedure com {workers} conexão(ões) DTS.")
+    pedidos_com_erro = telemetria['pedidos_com_erro']
+    try:
+        with get_sqlite_connection(DB_LOCAL) as conn_local:
+            colunas_staging, pedidos_concluidos = None, set()
+            if retomar:
+                colunas_staging, pedidos_concluidos = _ler_progresso(conn_local, modo)
+            if colunas_staging is None:
+                conn_local.execute(f"DROP TABLE IF EXISTS {TABELA_STAGING}")
+                conn_local.execute("DELETE FROM etl_progresso")
+                conn_local.commit()
+            else:
+                print(f"Retomando execução anterior: {len(pedidos_concluidos)} pedidos já processados serão ignorados.")
+            
+            pedidos_pendentes = [
+                numero for numero in df_pedidos['NumeroPedido'] if str(numero) not in pedidos_concluidos
+            ]
+            lote = []
+            pedidos_no_lote = []
+            indices_decimais = None
+            inicio_fase = time.perf_counter()
+            execucoes = processar_pedidos_dts(pedidos_pendentes, workers, pool_dts)
+            for numero, columns, rows, erro, duracao in tqdm(execucoes, total=len(pedidos_pendentes), desc='Processando pedidos no DTS', unit='pedido'):
+                if duracao is not None:
+                    telemetria['latencias'].append(duracao)
+                nomes_colunas = [nome for nome, _ in columns] if erro is None else None
+                if erro is None and colunas_staging is None:
+                    # C5_NUM identifica o pedido de origem de cada linha (usado pelo upsert incremental)
+                    colunas_staging = nomes_colunas + ['C5_NUM']
+                    _criar_tabela_staging(conn_local, columns + [('C5_NUM', str)])
+                elif erro is None and nomes_colunas + ['C5_NUM'] != colunas_staging:
+                    erro = f"colunas retornadas pela procedure diferem das esperadas: {nomes_colunas}"
+                if erro is not None:
+                    print(f"\nErro ao processar pedido {numero}: {erro}")
+                    pedidos_com_erro.append(numero)
+                    continue
+                if indices_decimais is None:
+                    # Tipos resolvidos uma única vez: a procedure sempre retorna as mesmas colunas
+                    indices_decimais = [indice for indice, (_, tipo) in enumerate(columns) if tipo is Decimal]
+                inicio_conversao = time.perf_counter()
+                lote.extend(_normalizar_linhas(rows, indices_decimais, str(numero)))
+                telemetria['tempo_conversao_decimal'] += time.perf_counter() - inicio_conversao
+                pedidos_no_lote.append(str(numero))
+                if len(lote) >= ETL_LOTE_REGISTROS:
+                    inicio_escrita = time.perf_counter()
+                    _gravar_lote_staging(conn_local, colunas_staging, lote, pedidos_no_lote, modo)
+                    telemetria['tempo_escrita_sqlite'] += time.perf_counter() - inicio_escrita
+                    lote, pedidos_no_lote = [], []
+            if pedidos_no_lote:
+                inicio_escrita = time.perf_counter()
+                _gravar_lote_staging(conn_local, colunas_staging, lote, pedidos_no_lote, modo)
+                telemetria['tempo_escrita_sqlite'] += time.perf_counter() - inicio_escrita
+            # Só o tempo do laço que não foi gasto na conversão e na gravação dos lotes,
+            # contados em suas próprias fases: as fases de 'etl_runs' não se sobrepõem
+            telemetria['tempo_procedure_dts'] = (
+                time.perf_counter() - inicio_fase
+                - telemetria['tempo_conversao_decimal'] - telemetria['tempo_escrita_sqlite']
+            )
+            
+            total_linhas = 0
+            if colunas_staging is not None:
+                total_linhas = conn_local.execute(f"SELECT COUNT(*) FROM {TABELA_STAGING}").fetchone()[0]
+            telemetria['total_registros'] = total_linhas
+    except Exception as e:
+        print(f"\nERRO ao gravar os dados na tabela de staging do SQLite: {e}")
+        print("Os pedidos já gravados foram preservados. Execute novamente com --retomar para continuar.")
+        return
+    finally:
+        if conn1:
+            conn1.close()
     print("Conexões com Protheus e DTS fechadas.")
+    if pedidos_com_erro:
+        print(f"{len(pedidos_com_erro)} pedido(s) não puderam ser processados no DTS.")
+        if modo == 'completo' and len(pedidos_com_erro) > ETL_LIMITE_FALHAS * len(df_pedidos):
+            # Provável queda de conexão: não substitui a base por uma geração incompleta
+            print("Muitos pedidos falharam; 'pedidos_info' não foi substituída.")
+            print("Execute novamente com --retomar para reprocessar apenas os pedidos pendentes.")
+            telemetria['status'] = 'abortado'
+            return
     
-    if not resultados:
+    if total_linhas == 0:
         print("Nenhum resultado foi retornado pela procedure. Encerrando.")
+        telemetria['status'] = 'sem_resultados'
         return
     
-    df_resultado = pd.DataFrame(resultados)
-    df_resultado.drop_duplicates(inplace=True)
-    # --- AJUSTE DE TIPOS DE DADOS ---
-    print("Ajustando tipos de dados para compatibilidade com SQLite...")
-    for col in df_resultado.columns:
-        if any(isinstance(x, Decimal) for x in df_resultado[col].dropna()):
-            df_resultado[col] = df_resultado[col].astype(float)
-    
-    # Salva o resultado em uma tabela 'pedidos_info' no nosso banco local
+    # Salva o resultado em uma tabela 'pedidos_info' no nosso banco local,
+    # removendo as linhas duplicadas diretamente no SQL
+    marca_d_agua = _calcular_marca_d_agua(df_pedidos, pedidos_com_erro, estado_anterior)
+    selecao_deduplicada = _selecao_deduplicada(colunas_staging)
+    inicio_escrita = time.perf_counter()
     try:
-        with sqlite3.connect(DB_LOCAL) as conn_local:
-            # Verificar se a tabela já existe e tem dados
+        with get_sqlite_connection(DB_LOCAL) as conn_local:
             cursor = conn_local.cursor()
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='pedidos_info'")
-            if cursor.fetchone():
-                cursor.execute("SELECT COUNT(*) FROM pedidos_info")
-                count = cursor.fetchone()[0]
-                if count > 0:
-                    # Se a tabela já tem dados, fazemos backup antes de substituir
-                    import shutil
-                    backup_file = f"pedidos_info.backup_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-                    # Exportar dados existentes para o backup
-                    df_existing = pd.read_sql_query("SELECT * FROM pedidos_info", conn_local)
-                    with sqlite3.connect(backup_file) as conn_backup:
-                        df_existing.to_sql('pedidos_info', conn_backup, index=False)
-                    print(f"Backup dos dados existentes criado em {backup_file}")
+            if modo == 'incremental':
+                # Upsert: remove as linhas antigas dos pedidos reprocessados e insere as novas,
+                # tudo na mesma transação
+                cursor.execute(
+                    f"""
+                    DELETE FROM pedidos_info
+                    WHERE C5_NUM IN (SELECT DISTINCT C5_NUM FROM {TABELA_STAGING})
+                    """
+                )
+                print(f"{cursor.rowcount} registros antigos substituídos.")
+                # Linhas iguais a uma que continua na base (vinda de outro pedido) não são repetidas
+                colunas_dts = colunas_staging[:-1]
+                condicao_existente = ' AND '.join(
+                    f"p.{nome_sql(coluna)} IS nova.{nome_sql(coluna)}" for coluna in colunas_dts
+                )
+                lista_colunas = ', '.join(nome_sql(coluna) for coluna in colunas_staging)
+                cursor.execute(
+                    f"""
+                    INSERT INTO pedidos_info ({lista_colunas})
+                    SELECT * FROM ({selecao_deduplicada}) AS nova
+                    WHERE NOT EXISTS (SELECT 1 FROM pedidos_info AS p WHERE {condicao_existente})
+                    """
+                )
+                total_registros = cursor.rowcount
+                criar_indices_pedidos_info(cursor)
+            else:
+                # Carrega a nova geração numa tabela sombra, sem afetar quem está lendo 'pedidos_info'
+                cursor.execute(f"DROP TABLE IF EXISTS {TABELA_NOVA}")
+                cursor.execute(f"CREATE TABLE {TABELA_NOVA} AS {selecao_deduplicada}")
+                cursor.execute(f"SELECT COUNT(*) FROM {TABELA_NOVA}")
+                total_registros = cursor.fetchone()[0]
+                
+                # Troca atômica: a geração atual passa a ser a anterior e a sombra assume o nome
+                cursor.execute("BEGIN IMMEDIATE")
+                cursor.execute(f"DROP TABLE IF EXISTS {TABELA_ANTERIOR}")
+                cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='pedidos_info'")
+                if cursor.fetchone():
+                    cursor.execute(f"ALTER TABLE pedidos_info RENAME TO {TABELA_ANTERIOR}")
+                    # Os índices acompanham a tabela renomeada; são removidos da geração anterior
+                    # para que os mesmos nomes possam ser criados na nova 'pedidos_info'
+                    for nome_indice, _ in INDICES_PEDIDOS_INFO:
+                        cursor.execute(f"DROP INDEX IF EXISTS {nome_indice}")
+                cursor.execute(f"ALTER TABLE {TABELA_NOVA} RENAME TO pedidos_info")
+                criar_indices_pedidos_info(cursor)
+                print(f"Geração anterior de 'pedidos_info' mantida na tabela '{TABELA_ANTERIOR}'.")
+            conn_local.commit()
+            # Atualiza as estatísticas usadas pelo planejador de consultas
+            cursor.execute("ANALYZE pedidos_info")
             
-            # Agora podemos substituir com segurança
-            df_resultado.to_sql('pedidos_info', conn_local, if_exists='replace', index=False)
+            cursor.execute(f"DROP TABLE IF EXISTS {TABELA_STAGING}")
+            cursor.execute("DELETE FROM etl_progresso")
+            _gravar_estado_sincronizacao(
+                conn_local, marca_d_agua, modo, len(df_pedidos) - len(pedidos_com_erro)
+            )
+        telemetria['tempo_escrita_sqlite'] += time.perf_counter() - inicio_escrita
+        telemetria['total_registros'] = total_registros
+        telemetria['status'] = 'sucesso'
         fim = time.time()
         print("\n----------------------------------------------------")
-        print(f"SUCESSO! Base de dados 'pedidos_info' atualizada em {DB_LOCAL}.")
-        print(f"Total de {len(df_resultado)} registros salvos.")
+        print(f"SUCESSO! Base de dados 'pedidos_info' atualizada em {DB_LOCAL} (modo {modo}).")
+        print(f"Total de {total_registros} registros salvos.")
         print(f"Tempo total de execução: {round(fim - inicio, 2)} segundos.")
         print("----------------------------------------------------")
     except Exception as e:
         print(f"\nERRO ao salvar os dados no banco local SQLite: {e}")
 
 if __name__ == '__main__':
-    gerar_base_completa()
+    import argparse
+    parser = argparse.ArgumentParser(description="Gera a base local de pedidos a partir do Protheus/DTS.")
+    parser.add_argument('--aquecer-cache-bom', action='store_true',
+                        help="Pré-carrega o cache de BOM para todos os equipamentos de 'pedidos_info'.")
+    parser.add_argument('--atualizar-lookups-estoque', action='store_true',
+                        help="Recarrega do Protheus os fornecedores principais e os últimos pedidos de compra.")
+    parser.add_argument('--forcar', action='store_true',
+                        help="Com --aquecer-cache-bom, recarrega também as BOMs ainda válidas.")
+    parser.add_argument('--workers', type=int, default=None,
+                        help=f"Conexões DTS executando a procedure em paralelo (padrão: {DTS_WORKERS}).")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Processa apenas pedidos novos ou alterados desde a última sincronização.")
+    parser.add_argument('--retomar', action='store_true',
+                        help="Continua uma execução interrompida, ignorando os pedidos já processados.")
+    args = parser.parse_args()
+    
+    if args.aquecer_cache_bom:
+        import db_manager
+        db_manager.aquecer_cache_bom(forcar=args.forcar)
+    elif args.atualizar_lookups_estoque:
+        import db_manager
+        db_manager.atualizar_lookups_estoque()
+    else:
+        gerar_base_completa(workers=args.workers, incremental=args.incremental, retomar=args.retomar)
+    # Fecha a conexão persistente com o SQLite local (faz o checkpoint do WAL)
+    fechar_conexoes_sqlite()
 
 
 
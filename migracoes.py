@@ -0,0 +1,413 @@
+import sqlite3
+import datetime
+
+from database import get_sqlite_connection
+
+DB_LOCAL = 'garantia.db'
+
+# Estrutura do banco SQLite local, mantida por migrações numeradas. A versão aplicada fica em
+# PRAGMA user_version: com o banco já atualizado, a inicialização faz só essa leitura.
+# Para alterar o schema, acrescente uma migração ao final de MIGRACOES (nunca altere as já
+# publicadas). Cada passo deve ser idempotente, pois bases anteriores a este controle estão
+# na versão 0 mas já têm parte das tabelas.
+
+# Índices das tabelas do fluxo de solicitações: (nome, tabela, [(coluna, ordem)]).
+# Ao alterar a lista, acrescente uma migração que chame _criar_indices_workflow novamente.
+INDICES_WORKFLOW = [
+    # Filas por status, cada uma ordenada pela data da sua etapa
+    ('idx_solicitacoes_status_criacao', 'solicitacoes', [('status_atual', 'ASC'), ('data_criacao', 'DESC')]),
+    ('idx_solicitacoes_status_aprovacao', 'solicitacoes', [('status_atual', 'ASC'), ('data_aprovacao', 'DESC')]),
+    ('idx_solicitacoes_status_liberacao', 'solicitacoes', [('status_atual', 'ASC'), ('data_liberacao', 'DESC')]),
+    ('idx_solicitacoes_status_devolucao', 'solicitacoes', [('status_atual', 'ASC'), ('data_devolucao_solicitada', 'DESC')]),
+    ('idx_solicitacoes_status_centro_custo', 'solicitacoes', [('status_atual', 'ASC'), ('centro_custo', 'ASC'), ('data_criacao', 'DESC')]),
+    ('idx_solicitacoes_data_criacao', 'solicitacoes', [('data_criacao', 'DESC')]),
+    # Itens e histórico de uma solicitação
+    ('idx_itens_solicitacao_solicitacao', 'itens_solicitacao', [('solicitacao_id', 'ASC'), ('id', 'ASC')]),
+    ('idx_historico_solicitacao', 'historico', [('solicitacao_id', 'ASC'), ('timestamp', 'ASC')]),
+    # Centros de custo por gestor e por código, e a listagem completa ordenada por setor
+    ('idx_centros_custo_gestor', 'centros_custo', [('gestor', 'ASC')]),
+    ('idx_centros_custo_codigo', 'centros_custo', [('codigo', 'ASC')]),
+    ('idx_centros_custo_setor', 'centros_custo', [('setor', 'ASC')]),
+]
+
+# Índices mantidos em 'pedidos_info' após cada carga: (nome, [(coluna, ordem)]).
+# O último cobre a consulta dos dropdowns da solicitação (get_clientes_pedidos_equipamentos),
+# na mesma ordenação, para que ela seja atendida só pelo índice.
+INDICES_PEDIDOS_INFO = [
+    ('idx_pedidos_info_cnpj_cpf', [('CNPJ/CPF', 'ASC')]),
+    ('idx_pedidos_info_pdv', [('Nº PDV', 'ASC')]),
+    ('idx_pedidos_info_sku', [('SKU Protheus', 'ASC')]),
+    ('idx_pedidos_info_c5_num', [('C5_NUM', 'ASC')]),
+    ('idx_pedidos_info_dropdown', [
+        ('Nome/Razão Social', 'ASC'), ('Data Venda', 'DESC'), ('Nº PDV', 'ASC'),
+        ('CNPJ/CPF', 'ASC'), ('SKU Protheus', 'ASC'), ('Descrição do Produto', 'ASC'),
+    ]),
+]
+
+def _colunas(cursor, tabela):
+    cursor.execute(f"PRAGMA table_info({tabela})")
+    return {info[1] for info in cursor.fetchall()}
+
+def _adicionar_colunas(cursor, tabela, colunas):
+    """Adiciona à tabela as colunas [(nome, tipo)] que ela ainda não tem."""
+    existentes = _colunas(cursor, tabela)
+    for nome, tipo in colunas:
+        if nome not in existentes:
+            print(f" -> Adicionando coluna '{nome}' na tabela '{tabela}'...")
+            cursor.execute(f"ALTER TABLE {tabela} ADD COLUMN {nome} {tipo}")
+
+def _tabela_existe(cursor, tabela):
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name = ?", (tabela,))
+    return cursor.fetchone() is not None
+
+def nome_sql(nome):
+    """Retorna o nome de coluna/tabela entre aspas duplas, escapando aspas internas."""
+    return '"' + str(nome).replace('"', '""') + '"'
+
+def criar_indices_pedidos_info(cursor):
+    """
+    Cria os índices de INDICES_PEDIDOS_INFO que ainda não existem em 'pedidos_info'.
+    Índices cujas colunas não existem na tabela (bases antigas) são ignorados.
+    """
+    cursor.execute("PRAGMA table_info(pedidos_info)")
+    colunas_existentes = {linha[1] for linha in cursor.fetchall()}
+    for nome_indice, colunas in INDICES_PEDIDOS_INFO:
+        if not all(coluna in colunas_existentes for coluna, _ in colunas):
+            continue
+        definicao = ', '.join(f"{nome_sql(coluna)} {ordem}" for coluna, ordem in colunas)
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {nome_indice} ON pedidos_info ({definicao})")
+
+def _migracao_fluxo_solicitacoes(cursor):
+    # Tabela principal de solicitações
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS solicitacoes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            data_criacao TEXT,
+            solicitante TEXT,
+            solicitante_email TEXT,
+            cliente_cnpj TEXT,
+            cliente_nome TEXT,
+            pedido_venda TEXT,
+            equipamento_sku TEXT,
+            equipamento_nome TEXT,
+            status_atual TEXT, -- 'Pendente Aprovação', 'Aprovada', 'Rejeitada', 'Disponível para Retirada', 'Não Disponível', 'Retirada Confirmada', 'Devolução Pendente Almoxarifado', 'Devolução Concluída', 'Finalizada'
+            data_ultimo_status TEXT,
+            aprovador TEXT, -- Usuário que aprovou/rejeitou
+            data_aprovacao TEXT, -- Data da aprovação/rejeição
+            motivo_rejeicao TEXT, -- Motivo se a solicitação foi rejeitada
+            almoxarife_liberacao TEXT, -- Usuário do almoxarifado que liberou
+            data_liberacao TEXT, -- Data da liberação pelo almoxarifado
+            motivo_nao_disponivel TEXT, -- Motivo se o almoxarifado não pôde separar
+            retirado_por TEXT,
+            data_retirada TEXT, -- Data da confirmação de retirada pelo solicitante
+            data_devolucao_solicitada TEXT, -- Data em que o solicitante registrou a devolução
+            data_devolucao_confirmada TEXT, -- Data em que o almoxarifado confirmou a devolução
+            almoxarife_devolucao_confirmacao TEXT, -- Usuário do almoxarifado que confirmou a devolução
+            data_finalizacao TEXT -- Data de finalização do processo
+        )
+    ''')
+    # Colunas acrescentadas depois da primeira versão da tabela
+    _adicionar_colunas(cursor, 'solicitacoes', [
+        ('solicitante_email', 'TEXT'), ('cliente_cnpj', 'TEXT'), ('retirado_por', 'TEXT'),
+        ('status_aprovacao', 'TEXT'), ('aprovador', 'TEXT'), ('data_aprovacao', 'TEXT'),
+        ('motivo_rejeicao', 'TEXT'), ('almoxarife_liberacao', 'TEXT'), ('data_liberacao', 'TEXT'),
+        ('motivo_nao_disponivel', 'TEXT'), ('data_retirada', 'TEXT'),
+        ('data_devolucao_solicitada', 'TEXT'), ('data_devolucao_confirmada', 'TEXT'),
+        ('almoxarife_devolucao_confirmacao', 'TEXT'), ('data_finalizacao', 'TEXT'),
+    ])
+    # Itens de cada solicitação
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS itens_solicitacao (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            solicitacao_id INTEGER,
+            componente_sku TEXT,
+            componente_desc TEXT,
+            quantidade_solicitada INTEGER,
+            quantidade_liberada INTEGER DEFAULT 0, -- Quantidade separada pelo almoxarifado
+            quantidade_retirada INTEGER DEFAULT 0, -- Quantidade efetivamente retirada
+            quantidade_devolvida INTEGER DEFAULT 0, -- Quantidade devolvida pelo solicitante
+            observacoes TEXT,
+            FOREIGN KEY (solicitacao_id) REFERENCES solicitacoes (id)
+        )
+    ''')
+    _adicionar_colunas(cursor, 'itens_solicitacao', [
+        ('quantidade_liberada', 'INTEGER DEFAULT 0'),
+        ('quantidade_retirada', 'INTEGER DEFAULT 0'),
+        ('quantidade_devolvida', 'INTEGER DEFAULT 0'),
+        ('observacoes', 'TEXT'),
+    ])
+    # Histórico para auditoria completa
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS historico (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            solicitacao_id INTEGER,
+            timestamp TEXT,
+            usuario TEXT,
+            acao TEXT,
+            detalhes TEXT,
+            FOREIGN KEY (solicitacao_id) REFERENCES solicitacoes (id)
+        )
+    ''')
+
+def _migracao_centros_custo(cursor):
+    # Centros de custo e seus gestores responsáveis; os iniciais só entram na criação da tabela
+    if not _tabela_existe(cursor, 'centros_custo'):
+        cursor.execute('''
+            CREATE TABLE centros_custo (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                codigo TEXT NOT NULL,
+                setor TEXT NOT NULL,
+                gestor TEXT NOT NULL,
+                gestor_email TEXT
+            )
+        ''')
+        cursor.executemany(
+            "INSERT INTO centros_custo (codigo, setor, gestor, gestor_email) VALUES (?, ?, ?, ?)",
+            [
+                ('040023', 'Garantia', 'gestor.garantia', 'gestor.garantia@empresa.com'),
+                ('040031', 'Assistência', 'gestor.assistencia', 'gestor.assistencia@empresa.com'),
+                ('040024', 'Instalações', 'gestor.instalacoes', 'gestor.instalacoes@empresa.com'),
+            ]
+        )
+    _adicionar_colunas(cursor, 'solicitacoes', [('centro_custo', 'TEXT'), ('setor', 'TEXT')])
+
+def _migracao_etl_pedidos(cursor):
+    # Pedidos já gravados na staging pela execução atual do ETL (checkpoint para retomada)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS etl_progresso (
+            C5_NUM TEXT PRIMARY KEY,
+            modo TEXT,
+            data_processamento TEXT
+        )
+    ''')
+    # Telemetria de cada execução do ETL de pedidos (tempos por fase e vazão)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS etl_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            inicio TEXT,
+            fim TEXT,
+            modo TEXT, -- 'completo' ou 'incremental'
+            status TEXT, -- 'sucesso', 'erro', 'abortado', 'sem_alteracoes', 'sem_resultados'
+            workers INTEGER,
+            total_pedidos INTEGER,
+            total_registros INTEGER,
+            tempo_extracao_protheus REAL, -- segundos
+            tempo_procedure_dts REAL, -- segundos
+            latencia_p50_ms REAL, -- latência da procedure por pedido
+            latencia_p95_ms REAL,
+            tempo_conversao_decimal REAL, -- segundos
+            tempo_escrita_sqlite REAL, -- segundos
+            tempo_total REAL, -- segundos
+            registros_por_segundo REAL,
+            pedidos_com_erro TEXT -- lista JSON com os números dos pedidos
+        )
+    ''')
+    # Estado da sincronização incremental de tabelas vindas do Protheus/DTS
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sync_estado (
+            tabela TEXT PRIMARY KEY,
+            ultimo_recno INTEGER, -- Maior R_E_C_N_O_ do SC5010 já sincronizado
+            ultima_emissao TEXT, -- Maior C5_EMISSAO (AAAAMMDD) já sincronizado
+            modo TEXT, -- 'completo' ou 'incremental'
+            data_ultima_execucao TEXT,
+            pedidos_processados INTEGER
+        )
+    ''')
+    # Bases geradas antes da criação dos índices de 'pedidos_info' passam a tê-los
+    if _tabela_existe(cursor, 'pedidos_info'):
+        criar_indices_pedidos_info(cursor)
+
+def _migracao_cache_bom(cursor):
+    # Cache local da BOM do Protheus
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS componentes_produtos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            produto_sku TEXT NOT NULL,
+            componente_sku TEXT NOT NULL,
+            componente_desc TEXT NOT NULL,
+            quantidade INTEGER NOT NULL
+        )
+    ''')
+    _adicionar_colunas(cursor, 'componentes_produtos', [
+        ('unidade_medida', 'TEXT'), ('nivel', 'INTEGER'), ('pai_componente', 'TEXT'), ('ordem', 'INTEGER'),
+    ])
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_componentes_produtos_produto
+        ON componentes_produtos (produto_sku, ordem)
+    ''')
+    # Uma linha por equipamento: quando a BOM foi lida do Protheus e com qual profundidade
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS componentes_produtos_cache (
+            produto_sku TEXT PRIMARY KEY,
+            nivel_maximo INTEGER NOT NULL,
+            data_atualizacao TEXT NOT NULL
+        )
+    ''')
+
+def _migracao_lookups_estoque(cursor):
+    # Fornecedor principal (SA5010/SA2010) e previsão do último pedido de compra (SC7010) por produto
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fornecedor_principal (
+            produto TEXT PRIMARY KEY, -- B1_COD sem os espaços de preenchimento
+            nome_fornecedor TEXT,
+            descricao_produto_fornecedor TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ultimo_pedido_compra (
+            produto TEXT PRIMARY KEY, -- B1_COD sem os espaços de preenchimento
+            previsao_entrega TEXT -- C7_DATPRF (AAAAMMDD)
+        )
+    ''')
+
+def _migracao_quantidade_bom_real(cursor):
+    # G1_QUANT é fracionário: com afinidade INTEGER o cache devolvia 2 onde o Protheus devolve 2.0.
+    # O SQLite não altera o tipo de uma coluna, então a tabela é recriada com as linhas já gravadas.
+    # Uma cópia que tenha sobrado de uma execução interrompida é descartada, para a migração poder ser repetida.
+    cursor.execute("DROP TABLE IF EXISTS componentes_produtos_nova")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS componentes_produtos_nova (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            produto_sku TEXT NOT NULL,
+            componente_sku TEXT NOT NULL,
+            componente_desc TEXT NOT NULL,
+            quantidade REAL NOT NULL,
+            unidade_medida TEXT,
+            nivel INTEGER,
+            pai_componente TEXT,
+            ordem INTEGER
+        )
+    ''')
+    cursor.execute('''
+        INSERT INTO componentes_produtos_nova (
+            id, produto_sku, componente_sku, componente_desc, quantidade,
+            unidade_medida, nivel, pai_componente, ordem
+        )
+        SELECT
+            id, produto_sku, componente_sku, componente_desc, CAST(quantidade AS REAL),
+            unidade_medida, nivel, pai_componente, ordem
+        FROM componentes_produtos
+    ''')
+    cursor.execute("DROP TABLE componentes_produtos")
+    cursor.execute("ALTER TABLE componentes_produtos_nova RENAME TO componentes_produtos")
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_componentes_produtos_produto
+        ON componentes_produtos (produto_sku, ordem)
+    ''')
+
+def _migracao_query_log(cursor):
+    # Consultas lentas registradas pelo query_monitor
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS query_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT,
+            banco TEXT, -- 'SQLITE', 'PROTHEUS' ou 'DTS'
+            fingerprint TEXT,
+            sql TEXT,
+            duracao_ms REAL,
+            linhas INTEGER,
+            origem TEXT, -- módulo.função que executou a consulta
+            pagina TEXT -- página do Streamlit ativa
+        )
+    ''')
+
+def _criar_indices_workflow(cursor):
+    """
+    Cria os índices de INDICES_WORKFLOW e remove os índices 'idx_' dessas tabelas que saíram da lista.
+    """
+    nomes = {nome for nome, _, _ in INDICES_WORKFLOW}
+    for tabela in sorted({tabela for _, tabela, _ in INDICES_WORKFLOW}):
+        colunas_existentes = _colunas(cursor, tabela)
+        for nome, tabela_indice, colunas in INDICES_WORKFLOW:
+            if tabela_indice != tabela or not all(coluna in colunas_existentes for coluna, _ in colunas):
+                continue
+            definicao = ', '.join(f"{coluna} {ordem}" for coluna, ordem in colunas)
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {nome} ON {tabela} ({definicao})")
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND name LIKE 'idx\\_%' ESCAPE '\\'",
+            (tabela,)
+        )
+        for (nome_antigo,) in cursor.fetchall():
+            if nome_antigo not in nomes:
+                cursor.execute(f"DROP INDEX IF EXISTS {nome_antigo}")
+
+def _migracao_indices_workflow(cursor):
+    _criar_indices_workflow(cursor)
+    # A versão dos índices passa a ser controlada pelas migrações
+    cursor.execute("DROP TABLE IF EXISTS indices_versao")
+
+# (versão, descrição, função que recebe o cursor), em ordem
+MIGRACOES = [
+    (1, "tabelas do fluxo de solicitações", _migracao_fluxo_solicitacoes),
+    (2, "centros de custo e gestores", _migracao_centros_custo),
+    (3, "controle do ETL de pedidos", _migracao_etl_pedidos),
+    (4, "cache local de BOM", _migracao_cache_bom),
+    (5, "lookups de estoque", _migracao_lookups_estoque),
+    (6, "índices do fluxo de solicitações", _migracao_indices_workflow),
+    (7, "quantidade fracionária no cache de BOM", _migracao_quantidade_bom_real),
+    (8, "log de consultas lentas", _migracao_query_log),
+    (9, "índice de centros de custo por setor", _criar_indices_workflow),
+]
+VERSAO_SCHEMA = MIGRACOES[-1][0]
+
+def _backup_antes_de_migrar(conn, caminho):
+    """Copia o banco antes de migrá-lo, se ele já tiver solicitações ou histórico."""
+    cursor = conn.cursor()
+    try:
+        if not _tabela_existe(cursor, 'solicitacoes') or not _tabela_existe(cursor, 'historico'):
+            return
+        cursor.execute("SELECT (SELECT COUNT(*) FROM solicitacoes) + (SELECT COUNT(*) FROM historico)")
+        if not cursor.fetchone()[0]:
+            return
+        backup_file = f"{caminho}.backup_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        # Cópia pela API de backup do SQLite, que inclui o conteúdo ainda no arquivo WAL
+        conn_backup = sqlite3.connect(backup_file)
+        try:
+            conn.backup(conn_backup)
+        finally:
+            conn_backup.close()
+        print(f"Backup do banco de dados criado: {backup_file}")
+    except Exception as e:
+        print(f"Aviso: Não foi possível criar o backup antes da migração: {e}")
+
+def versao_banco(caminho=DB_LOCAL):
+    """Retorna a versão do schema do banco (PRAGMA user_version)."""
+    return get_sqlite_connection(caminho).execute("PRAGMA user_version").fetchone()[0]
+
+def migrar_banco(caminho=DB_LOCAL):
+    """
+    Leva o banco SQLite local à versão VERSAO_SCHEMA, aplicando em ordem as migrações
+    pendentes. Cada migração roda na sua própria transação, junto com a atualização de
+    PRAGMA user_version; processos que inicializam o banco ao mesmo tempo aguardam um ao
+    outro e não repetem migrações. Com o banco já atualizado, só a versão é lida.
+    Retorna a versão final.
+    """
+    conn = get_sqlite_connection(caminho)
+    versao = conn.execute("PRAGMA user_version").fetchone()[0]
+    if versao >= VERSAO_SCHEMA:
+        return versao
+
+    print(f"Atualizando a estrutura do banco de dados local da versão {versao} para a {VERSAO_SCHEMA}...")
+    _backup_antes_de_migrar(conn, caminho)
+    cursor = conn.cursor()
+    for numero, descricao, migracao in MIGRACOES:
+        if numero <= versao:
+            continue
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Outro processo pode ter aplicado a migração enquanto esperávamos o bloqueio
+            versao = conn.execute("PRAGMA user_version").fetchone()[0]
+            if numero <= versao:
+                conn.rollback()
+                continue
+            print(f" -> Migração {numero}: {descricao}")
+            migracao(cursor)
+            cursor.execute(f"PRAGMA user_version = {numero}")
+            conn.commit()
+            versao = numero
+        except Exception:
+            conn.rollback()
+            raise
+    print("Estrutura do banco de dados verificada e atualizada com sucesso.")
+    return versao
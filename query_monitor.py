@@ -0,0 +1,358 @@
+import os
+import re
+import sys
+import time
+import sqlite3
+import hashlib
+import datetime
+import threading
+from collections import deque
+
+import pandas as pd
+
+DB_LOCAL = 'garantia.db'
+
+# Consultas que levam pelo menos este tempo (ms) são gravadas na tabela 'query_log'. A gravação
+# acontece no próximo commit de uma conexão instrumentada com o banco local, fora de transações.
+QUERY_LENTA_MS = float(os.environ.get('QUERY_LENTA_MS', 500))
+# Quantidade de consultas recentes mantidas em memória para o painel de diagnóstico
+QUERY_BUFFER_TAMANHO = int(os.environ.get('QUERY_BUFFER_TAMANHO', 2000))
+
+_consultas_recentes = deque(maxlen=QUERY_BUFFER_TAMANHO)
+_buffer_lock = threading.Lock()
+_contexto = threading.local()
+# Consultas lentas aguardando gravação em 'query_log'
+_consultas_lentas = deque(maxlen=QUERY_BUFFER_TAMANHO)
+
+# Módulos ignorados ao procurar a função do app que originou a consulta
+_DIRETORIO_APP = os.path.dirname(os.path.abspath(__file__))
+_ARQUIVOS_IGNORADOS = tuple(
+    os.path.join(_DIRETORIO_APP, arquivo) for arquivo in ('query_monitor.py', 'query_replay.py', 'database.py')
+)
+
+def definir_pagina(pagina):
+    """Associa as próximas consultas da thread atual (a execução do Streamlit) a uma página do app."""
+    _contexto.pagina = pagina
+
+def pagina_atual():
+    return getattr(_contexto, 'pagina', None)
+
+def fingerprint_sql(sql):
+    """
+    Normaliza o SQL para agrupar execuções da mesma consulta: remove comentários,
+    troca literais por '?', reduz listas IN a um único marcador e compacta os espaços.
+    """
+    texto = re.sub(r'--[^\n]*', ' ', sql)
+    texto = re.sub(r'/\*.*?\*/', ' ', texto, flags=re.S)
+    texto = re.sub(r"'(?:[^']|'')*'", '?', texto)
+    texto = re.sub(r'\b\d+(?:\.\d+)?\b', '?', texto)
+    texto = re.sub(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', 'IN (?+)', texto, flags=re.I)
+    return re.sub(r'\s+', ' ', texto).strip()
+
+def _origem_da_consulta():
+    """Retorna 'modulo.funcao' do primeiro frame do app fora da camada de acesso a dados."""
+    frame = sys._getframe(2)
+    while frame is not None:
+        arquivo = os.path.abspath(frame.f_code.co_filename)
+        if arquivo.startswith(_DIRETORIO_APP) and arquivo not in _ARQUIVOS_IGNORADOS:
+            modulo = os.path.splitext(os.path.basename(arquivo))[0]
+            return f"{modulo}.{frame.f_code.co_name}"
+        frame = frame.f_back
+    return None
+
+def _iniciar_registro(banco, sql):
+    registro = {
+        'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'banco': banco,
+        'fingerprint': fingerprint_sql(sql),
+        'sql': sql,
+        'duracao_ms': 0.0,
+        'linhas': None,
+        'origem': _origem_da_consulta(),
+        'pagina': getattr(_contexto, 'pagina', None),
+    }
+    with _buffer_lock:
+        _consultas_recentes.append(registro)
+    return registro
+
+def _registrar_se_lenta(registro):
+    """
+    Enfileira para 'query_log' o registro que passou do limite de lentidão (uma única vez).
+    A fila é gravada por gravar_consultas_lentas; até lá, o tempo e as linhas de leituras
+    posteriores continuam sendo somados ao mesmo registro.
+    """
+    if registro is None or registro.get('lenta') or registro['duracao_ms'] < QUERY_LENTA_MS:
+        return
+    registro['lenta'] = True
+    _consultas_lentas.append(registro)
+
+def gravar_consultas_lentas(conn):
+    """
+    Grava em 'query_log' as consultas lentas enfileiradas, usando a conexão SQLite 'conn'
+    (com o banco DB_LOCAL). Com uma transação aberta na conexão não faz nada: a gravação
+    não disputa o bloqueio de escrita da própria thread nem entra no commit de outra
+    operação, e fica para o próximo commit.
+    """
+    if not _consultas_lentas or conn.in_transaction:
+        return
+    registros = []
+    while _consultas_lentas:
+        try:
+            registros.append(_consultas_lentas.popleft())
+        except IndexError:
+            break
+    try:
+        # Cursor sem instrumentação, para não registrar a própria gravação do log
+        cursor = conn.cursor(sqlite3.Cursor)
+        cursor.executemany(
+            """
+            INSERT INTO query_log (timestamp, banco, fingerprint, sql, duracao_ms, linhas, origem, pagina)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (registro['timestamp'], registro['banco'], registro['fingerprint'], registro['sql'],
+                 registro['duracao_ms'], registro['linhas'], registro['origem'], registro['pagina'])
+                for registro in registros
+            ]
+        )
+        sqlite3.Connection.commit(conn)
+    except Exception as e:
+        if conn.in_transaction:
+            sqlite3.Connection.rollback(conn)
+        if isinstance(e, sqlite3.OperationalError) and 'no such table' in str(e):
+            # Banco ainda não migrado (migracoes.py): os registros aguardam a criação da tabela
+            _consultas_lentas.extendleft(reversed(registros))
+            return
+        print(f"Aviso: Não foi possível gravar {len(registros)} consulta(s) lenta(s) em 'query_log': {e}")
+
+def _somar_linhas(registro, linhas):
+    if registro is not None:
+        registro['linhas'] = (registro['linhas'] or 0) + linhas
+
+class InstrumentedCursor:
+    """Cursor (pyodbc) que mede tempo e linhas de cada consulta; os demais atributos são delegados."""
+    def __init__(self, cursor, banco):
+        self._cursor = cursor
+        self._banco = banco
+        self._registro = None
+
+    def __getattr__(self, nome):
+        return getattr(self._cursor, nome)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def execute(self, sql, *params):
+        _registrar_se_lenta(self._registro)
+        self._registro = _iniciar_registro(self._banco, sql)
+        inicio = time.perf_counter()
+        try:
+            self._cursor.execute(sql, *params)
+        finally:
+            self._registro['duracao_ms'] += (time.perf_counter() - inicio) * 1000
+        rowcount = getattr(self._cursor, 'rowcount', -1)
+        if rowcount is not None and rowcount >= 0:
+            self._registro['linhas'] = rowcount
+        # Registra já aqui: cursores cujo resultado nunca é lido não chegam a fetchall/close
+        _registrar_se_lenta(self._registro)
+        return self
+
+    def executemany(self, sql, seq_params):
+        _registrar_se_lenta(self._registro)
+        self._registro = _iniciar_registro(self._banco, sql)
+        inicio = time.perf_counter()
+        try:
+            self._cursor.executemany(sql, seq_params)
+        finally:
+            self._registro['duracao_ms'] += (time.perf_counter() - inicio) * 1000
+        _registrar_se_lenta(self._registro)
+        return self
+
+    def _medir_fetch(self, metodo, *args):
+        inicio = time.perf_counter()
+        resultado = metodo(*args)
+        if self._registro is not None:
+            self._registro['duracao_ms'] += (time.perf_counter() - inicio) * 1000
+            _registrar_se_lenta(self._registro)
+        return resultado
+
+    def fetchone(self):
+        linha = self._medir_fetch(self._cursor.fetchone)
+        if linha is not None:
+            _somar_linhas(self._registro, 1)
+        return linha
+
+    def fetchmany(self, *args):
+        linhas = self._medir_fetch(self._cursor.fetchmany, *args)
+        _somar_linhas(self._registro, len(linhas))
+        return linhas
+
+    def fetchall(self):
+        linhas = self._medir_fetch(self._cursor.fetchall)
+        if self._registro is not None:
+            self._registro['linhas'] = len(linhas)
+            _registrar_se_lenta(self._registro)
+        return linhas
+
+    def close(self):
+        _registrar_se_lenta(self._registro)
+        self._cursor.close()
+
+class InstrumentedConnection:
+    """Conexão (pyodbc) cujos cursores são instrumentados; os demais atributos são delegados."""
+    def __init__(self, conn, banco):
+        self._conn = conn
+        self._banco = banco
+
+    def __getattr__(self, nome):
+        return getattr(self._conn, nome)
+
+    def cursor(self):
+        return InstrumentedCursor(self._conn.cursor(), self._banco)
+
+    def execute(self, sql, *params):
+        return self.cursor().execute(sql, *params)
+
+def instrumentar(conn, banco):
+    """Envolve uma conexão pyodbc para registrar as consultas executadas por ela."""
+    return InstrumentedConnection(conn, banco)
+
+class InstrumentedSQLiteCursor(sqlite3.Cursor):
+    """Cursor SQLite que mede tempo e linhas de cada consulta."""
+    _registro = None
+
+    def execute(self, sql, parameters=()):
+        _registrar_se_lenta(self._registro)
+        self._registro = _iniciar_registro('SQLITE', sql)
+        inicio = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._registro['duracao_ms'] += (time.perf_counter() - inicio) * 1000
+            if self.rowcount >= 0:
+                self._registro['linhas'] = self.rowcount
+            # Registra já aqui: cursores de conn.execute cujo resultado nunca é lido não
+            # chegam a fetchall/close
+            _registrar_se_lenta(self._registro)
+
+    def executemany(self, sql, seq_of_parameters):
+        _registrar_se_lenta(self._registro)
+        self._registro = _iniciar_registro('SQLITE', sql)
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._registro['duracao_ms'] += (time.perf_counter() - inicio) * 1000
+            if self.rowcount >= 0:
+                self._registro['linhas'] = self.rowcount
+            # Registra já aqui: cursores de conn.execute cujo resultado nunca é lido não
+            # chegam a fetchall/close
+            _registrar_se_lenta(self._registro)
+
+    def fetchone(self):
+        inicio = time.perf_counter()
+        linha = super().fetchone()
+        if self._registro is not None:
+            self._registro['duracao_ms'] += (time.perf_counter() - inicio) * 1000
+            if linha is not None:
+                _somar_linhas(self._registro, 1)
+            _registrar_se_lenta(self._registro)
+        return linha
+
+    def fetchmany(self, *args, **kwargs):
+        inicio = time.perf_counter()
+        linhas = super().fetchmany(*args, **kwargs)
+        if self._registro is not None:
+            self._registro['duracao_ms'] += (time.perf_counter() - inicio) * 1000
+            _somar_linhas(self._registro, len(linhas))
+            _registrar_se_lenta(self._registro)
+        return linhas
+
+    def fetchall(self):
+        inicio = time.perf_counter()
+        linhas = super().fetchall()
+        if self._registro is not None:
+            self._registro['duracao_ms'] += (time.perf_counter() - inicio) * 1000
+            self._registro['linhas'] = len(linhas)
+            _registrar_se_lenta(self._registro)
+        return linhas
+
+    def close(self):
+        _registrar_se_lenta(self._registro)
+        super().close()
+
+class InstrumentedSQLiteConnection(sqlite3.Connection):
+    """
+    Conexão SQLite cujos cursores (inclusive os de conn.execute) são instrumentados.
+    Se a conexão for com o banco local, grava as consultas lentas pendentes em 'query_log'
+    depois de cada commit (inclusive o do bloco 'with').
+    """
+    def __init__(self, database, *args, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        self._grava_query_log = os.path.abspath(os.fspath(database)) == os.path.abspath(DB_LOCAL)
+
+    def cursor(self, factory=InstrumentedSQLiteCursor):
+        return super().cursor(factory)
+
+    # O execute/executemany nativos da conexão não passam por cursor(); usam um cursor comum
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        super().commit()
+        if self._grava_query_log:
+            gravar_consultas_lentas(self)
+
+    def __exit__(self, *args):
+        resultado = super().__exit__(*args)
+        if self._grava_query_log:
+            gravar_consultas_lentas(self)
+        return resultado
+
+def get_consultas_recentes():
+    """Retorna as consultas do buffer em memória (as mais recentes do processo) como DataFrame."""
+    with _buffer_lock:
+        registros = [dict(registro) for registro in _consultas_recentes]
+    colunas = ['timestamp', 'banco', 'fingerprint', 'sql', 'duracao_ms', 'linhas', 'origem', 'pagina']
+    return pd.DataFrame(registros, columns=colunas)
+
+def get_top_consultas(limite=20):
+    """
+    Agrupa as consultas recentes por fingerprint e retorna as que mais consumiram tempo,
+    com quantidade de execuções, tempo total/médio/máximo, linhas e origens.
+    """
+    df = get_consultas_recentes()
+    if df.empty:
+        return df
+    df['id_consulta'] = df['fingerprint'].map(lambda texto: hashlib.md5(texto.encode('utf-8')).hexdigest()[:10])
+    top = df.groupby(['banco', 'id_consulta', 'fingerprint'], as_index=False).agg(
+        execucoes=('duracao_ms', 'size'),
+        tempo_total_ms=('duracao_ms', 'sum'),
+        tempo_medio_ms=('duracao_ms', 'mean'),
+        tempo_maximo_ms=('duracao_ms', 'max'),
+        linhas_media=('linhas', 'mean'),
+        origens=('origem', lambda origens: ', '.join(sorted({o for o in origens if o}))),
+        paginas=('pagina', lambda paginas: ', '.join(sorted({p for p in paginas if p}))),
+    )
+    return top.sort_values('tempo_total_ms', ascending=False).head(limite)
+
+def get_consultas_lentas(limite=50):
+    """Retorna as últimas consultas lentas gravadas em 'query_log' (DataFrame vazio se não houver)."""
+    from database import get_sqlite_connection  # database importa este módulo
+    with get_sqlite_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='query_log'")
+        if not cursor.fetchone():
+            return pd.DataFrame()
+        # Inclui as consultas lentas que ainda aguardavam um commit para serem gravadas
+        gravar_consultas_lentas(conn)
+        return pd.read_sql_query("SELECT * FROM query_log ORDER BY id DESC LIMIT ?", conn, params=(limite,))
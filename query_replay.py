@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import pickle
+import sqlite3
+import hashlib
+import datetime
+import threading
+from collections import deque
+from contextlib import closing
+from decimal import Decimal
+
+# Modo das conexões com Protheus/DTS:
+#   ''           -> conexões reais (padrão)
+#   'gravar'     -> conexões reais, gravando cada consulta e seu resultado em DB_GRAVACOES
+#   'reproduzir' -> nenhuma conexão externa: as consultas são respondidas a partir de DB_GRAVACOES
+DB_MODO_GRAVACAO = os.environ.get('DB_MODO_GRAVACAO', '').strip().lower()
+DB_GRAVACOES = os.environ.get('DB_GRAVACOES', 'gravacoes_consultas.db')
+# Na reprodução, cada consulta espera REPLAY_FATOR_LATENCIA x o tempo gravado + REPLAY_LATENCIA_MS
+REPLAY_FATOR_LATENCIA = float(os.environ.get('REPLAY_FATOR_LATENCIA', 0))
+REPLAY_LATENCIA_MS = float(os.environ.get('REPLAY_LATENCIA_MS', 0))
+
+# Tipos que podem aparecer em cursor.description, gravados pelo nome
+_TIPOS = {
+    'str': str, 'int': int, 'float': float, 'bool': bool, 'bytes': bytes, 'bytearray': bytearray,
+    'Decimal': Decimal, 'date': datetime.date, 'datetime': datetime.datetime, 'time': datetime.time,
+}
+
+_gravacoes_lock = threading.Lock()
+_gravacoes_em_memoria = None
+
+class ConsultaNaoGravada(Exception):
+    """A consulta pedida na reprodução não existe em DB_GRAVACOES."""
+
+def modo_reproducao():
+    return DB_MODO_GRAVACAO == 'reproduzir'
+
+def _parametros(params):
+    # pyodbc aceita execute(sql, p1, p2) e execute(sql, [p1, p2]); os dois viram a mesma chave
+    if len(params) == 1 and isinstance(params[0], (list, tuple)):
+        params = params[0]
+    return [repr(p) for p in params]
+
+def _chave(banco, sql, parametros):
+    sql_normalizado = ' '.join(sql.split())
+    return hashlib.sha1(json.dumps([banco, sql_normalizado, parametros]).encode('utf-8')).hexdigest()
+
+def _criar_tabela(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS gravacoes (
+            chave TEXT PRIMARY KEY,
+            banco TEXT,
+            sql TEXT,
+            parametros TEXT, -- lista JSON com o repr de cada parâmetro
+            colunas TEXT, -- lista JSON de [nome, tipo]; NULL para comandos sem resultado
+            linhas BLOB, -- linhas do resultado (pickle)
+            rowcount INTEGER,
+            duracao_ms REAL,
+            data_gravacao TEXT
+        )
+    ''')
+
+def _gravar(banco, sql, parametros, colunas, linhas, rowcount, duracao_ms):
+    with _gravacoes_lock:
+        with closing(sqlite3.connect(DB_GRAVACOES)) as conn, conn:
+            _criar_tabela(conn)
+            conn.execute(
+                "INSERT OR REPLACE INTO gravacoes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    _chave(banco, sql, parametros), banco, sql, json.dumps(parametros),
+                    json.dumps(colunas) if colunas is not None else None,
+                    pickle.dumps(linhas), rowcount, duracao_ms,
+                    datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                )
+            )
+            conn.commit()
+
+def _buscar_gravacao(chave):
+    """Carrega DB_GRAVACOES em memória na primeira chamada e retorna a gravação da chave."""
+    global _gravacoes_em_memoria
+    with _gravacoes_lock:
+        if _gravacoes_em_memoria is None:
+            _gravacoes_em_memoria = {}
+            if os.path.exists(DB_GRAVACOES):
+                with closing(sqlite3.connect(DB_GRAVACOES)) as conn, conn:
+                    _criar_tabela(conn)
+                    for linha in conn.execute("SELECT chave, colunas, linhas, rowcount, duracao_ms FROM gravacoes"):
+                        _gravacoes_em_memoria[linha[0]] = linha[1:]
+            print(f"Reprodução de consultas: {len(_gravacoes_em_memoria)} gravações carregadas de {DB_GRAVACOES}.")
+        return _gravacoes_em_memoria.get(chave)
+
+class RecordingCursor:
+    """Cursor que executa no banco real e grava a consulta com o resultado completo."""
+    def __init__(self, cursor, banco):
+        self._cursor = cursor
+        self._banco = banco
+        self._linhas = deque()
+        self.description = None
+        self.rowcount = -1
+
+    def __getattr__(self, nome):
+        return getattr(self._cursor, nome)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        while self._linhas:
+            yield self._linhas.popleft()
+
+    def execute(self, sql, *params):
+        inicio = time.perf_counter()
+        self._cursor.execute(sql, *params)
+        self.description = self._cursor.description
+        self.rowcount = getattr(self._cursor, 'rowcount', -1)
+        # O resultado é lido por inteiro para ser gravado; o chamador lê da memória
+        linhas = [tuple(linha) for linha in self._cursor.fetchall()] if self.description else []
+        self._linhas = deque(linhas)
+        duracao_ms = (time.perf_counter() - inicio) * 1000
+        colunas = [[coluna[0], getattr(coluna[1], '__name__', 'str')] for coluna in self.description] if self.description else None
+        try:
+            _gravar(self._banco, sql, _parametros(params), colunas, linhas, self.rowcount, duracao_ms)
+        except Exception as e:
+            print(f"Aviso: Não foi possível gravar a consulta em {DB_GRAVACOES}: {e}")
+        return self
+
+    def fetchone(self):
+        return self._linhas.popleft() if self._linhas else None
+
+    def fetchmany(self, tamanho=1):
+        return [self._linhas.popleft() for _ in range(min(tamanho, len(self._linhas)))]
+
+    def fetchall(self):
+        linhas = list(self._linhas)
+        self._linhas.clear()
+        return linhas
+
+    def close(self):
+        self._cursor.close()
+
+class RecordingConnection:
+    """Conexão real cujos cursores gravam as consultas em DB_GRAVACOES."""
+    def __init__(self, conn, banco):
+        self._conn = conn
+        self._banco = banco
+
+    def __getattr__(self, nome):
+        return getattr(self._conn, nome)
+
+    def cursor(self):
+        return RecordingCursor(self._conn.cursor(), self._banco)
+
+    def execute(self, sql, *params):
+        return self.cursor().execute(sql, *params)
+
+class ReplayCursor(RecordingCursor):
+    """Cursor que responde às consultas a partir de DB_GRAVACOES, simulando a latência se configurado."""
+    def __init__(self, banco):
+        self._banco = banco
+        self._linhas = deque()
+        self.description = None
+        self.rowcount = -1
+
+    def __getattr__(self, nome):
+        raise AttributeError(nome)
+
+    def execute(self, sql, *params):
+        if ' '.join(sql.split()).upper() == 'SELECT 1':
+            # Ping do pool de conexões
+            self.description = [('', int, None, None, None, None, True)]
+            self._linhas = deque([(1,)])
+            return self
+        gravacao = _buscar_gravacao(_chave(self._banco, sql, _parametros(params)))
+        if gravacao is None:
+            raise ConsultaNaoGravada(
+                f"Consulta ao {self._banco} não encontrada em {DB_GRAVACOES} (grave-a com DB_MODO_GRAVACAO=gravar): "
+                f"{' '.join(sql.split())[:200]}"
+            )
+        colunas, linhas, rowcount, duracao_ms = gravacao
+        espera_ms = REPLAY_FATOR_LATENCIA * (duracao_ms or 0) + REPLAY_LATENCIA_MS
+        if espera_ms > 0:
+            time.sleep(espera_ms / 1000)
+        self.description = (
+            [(nome, _TIPOS.get(tipo, str), None, None, None, None, True) for nome, tipo in json.loads(colunas)]
+            if colunas else None
+        )
+        self._linhas = deque(pickle.loads(linhas))
+        self.rowcount = rowcount
+        return self
+
+    def executemany(self, sql, seq_params):
+        for params in seq_params:
+            self.execute(sql, params)
+        return self
+
+    def close(self):
+        self._linhas.clear()
+
+class ReplayConnection:
+    """Conexão sem banco por trás: serve as consultas gravadas de Protheus/DTS."""
+    def __init__(self, banco):
+        self._banco = banco
+        self.timeout = 0
+
+    def cursor(self):
+        return ReplayCursor(self._banco)
+
+    def execute(self, sql, *params):
+        return self.cursor().execute(sql, *params)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+def preparar_conexao(banco, conectar):
+    """
+    Abre a conexão com 'banco' de acordo com DB_MODO_GRAVACAO: chama 'conectar' para obter
+    a conexão real e a envolve para gravação, ou devolve uma ReplayConnection sem conectar.
+    """
+    if DB_MODO_GRAVACAO == 'reproduzir':
+        return ReplayConnection(banco)
+    if DB_MODO_GRAVACAO == 'gravar':
+        return RecordingConnection(conectar(), banco)
+    return conectar()
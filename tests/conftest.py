@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+# Os módulos do projeto ficam na raiz do repositório
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+
+@pytest.fixture
+def banco_local(tmp_path, monkeypatch):
+    """
+    Executa o teste em um diretório temporário, onde 'garantia.db' (DB_LOCAL) é um banco novo.
+    As conexões SQLite persistentes abertas durante o teste são fechadas ao final.
+    """
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path / 'garantia.db'
+    database.fechar_conexoes_sqlite()
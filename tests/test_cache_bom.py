@@ -0,0 +1,69 @@
+import sqlite3
+from contextlib import closing, contextmanager
+
+import pandas as pd
+
+import db_manager
+
+
+def _bom_protheus():
+    # Mesmas colunas e tipos que o pyodbc entrega para a CTE de _buscar_bom_protheus; as
+    # quantidades inteiras são as que a afinidade INTEGER devolvia como int
+    return pd.DataFrame({
+        'Componente': ['C001', 'S002', 'C003'],
+        'Descricao_Componente': ['Parafuso', 'Subconjunto', 'Arruela'],
+        'Quantidade': [2.0, 1.0, 4.0],
+        'Unidade_Medida': ['PC', 'PC', 'KG'],
+        'Nivel': [1, 1, 2],
+        'Pai_Componente': ['E100', 'E100', 'S002'],
+    })
+
+
+def test_bom_do_cache_igual_a_bom_do_protheus(banco_local, monkeypatch):
+    db_manager.init_database()
+
+    @contextmanager
+    def conexao_protheus():
+        yield None
+
+    monkeypatch.setattr(db_manager, 'get_protheus_connection', conexao_protheus)
+    monkeypatch.setattr(db_manager, '_buscar_bom_protheus', lambda conn, sku, nivel: _bom_protheus())
+
+    df_protheus = db_manager.get_componentes_by_sku_protheus('E100', nivel_maximo=3, usar_cache=False)
+
+    # A leitura seguinte vem do cache local, sem passar pelo Protheus
+    monkeypatch.setattr(db_manager, '_buscar_bom_protheus', None)
+    df_cache = db_manager.get_componentes_by_sku_protheus('E100', nivel_maximo=3)
+
+    pd.testing.assert_frame_equal(df_cache, df_protheus)
+    assert df_cache['Quantidade'].tolist() == [2.0, 1.0, 4.0]
+
+
+def test_cache_bom_antigo_passa_a_guardar_quantidade_real(banco_local):
+    # Tabela como o baseline criava, com quantidade INTEGER e uma linha já gravada
+    with closing(sqlite3.connect(banco_local)) as conn, conn:
+        conn.execute("""
+        CREATE TABLE componentes_produtos (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            produto_sku TEXT NOT NULL,
+            componente_sku TEXT NOT NULL,
+            componente_desc TEXT NOT NULL,
+            quantidade INTEGER NOT NULL
+        )
+        """)
+        conn.execute(
+            "INSERT INTO componentes_produtos (produto_sku, componente_sku, componente_desc, quantidade) "
+            "VALUES ('E100', 'C001', 'Parafuso', 2)"
+        )
+    conn.close()
+
+    db_manager.init_database()
+
+    conn = sqlite3.connect(banco_local)
+    try:
+        tipos = {linha[1]: linha[2] for linha in conn.execute("PRAGMA table_info(componentes_produtos)")}
+        quantidade = conn.execute("SELECT quantidade FROM componentes_produtos").fetchone()[0]
+    finally:
+        conn.close()
+    assert tipos['quantidade'] == 'REAL'
+    assert quantidade == 2.0 and isinstance(quantidade, float)
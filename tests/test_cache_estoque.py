@@ -0,0 +1,70 @@
+import pandas as pd
+import pytest
+
+import db_manager
+
+# Linhas por armazém como o Protheus devolve: códigos completados com espaços e, para
+# produto sem saldo em SB2, uma linha sem armazém
+ARMAZENS = pd.DataFrame({
+    'Codigo': ['C001      ', 'C001      ', 'C002      '],
+    'Descricao': ['Parafuso', 'Parafuso', 'Arruela'],
+    'Quantidade_Atual': [5.0, 3.0, 0.0],
+    'Quantidade_Empenhada': [1.0, 0.0, 0.0],
+    'Quantidade_Reservada': [0.0, 1.0, 0.0],
+    'Saldo_Disponivel': [4.0, 2.0, 0.0],
+    'Armazem': ['01', '02', None],
+    'Nome_Fornecedor': ['Fornecedor X', 'Fornecedor X', None],
+})
+
+
+@pytest.fixture
+def consultas_protheus(monkeypatch):
+    consultas = []
+
+    def consultar(components_list=None):
+        consultas.append(list(components_list))
+        codigos = ARMAZENS['Codigo'].str.rstrip()
+        return ARMAZENS[codigos.isin(components_list)].reset_index(drop=True)
+
+    monkeypatch.setattr(db_manager, '_cache_estoque', {})
+    monkeypatch.setattr(db_manager, '_consultar_estoque_protheus', consultar)
+    return consultas
+
+
+def test_detalhe_por_armazem_e_saldos_somados_saem_do_mesmo_cache(consultas_protheus):
+    df_armazens = db_manager.get_estoque_componentes(['C001', 'C002'], por_armazem=True)
+    df_somado = db_manager.get_estoque_componentes(['C002', 'C001'])
+    df_armazens_de_novo = db_manager.get_estoque_componentes(['C001'], por_armazem=True)
+
+    assert consultas_protheus == [['C001', 'C002']]
+    assert df_armazens['Armazem'].tolist() == ['01', '02', None]
+    assert df_armazens_de_novo['Armazem'].tolist() == ['01', '02']
+
+    assert list(df_somado.columns) == [
+        'Codigo', 'Descricao', 'Quantidade_Atual', 'Quantidade_Empenhada', 'Quantidade_Reservada',
+        'Saldo_Disponivel', 'Quantidade_Armazens', 'Nome_Fornecedor',
+    ]
+    somado = df_somado.set_index('Codigo')
+    assert somado.loc['C001      ', 'Saldo_Disponivel'] == 6.0
+    assert somado.loc['C001      ', 'Quantidade_Armazens'] == 2
+    assert somado.loc['C002      ', 'Quantidade_Armazens'] == 0
+    assert somado.loc['C001      ', 'Nome_Fornecedor'] == 'Fornecedor X'
+
+
+def test_saldos_do_indice_iguais_aos_somados(consultas_protheus):
+    por_armazem = db_manager.indexar_estoque(db_manager.get_estoque_componentes(['C001', 'C002'], por_armazem=True))
+    somado = db_manager.indexar_estoque(db_manager.get_estoque_componentes(['C001', 'C002']))
+
+    assert len(consultas_protheus) == 1
+    for sku in ('C001', 'C002'):
+        for coluna in ('Saldo_Disponivel', 'Quantidade_Atual', 'Quantidade_Armazens'):
+            assert por_armazem[sku][coluna] == somado[sku][coluna]
+    assert [armazem['Armazem'] for armazem in por_armazem['C001']['Armazens']] == ['01', '02']
+
+
+def test_cache_invalidado_consulta_de_novo_so_o_sku_liberado(consultas_protheus):
+    db_manager.get_estoque_componentes(['C001', 'C002'], por_armazem=True)
+    db_manager.invalidar_cache_estoque(['C001'])
+    db_manager.get_estoque_componentes(['C001', 'C002'], por_armazem=True)
+
+    assert consultas_protheus == [['C001', 'C002'], ['C001']]
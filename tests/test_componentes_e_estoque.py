@@ -0,0 +1,61 @@
+import threading
+
+import pandas as pd
+
+import db_manager
+
+COLUNAS = ['Componente', 'Descricao_Componente', 'Quantidade', 'Unidade_Medida', 'Nivel', 'Pai_Componente']
+
+
+def _estoque(componentes):
+    return pd.DataFrame({'Codigo': list(componentes), 'Saldo_Disponivel': [10.0] * len(componentes)})
+
+
+def test_nivel_1_produzido_antes_do_estoque_e_consultado_uma_vez(banco_local, monkeypatch):
+    db_manager.init_database()
+    df_nivel_1 = pd.DataFrame(
+        [('C001', 'Parafuso', 2.0, 'PC', 1, 'E100'), ('S002', 'Subconjunto', 1.0, 'PC', 1, 'E100')], columns=COLUNAS
+    )
+    df_subniveis = pd.DataFrame([('C003', 'Arruela', 4.0, 'PC', 2, 'S002')], columns=COLUNAS)
+    consultas_nivel_1 = []
+    estoque_liberado = threading.Event()
+    subniveis_liberados = threading.Event()
+
+    def nivel_1(sku):
+        consultas_nivel_1.append(sku)
+        return df_nivel_1
+
+    def subniveis(sku, df, nivel_maximo):
+        # Parte do nível 1 já lido, em vez de consultá-lo de novo
+        assert df is df_nivel_1
+        subniveis_liberados.wait(5)
+        return df_subniveis
+
+    def estoque(componentes, *args, **kwargs):
+        estoque_liberado.wait(5)
+        return _estoque(componentes)
+
+    monkeypatch.setattr(db_manager, '_bom_nivel_1_protheus', nivel_1)
+    monkeypatch.setattr(db_manager, '_buscar_subniveis_bom', subniveis)
+    monkeypatch.setattr(db_manager, 'get_estoque_componentes', estoque)
+
+    resultados = db_manager.buscar_componentes_e_estoque('E100', nivel_maximo=3)
+
+    # A prévia do nível 1 sai antes de o estoque responder
+    df_componentes, df_estoque, completo = next(resultados)
+    assert not completo and df_estoque.empty
+    assert df_componentes['Componente'].tolist() == ['C001', 'S002']
+
+    estoque_liberado.set()
+    df_componentes, df_estoque, completo = next(resultados)
+    assert not completo and df_estoque['Codigo'].tolist() == ['C001', 'S002']
+
+    subniveis_liberados.set()
+    df_componentes, df_estoque, completo = next(resultados)
+    assert completo
+    assert df_componentes['Componente'].tolist() == ['C001', 'S002', 'C003']
+    assert sorted(df_estoque['Codigo']) == ['C001', 'C003', 'S002']
+    assert consultas_nivel_1 == ['E100']
+
+    # A BOM completa fica no cache
+    pd.testing.assert_frame_equal(db_manager._ler_cache_bom('E100', 3), df_componentes)
@@ -0,0 +1,77 @@
+import threading
+
+import database
+import db_manager
+
+
+def _em_outra_thread(funcao):
+    resultado = []
+    thread = threading.Thread(target=lambda: resultado.append(funcao()))
+    thread.start()
+    thread.join()
+    return resultado[0]
+
+
+def test_conexao_reaproveitada_por_threads_sucessivas(banco_local):
+    # O Streamlit executa cada atualização da página numa thread nova
+    primeira = _em_outra_thread(lambda: database.get_sqlite_connection(database.DB_LOCAL))
+    segunda = _em_outra_thread(lambda: database.get_sqlite_connection(database.DB_LOCAL))
+    assert primeira is segunda
+    assert segunda.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+
+
+def test_threads_simultaneas_usam_conexoes_diferentes(banco_local):
+    conexoes = []
+    pronta = threading.Barrier(2)
+
+    def usar():
+        conexoes.append(database.get_sqlite_connection(database.DB_LOCAL))
+        pronta.wait(5)
+
+    threads = [threading.Thread(target=usar) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert conexoes[0] is not conexoes[1]
+
+
+def test_transacao_deixada_aberta_por_thread_encerrada_e_desfeita(banco_local):
+    db_manager.init_database()
+
+    def escrever_sem_commit():
+        conn = db_manager.get_db_connection()
+        conn.execute(
+            "INSERT INTO historico (solicitacao_id, timestamp, usuario, acao) VALUES (1, '2024-01-01', 'teste', 'pendente')"
+        )
+        return conn
+
+    conn = _em_outra_thread(escrever_sem_commit)
+    assert not conn.in_transaction
+    assert db_manager.get_db_connection().execute("SELECT COUNT(*) FROM historico").fetchone()[0] == 0
+
+
+def test_close_nao_fecha_a_conexao_compartilhada(banco_local):
+    db_manager.init_database()
+    conn = db_manager.get_db_connection()
+    # Um auxiliar que fecha a conexão não a tira de quem continua usando
+    db_manager.get_db_connection().close()
+    assert conn.execute("SELECT COUNT(*) FROM historico").fetchone()[0] == 0
+
+
+def test_close_e_with_nao_encerram_a_transacao_externa(banco_local):
+    db_manager.init_database()
+    try:
+        with db_manager.transacao() as conn:
+            conn.execute(
+                "INSERT INTO historico (solicitacao_id, timestamp, usuario, acao) VALUES (1, '2024-01-01', 'teste', 'externa')"
+            )
+            # Um auxiliar que fecha a conexão ou usa 'with' não desfaz nem grava a unidade de trabalho
+            with db_manager.get_db_connection() as conn_auxiliar:
+                conn_auxiliar.execute("SELECT COUNT(*) FROM historico").fetchone()
+            db_manager.get_db_connection().close()
+            assert conn.in_transaction
+            raise RuntimeError("falha depois do auxiliar")
+    except RuntimeError:
+        pass
+    assert db_manager.get_db_connection().execute("SELECT COUNT(*) FROM historico").fetchone()[0] == 0
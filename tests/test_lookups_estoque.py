@@ -0,0 +1,55 @@
+import pandas as pd
+
+import db_manager
+
+
+def _protheus(query, valores):
+    # Respostas do Protheus conforme a tabela consultada
+    if 'SA5010' in query:
+        return pd.DataFrame({'produto': ['C001      '], 'nome_fornecedor': ['Fornecedor X'],
+                             'descricao_produto_fornecedor': ['Parafuso X']})
+    if 'SC7010' in query:
+        return pd.DataFrame({'produto': ['C001      '], 'previsao_entrega': ['20241231']})
+    return pd.DataFrame({
+        'Codigo': [sku.ljust(10) for sku in valores], 'Descricao': ['Parafuso'] * len(valores),
+        'Quantidade_Atual': [5.0] * len(valores), 'Quantidade_Empenhada': [0.0] * len(valores),
+        'Quantidade_Reservada': [0.0] * len(valores), 'Saldo_Disponivel': [5.0] * len(valores),
+        'Armazem': ['01'] * len(valores),
+    })
+
+
+def test_banco_sem_lookups_consulta_fornecedor_no_protheus(banco_local, monkeypatch):
+    db_manager.init_database()
+    consultas = []
+
+    def consultar_em_lotes(query, valores):
+        consultas.append((query, list(valores)))
+        return _protheus(query, valores)
+
+    monkeypatch.setattr(db_manager, '_lookups_carregados', False)
+    monkeypatch.setattr(db_manager, '_agendar_atualizacao_lookups_estoque', lambda: None)
+    monkeypatch.setattr(db_manager, 'consultar_protheus_em_lotes', consultar_em_lotes)
+
+    df_estoque = db_manager._consultar_estoque_protheus(['C001', 'C002']).set_index('Codigo')
+
+    assert df_estoque.loc['C001      ', 'Nome_Fornecedor'] == 'Fornecedor X'
+    assert df_estoque.loc['C001      ', 'Previsao_Entrega_Ultimo_Pedido'] == '20241231'
+    assert pd.isna(df_estoque.loc['C002      ', 'Nome_Fornecedor'])
+    # Fornecedor e último pedido só dos produtos consultados
+    assert all(valores == ['C001', 'C002'] for _, valores in consultas)
+
+
+def test_lookups_locais_de_muitos_produtos_numa_consulta(banco_local):
+    db_manager.init_database()
+    produtos = [f'C{i:04d}' for i in range(1200)]
+    with db_manager.get_db_connection() as conn:
+        conn.executemany("INSERT INTO fornecedor_principal VALUES (?, ?, ?)",
+                         [(produto, f'Fornecedor {produto}', None) for produto in produtos[::2]])
+        conn.execute("INSERT INTO ultimo_pedido_compra VALUES ('C1199', '20241231')")
+
+    df_lookups = db_manager._ler_lookups_estoque(produtos).set_index('produto')
+
+    assert len(df_lookups) == 1200
+    assert df_lookups.loc['C0600', 'Nome_Fornecedor'] == 'Fornecedor C0600'
+    assert pd.isna(df_lookups.loc['C0601', 'Nome_Fornecedor'])
+    assert df_lookups.loc['C1199', 'Previsao_Entrega_Ultimo_Pedido'] == '20241231'
@@ -0,0 +1,45 @@
+import pandas as pd
+
+from gerar_base_pedidos import _calcular_marca_d_agua
+
+
+def _pedidos(*pedidos):
+    return pd.DataFrame(pedidos, columns=['NumeroPedido', 'Recno', 'Emissao'])
+
+
+def test_carga_completa_usa_o_maior_recno_e_a_maior_emissao():
+    df = _pedidos(('000001', 1, '20240101'), ('000002', 2, '20240105'), ('000003', 3, '20240103'))
+    assert _calcular_marca_d_agua(df, []) == (3, '20240105')
+
+
+def test_sem_pedidos_mantem_a_marca_anterior():
+    assert _calcular_marca_d_agua(_pedidos(), [], (40, '20240128')) is None
+
+
+def test_pedidos_da_janela_de_emissao_nao_recuam_a_marca():
+    # Incremental sem pedidos novos: só a janela de emissão foi reprocessada
+    df = _pedidos(('000027', 27, '20240128'), ('000020', 20, '20240121'))
+    assert _calcular_marca_d_agua(df, [], (40, '20240128')) == (40, '20240128')
+
+
+def test_pedidos_novos_avancam_a_marca():
+    df = _pedidos(('000027', 27, '20240128'), ('000041', 41, '20240301'), ('000042', 42, '20240302'))
+    assert _calcular_marca_d_agua(df, [], (40, '20240128')) == (42, '20240302')
+
+
+def test_erro_em_pedido_novo_segura_a_marca_antes_dele():
+    df = _pedidos(('000041', 41, '20240301'), ('000042', 42, '20240302'), ('000043', 43, '20240303'))
+    assert _calcular_marca_d_agua(df, ['000042'], (40, '20240128')) == (41, '20240302')
+
+
+def test_erro_na_carga_completa_segura_a_marca_antes_do_pedido():
+    df = _pedidos(('000001', 1, '20240101'), ('000002', 2, '20240102'), ('000003', 3, '20240103'))
+    assert _calcular_marca_d_agua(df, ['000002'], None) == (1, '20240102')
+
+
+def test_erro_em_pedido_da_janela_nao_recua_o_recno():
+    df = _pedidos(('000027', 27, '20240125'), ('000041', 41, '20240301'))
+    ultimo_recno, ultima_emissao = _calcular_marca_d_agua(df, ['000027'], (40, '20240128'))
+    assert ultimo_recno == 41
+    # A emissão não passa da do pedido com erro, que continua dentro da janela
+    assert ultima_emissao == '20240125'
@@ -0,0 +1,104 @@
+from contextlib import closing
+import sqlite3
+
+import migracoes
+from migracoes import MIGRACOES, VERSAO_SCHEMA, migrar_banco, versao_banco
+
+
+def _tabelas(caminho):
+    with closing(sqlite3.connect(caminho)) as conn, conn:
+        return {linha[0] for linha in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+
+def _colunas(caminho, tabela):
+    with closing(sqlite3.connect(caminho)) as conn, conn:
+        return {linha[1]: linha[2] for linha in conn.execute(f"PRAGMA table_info({tabela})")}
+
+
+def test_banco_novo_recebe_todas_as_migracoes(banco_local):
+    assert migrar_banco(str(banco_local)) == VERSAO_SCHEMA
+    assert versao_banco(str(banco_local)) == VERSAO_SCHEMA
+    assert {
+        'solicitacoes', 'itens_solicitacao', 'historico', 'centros_custo', 'etl_progresso', 'etl_runs',
+        'sync_estado', 'componentes_produtos', 'componentes_produtos_cache', 'fornecedor_principal',
+        'ultimo_pedido_compra', 'query_log',
+    } <= _tabelas(banco_local)
+    assert _colunas(banco_local, 'componentes_produtos')['quantidade'] == 'REAL'
+    with closing(sqlite3.connect(banco_local)) as conn, conn:
+        assert conn.execute("SELECT COUNT(*) FROM centros_custo").fetchone()[0] == 3
+
+
+def test_banco_atualizado_nao_executa_migracoes(banco_local, monkeypatch):
+    migrar_banco(str(banco_local))
+    monkeypatch.setattr(migracoes, 'MIGRACOES', [(numero, descricao, None) for numero, descricao, _ in MIGRACOES])
+    assert migrar_banco(str(banco_local)) == VERSAO_SCHEMA
+
+
+def test_banco_anterior_ao_controle_de_versao_e_migrado_com_backup(banco_local):
+    # Estrutura criada pelas versões anteriores a migracoes.py (user_version = 0)
+    with closing(sqlite3.connect(banco_local)) as conn, conn:
+        conn.executescript('''
+            CREATE TABLE solicitacoes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, data_criacao TEXT, solicitante TEXT,
+                status_atual TEXT, data_ultimo_status TEXT
+            );
+            CREATE TABLE itens_solicitacao (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, solicitacao_id INTEGER, componente_sku TEXT,
+                componente_desc TEXT, quantidade_solicitada INTEGER
+            );
+            CREATE TABLE historico (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, solicitacao_id INTEGER, timestamp TEXT,
+                usuario TEXT, acao TEXT, detalhes TEXT
+            );
+            CREATE TABLE componentes_produtos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, produto_sku TEXT NOT NULL, componente_sku TEXT NOT NULL,
+                componente_desc TEXT NOT NULL, quantidade INTEGER NOT NULL
+            );
+            CREATE TABLE pedidos_info ("Nº PDV" TEXT, "CNPJ/CPF" TEXT, "SKU Protheus" TEXT);
+            INSERT INTO solicitacoes (data_criacao, solicitante, status_atual) VALUES ('2024-01-01', 'ana', 'Aprovada');
+            INSERT INTO historico (solicitacao_id, acao) VALUES (1, 'Criação');
+        ''')
+
+    assert migrar_banco(str(banco_local)) == VERSAO_SCHEMA
+
+    assert 'centro_custo' in _colunas(banco_local, 'solicitacoes')
+    assert 'quantidade_liberada' in _colunas(banco_local, 'itens_solicitacao')
+    assert _colunas(banco_local, 'componentes_produtos')['quantidade'] == 'REAL'
+    with closing(sqlite3.connect(banco_local)) as conn, conn:
+        assert conn.execute("SELECT solicitante, status_atual FROM solicitacoes").fetchall() == [('ana', 'Aprovada')]
+        indices = {linha[1] for linha in conn.execute("PRAGMA index_list(pedidos_info)")}
+    assert 'idx_pedidos_info_pdv' in indices
+    assert list(banco_local.parent.glob('garantia.db.backup_*'))
+
+
+def test_banco_em_versao_intermediaria_recebe_so_as_pendentes(banco_local, monkeypatch):
+    monkeypatch.setattr(migracoes, 'MIGRACOES', MIGRACOES[:6])
+    monkeypatch.setattr(migracoes, 'VERSAO_SCHEMA', 6)
+    assert migrar_banco(str(banco_local)) == 6
+    with closing(sqlite3.connect(banco_local)) as conn, conn:
+        conn.execute(
+            "INSERT INTO componentes_produtos (produto_sku, componente_sku, componente_desc, quantidade, ordem) "
+            "VALUES ('E100', 'C001', 'Parafuso', 2, 0)"
+        )
+    monkeypatch.setattr(migracoes, 'MIGRACOES', MIGRACOES)
+    monkeypatch.setattr(migracoes, 'VERSAO_SCHEMA', VERSAO_SCHEMA)
+
+    assert migrar_banco(str(banco_local)) == VERSAO_SCHEMA
+    with closing(sqlite3.connect(banco_local)) as conn, conn:
+        assert conn.execute("SELECT quantidade, typeof(quantidade) FROM componentes_produtos").fetchall() == [(2.0, 'real')]
+
+
+def test_migracao_da_quantidade_pode_ser_repetida(banco_local):
+    migrar_banco(str(banco_local))
+    migracao = dict((numero, funcao) for numero, _, funcao in MIGRACOES)[7]
+    with closing(sqlite3.connect(banco_local)) as conn, conn:
+        conn.execute(
+            "INSERT INTO componentes_produtos (produto_sku, componente_sku, componente_desc, quantidade, ordem) "
+            "VALUES ('E100', 'C001', 'Parafuso', 1.5, 0)"
+        )
+        # Cópia deixada por uma execução interrompida
+        conn.execute("CREATE TABLE componentes_produtos_nova (id INTEGER PRIMARY KEY, lixo TEXT)")
+        migracao(conn.cursor())
+        migracao(conn.cursor())
+        assert conn.execute("SELECT componente_sku, quantidade FROM componentes_produtos").fetchall() == [('C001', 1.5)]
+    assert 'componentes_produtos_nova' not in _tabelas(banco_local)
@@ -0,0 +1,26 @@
+from gerar_base_pedidos import _percentil
+
+
+def test_sem_valores():
+    assert _percentil([], 50) is None
+
+
+def test_mediana_com_quantidade_impar():
+    assert _percentil([5, 1, 4, 2, 3], 50) == 3
+
+
+def test_mediana_com_quantidade_par():
+    # Posto mais próximo: ceil(0,5 * 4) = 2º valor
+    assert _percentil([4, 1, 3, 2], 50) == 2
+
+
+def test_p95():
+    valores = list(range(1, 21))
+    assert _percentil(valores, 95) == 19
+    assert _percentil(valores + [21], 95) == 20
+
+
+def test_extremos():
+    assert _percentil([3, 1, 2], 0) == 1
+    assert _percentil([3, 1, 2], 100) == 3
+    assert _percentil([7], 95) == 7
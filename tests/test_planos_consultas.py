@@ -0,0 +1,54 @@
+import inspect
+
+import db_manager
+from migracoes import criar_indices_pedidos_info, nome_sql
+
+COLUNAS_PEDIDOS_INFO = [
+    'CNPJ/CPF', 'Nome/Razão Social', 'Data Venda', 'Nº PDV', 'SKU Protheus', 'Descrição do Produto', 'C5_NUM',
+]
+
+
+def _banco_migrado():
+    db_manager.init_database()
+    # pedidos_info é criada pela carga do ETL, com os índices de INDICES_PEDIDOS_INFO
+    with db_manager.get_db_connection() as conn:
+        conn.execute(f"CREATE TABLE pedidos_info ({', '.join(nome_sql(coluna) + ' TEXT' for coluna in COLUNAS_PEDIDOS_INFO)})")
+        criar_indices_pedidos_info(conn.cursor())
+    return db_manager.get_db_connection()
+
+
+def _contagem(conn, tabela):
+    return conn.execute(f"SELECT COUNT(*) FROM {tabela}").fetchone()[0]
+
+
+def test_banco_migrado_nao_tem_varreduras_completas(banco_local):
+    conn = _banco_migrado()
+
+    assert db_manager.verificar_planos_consultas() == []
+
+    # As gravações feitas durante a verificação são desfeitas
+    for tabela in ('solicitacoes', 'itens_solicitacao', 'historico', 'componentes_produtos'):
+        assert _contagem(conn, tabela) == 0
+
+
+def test_varredura_sem_indice_e_apontada(banco_local):
+    conn = _banco_migrado()
+    conn.execute("DROP INDEX idx_centros_custo_setor")
+    conn.execute("DROP INDEX idx_historico_solicitacao")
+
+    varreduras = {(funcao, detalhe) for funcao, _, detalhe in db_manager.verificar_planos_consultas()}
+
+    assert ('get_centros_custo', 'SCAN centros_custo') in varreduras
+    assert ('get_historico_solicitacao', 'SCAN historico') in varreduras
+
+
+def test_toda_funcao_com_sql_local_e_verificada_ou_isenta():
+    fonte_verificacao = inspect.getsource(db_manager.verificar_planos_consultas)
+    internas = {'transacao', 'get_db_connection', 'init_database', 'verificar_planos_consultas'}
+    for nome, funcao in inspect.getmembers(db_manager, inspect.isfunction):
+        if funcao.__module__ != 'db_manager' or nome in internas:
+            continue
+        fonte = inspect.getsource(funcao)
+        if 'get_db_connection()' not in fonte and 'transacao()' not in fonte:
+            continue
+        assert f"('{nome}'," in fonte_verificacao or nome in db_manager.PLANOS_NAO_VERIFICADOS, nome
@@ -0,0 +1,47 @@
+import pytest
+
+import database
+import db_manager
+from database import ConnectionPool, FalhaConexao
+
+
+def _fabrica_com_falha():
+    raise RuntimeError("servidor fora do ar")
+
+
+def test_falha_ao_abrir_conexao_libera_a_vaga_do_pool():
+    pool = ConnectionPool("TESTE", _fabrica_com_falha, 1, timeout_checkout=0.1)
+    for _ in range(2):
+        with pytest.raises(FalhaConexao) as erro:
+            pool.acquire()
+        assert isinstance(erro.value.__cause__, RuntimeError)
+
+
+def test_aviso_de_conexao_simulada_aparece_so_na_criacao_do_pool(monkeypatch):
+    avisos = []
+    monkeypatch.setattr(database, 'is_streamlit_cloud', True)
+    monkeypatch.setattr(database.st, 'warning', avisos.append)
+    monkeypatch.setattr(database, '_recursos_compartilhados', {})
+
+    for _ in range(3):
+        with database.get_protheus_connection():
+            pass
+        database.get_dts_pool()
+
+    assert len(avisos) == 2
+
+
+def test_estoque_sem_conexao_com_protheus_mostra_erro_e_interrompe(monkeypatch):
+    erros, paradas = [], []
+    monkeypatch.setattr(database.st, 'error', erros.append)
+    monkeypatch.setattr(database.st, 'stop', lambda: paradas.append(True))
+    monkeypatch.setattr(
+        database, '_recursos_compartilhados', {'pool_protheus': ConnectionPool("PROTHEUS", _fabrica_com_falha, 1)}
+    )
+
+    # Fora da thread do script o st.stop não interrompe a execução: o erro chega a quem chamou
+    with pytest.raises(FalhaConexao):
+        db_manager.get_estoque_componentes(['C001'], usar_cache=False)
+
+    assert paradas == [True]
+    assert len(erros) == 1 and 'Falha na conexão com o banco de dados Protheus' in erros[0]
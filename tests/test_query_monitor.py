@@ -0,0 +1,58 @@
+import sqlite3
+import time
+
+import db_manager
+import query_monitor
+
+
+def _fingerprints_gravados():
+    conn = sqlite3.connect(db_manager.DB_LOCAL)
+    try:
+        return [linha[0] for linha in conn.execute("SELECT fingerprint FROM query_log ORDER BY id")]
+    finally:
+        conn.close()
+
+
+def test_consultas_lentas_dentro_de_transacao_sao_gravadas_apos_o_commit(banco_local, monkeypatch):
+    db_manager.init_database()
+    monkeypatch.setattr(query_monitor, 'QUERY_LENTA_MS', 0)
+
+    inicio = time.perf_counter()
+    conn = db_manager.get_db_connection()
+    try:
+        conn.execute("INSERT INTO historico (solicitacao_id, timestamp, usuario, acao) VALUES (?, ?, ?, ?)",
+                     (1, '2024-01-01 00:00:00', 'teste', 'teste'))
+        conn.execute("UPDATE historico SET detalhes = ? WHERE solicitacao_id = ?", ('x', 1))
+        conn.execute("SELECT COUNT(*) FROM historico")
+        # Nada é gravado enquanto a conexão detém o bloqueio de escrita
+        assert _fingerprints_gravados() == []
+        conn.commit()
+    finally:
+        conn.close()
+    # Sem esperar pelo timeout do bloqueio
+    assert time.perf_counter() - inicio < 1
+
+    gravados = _fingerprints_gravados()
+    assert 'INSERT INTO historico (solicitacao_id, timestamp, usuario, acao) VALUES (?, ?, ?, ?)' in gravados
+    assert 'UPDATE historico SET detalhes = ? WHERE solicitacao_id = ?' in gravados
+    # Cursor de conn.execute cujo resultado nunca foi lido também é registrado
+    assert 'SELECT COUNT(*) FROM historico' in gravados
+
+
+def test_consultas_rapidas_nao_sao_gravadas(banco_local):
+    db_manager.init_database()
+    with db_manager.get_db_connection() as conn:
+        conn.execute("SELECT COUNT(*) FROM historico").fetchone()
+    conn.close()
+    assert _fingerprints_gravados() == []
+
+
+def test_consultas_lentas_pendentes_aparecem_na_listagem(banco_local, monkeypatch):
+    db_manager.init_database()
+    monkeypatch.setattr(query_monitor, 'QUERY_LENTA_MS', 0)
+    conn = db_manager.get_db_connection()
+    conn.execute("SELECT COUNT(*) FROM solicitacoes").fetchone()
+    # Sem commit a consulta ainda está na fila; a listagem grava as pendentes antes de ler
+    df = query_monitor.get_consultas_lentas()
+    assert 'SELECT COUNT(*) FROM solicitacoes' in df['fingerprint'].tolist()
+    assert 'SELECT COUNT(*) FROM solicitacoes' in _fingerprints_gravados()
@@ -0,0 +1,62 @@
+import pytest
+
+import db_manager
+
+
+def _inserir(conn, acao):
+    conn.execute(
+        "INSERT INTO historico (solicitacao_id, timestamp, usuario, acao) VALUES (1, '2024-01-01', 'teste', ?)",
+        (acao,)
+    )
+
+
+def _acoes():
+    conn = db_manager.get_db_connection()
+    return [linha['acao'] for linha in conn.execute("SELECT acao FROM historico ORDER BY id")]
+
+
+@pytest.fixture
+def banco_inicializado(banco_local):
+    db_manager.init_database()
+    return banco_local
+
+
+def test_commit_unico_ao_final(banco_inicializado):
+    with db_manager.transacao():
+        db_manager.log_historico(1, 'usuario', 'primeira')
+        db_manager.log_historico(1, 'usuario', 'segunda')
+    assert _acoes() == ['primeira', 'segunda']
+
+
+def test_excecao_desfaz_toda_a_unidade_de_trabalho(banco_inicializado):
+    with pytest.raises(RuntimeError):
+        with db_manager.transacao() as conn:
+            _inserir(conn, 'externa')
+            db_manager.log_historico(1, 'usuario', 'aninhada')
+            raise RuntimeError("falha")
+    assert _acoes() == []
+    assert not db_manager.get_db_connection().in_transaction
+
+
+def test_excecao_tratada_desfaz_so_a_parte_aninhada(banco_inicializado):
+    with db_manager.transacao() as conn:
+        _inserir(conn, 'externa')
+        try:
+            with db_manager.transacao() as conn_aninhada:
+                _inserir(conn_aninhada, 'aninhada')
+                raise ValueError("falha tratada")
+        except ValueError:
+            pass
+        db_manager.log_historico(1, 'usuario', 'depois')
+    assert _acoes() == ['externa', 'depois']
+
+
+def test_niveis_aninhados_gravados_com_a_externa(banco_inicializado):
+    with db_manager.transacao():
+        with db_manager.transacao():
+            with db_manager.transacao() as conn:
+                _inserir(conn, 'terceiro nível')
+        # Nada é gravado antes do fim da transação externa
+        assert db_manager.get_db_connection().in_transaction
+    assert _acoes() == ['terceiro nível']
+    assert db_manager.get_db_connection().profundidade_transacao == 0